@@ -1,5 +1,5 @@
 #
-#   Secondary parsing method for 10-Q filings.
+#   Secondary parsing method for 10-Q and 10-K filings.
 #
 #       Rather than trying to find each "Item" string in the document (some filings omit these strings, especially
 #       for Item 1), scan the Index or Table of Contents usually found at the beginning of the document. Use that
@@ -18,14 +18,20 @@ from html.parser import HTMLParser
 from io import StringIO
 import html
 import math
-import json
+import ixbrl
+import filing_catalog
+import cleaned_filing
+import instrumentation
 
 
-CLEAN_10K = False
+CLEAN_10K = True
 CLEAN_10Q = True
 OVERWRITE_EXISTING = True  # If True, overwrite existing cleaned files, else skip
 WRITE_OUTPUT_FILE = True    # Write the clean_ output file, else just print
 SECTION_MARKER = 'Â°'
+STRIP_INLINE_XBRL = True    # Drop hidden inline XBRL facts and unwrap ix tags, else only remove <ix:header>
+INSTRUMENT = False  # If True, log each filing's step timings and peak memory to data/instrumentation.jsonl
+MAX_10K_ITEM = 16       # Highest item number in a 10-K (Items 1-16, including 1A, 7A, 9A etc.)
 COMPANY_SCAN_LIST = ['']   # List of company name strings to limit parse, e.g., ['ABBOTT', 'AMERICAN FINANCIAL']
 COMPANY_SCAN_CONTINUE = True        # If True, continue scanning when done with first company in list
 
@@ -90,6 +96,7 @@ def delete_repeated_item(index_text, section_text):
     else:
         return index_text_match.end()
 
+@instrumentation.instrumented('clean', parser='toc')
 def clean_filing(input_filename, filing_type, output_filename):
     """
     Cleans a 10-K or 10-Q filing. All arguments take strings as input
@@ -100,23 +107,21 @@ def clean_filing(input_filename, filing_type, output_filename):
     # open file
     with open (input_filename, 'r', encoding='utf-8') as f:
         data = f.read()
+    instrumentation.lap('read')
 
     data = unicodedata.normalize("NFKD", data)
+    instrumentation.lap('normalize')
 
     # Extract EDGAR CIK and filename
-    CIK = re.search(r'(?:CENTRAL INDEX KEY:\s+)(\d+)', data, re.IGNORECASE)[1]
-    edgar_accession = re.search(r'(?:ACCESSION NUMBER:\s+)([\d-]+)', data, re.IGNORECASE)[1]
-    edgar_filename = re.search(r'(?:<FILENAME>)(.+)\n', data, re.IGNORECASE)[1]
+    header_data = filing_catalog.read_submission_header(data)
+    CIK = header_data["CIK"]
+    edgar_accession = header_data["edgar_accession"]
+    edgar_filename = header_data["edgar_filename"]
     EDGAR_PATH = f'https://www.sec.gov/Archives/edgar/data/{CIK}/{edgar_accession.replace("-", "")}/{edgar_filename}'
     print(f'Parsing {EDGAR_PATH}')
+    instrumentation.lap('header')
 
-    header_data = {
-        "CIK": CIK,
-        "edgar_accession": edgar_accession,
-        "edgar_filename": edgar_filename
-    }
-
-    if filing_type == '10-Q':
+    if filing_type == '10-Q' or filing_type == '10-K':
         # Step 1. Remove all the encoded sections
         data = re.sub(r'<DOCUMENT>\n<TYPE>GRAPHIC.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>ZIP.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
@@ -126,7 +131,12 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = re.sub(r'<PDF.*?</PDF>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>XML.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>EX.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
-        data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('binary_strip')
+        if STRIP_INLINE_XBRL:
+            data = ixbrl.strip_inline_xbrl(data)    # Drop hidden facts and unwrap ix tags before any other processing
+        else:
+            data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('inline_xbrl')
 
         data = html.unescape(data)    # This function doesn't convert all the characters as needed, like xa0 and apostrophes
         data = data.replace('\xa0', ' ')
@@ -134,14 +144,16 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = data.replace("’", "'")
         data = data.replace('“', '"')
         data = data.replace('”', '"')
+        instrumentation.lap('unescape')
 
         soup = BeautifulSoup(data, 'html.parser')
+        instrumentation.lap('beautifulsoup')
 
         index_table_hdr = soup.find(string=re.compile(r'(?i)^\s*Part\s+I'))
         if not index_table_hdr:
             error_text = f'{EDGAR_PATH}\nCould not find Index table header'
             print(error_text)
-            with open('error_not_cleaned_ITH_' + input_filename, 'w') as f:
+            with open(cleaned_filing.error_filename('error_not_cleaned_ITH_', input_filename), 'w') as f:
                 f.write(error_text)                
             return
         index_table = index_table_hdr.find_parent('table')
@@ -153,10 +165,12 @@ def clean_filing(input_filename, filing_type, output_filename):
             else:
                 error_text = f"{EDGAR_PATH}\ncould not find index_table parent tag."
                 print(error_text)
-                with open('error_not_cleaned_ITT_' + input_filename, 'w') as f:
+                with open(cleaned_filing.error_filename('error_not_cleaned_ITT_', input_filename), 'w') as f:
                     f.write(error_text)                
                 return
 
+        instrumentation.lap('index_table')
+
         # Found the index table. Create a dataframe to store locations of data items.
         contents_df = pd.DataFrame(columns = ['Item', 'Begin_tag', 'Begin_line', 'Begin_pos']) 
         contents_df['Begin_tag'] = contents_df['Begin_tag'].astype(str)
@@ -169,9 +183,13 @@ def clean_filing(input_filename, filing_type, output_filename):
                 in_part = 2
 
             # First get the item text, if any. Clean it up depending on what Part it's in.
+            # 10-K items are numbered uniquely across Parts, 10-Q Part II items are numbered 21, 22...
             item_text = row.find(string=re.compile(r'(?i)item\s+\d'))
+            if item_text and filing_type == '10-K':
+                if int(re.search(r'(?i)item\s+(\d+)', item_text)[1]) > MAX_10K_ITEM:
+                    continue
             if item_text:
-                if in_part == 1:
+                if in_part == 1 or filing_type == '10-K':
                     item_text = re.sub(r'item\s+(\d+)(a|b)?\.?', 'item \\1\\2.', item_text, flags=re.IGNORECASE)
                 else:
                     item_text = re.sub(r'item\s+(\d+)(a|b)?\.?', 'item 2\\1\\2.', item_text, flags=re.IGNORECASE)
@@ -224,9 +242,17 @@ def clean_filing(input_filename, filing_type, output_filename):
                 else:
                     continue    # No item and no previous row item
 
+        instrumentation.lap('anchors')
+
         # Clean up the contents dataframe. If we couldn't find a section, remove it.
         contents_df = contents_df.dropna()
         contents_df = contents_df.reset_index(drop=True)
+        if len(contents_df) == 0:
+            error_text = f"{EDGAR_PATH}\nNo usable anchors in index table."
+            print(error_text)
+            with open(cleaned_filing.error_filename('error_not_cleaned_NA_', input_filename), 'w') as f:
+                f.write(error_text)
+            return
 
         # Extract the identified section and write to output file
         try:
@@ -235,45 +261,55 @@ def clean_filing(input_filename, filing_type, output_filename):
             # ** Should never reach this code
             error_text = f"Couldn't find some tags for {EDGAR_PATH}.\n{contents_df}"
             print(error_text)
-            with open('error_not_cleaned_MT_' + input_filename, 'w') as f:
+            with open(cleaned_filing.error_filename('error_not_cleaned_MT_', input_filename), 'w') as f:
                 f.write(error_text)                
             return  # Probably means we couldn't find tags, abort this file
 
-        with open(output_filename, 'w', encoding='utf-8') as output:
-            output.write(json.dumps(header_data) + '\n')
-            for i in range(0, len(contents_df)):
-                # Use Beautiful Soup sourceline and sourcepos to determine where text is in the main buffer
-                sl = data.splitlines()
-                start = contents_df['Begin_line'][i]-1
-                stop = len(sl)-1 if i+1 == len(contents_df) else contents_df['Begin_line'][i+1]-1
-
-                # Must do the end slice first in case same line
-                sl[stop] = sl[stop] if i+1 == len(contents_df) else sl[stop][:contents_df['Begin_pos'][i+1]]
-                sl[start] = sl[start][contents_df['Begin_pos'][i]:]
-                aggregate_text = '\n'.join(sl[start: stop+1])
-
-                # Clean the text
-                aggregate_text = re.sub(r'<TABLE.*?</TABLE>', repl=tablerep, string=aggregate_text, flags=re.S | re.A | re.IGNORECASE)
-                aggregate_text = re.sub(r'<div.*?>', '\n', aggregate_text, flags=re.IGNORECASE)
-                aggregate_text = strip_tags(aggregate_text)
-                aggregate_text = re.sub(r'\s*\d*\s*Table of Contents', ' ', aggregate_text, flags=re.DOTALL| re.IGNORECASE | re.MULTILINE)
-                # Delete repetitive item text at beginning
-                aggregate_text = aggregate_text[delete_repeated_item(contents_df['Item'][i], aggregate_text):]
-                aggregate_text = re.sub(r'\n(item\s+\d+(?:a|b)?\..*)$', '', aggregate_text, flags=re.IGNORECASE)
-                aggregate_text = re.sub(r'^\s*PART II?.*?\n?$', ' ', aggregate_text, flags=re.DOTALL| re.IGNORECASE | re.MULTILINE)
-                aggregate_text = re.sub(r'\n\s*\d*\s*\n', '\n', aggregate_text)
-                if WRITE_OUTPUT_FILE:
-                    output.write(SECTION_MARKER + contents_df['Item'][i] + ' ' + aggregate_text)
-                else:
-                    print(f"*****\n{SECTION_MARKER}{contents_df['Item'][i]} {aggregate_text}\n*****")
+        sl = data.splitlines()
+        sections = []
+        instrumentation.lap('split_lines')
+        for i in range(0, len(contents_df)):
+            # Use Beautiful Soup sourceline and sourcepos to determine where text is in the main buffer
+            start = contents_df['Begin_line'][i]-1
+            stop = len(sl)-1 if i+1 == len(contents_df) else contents_df['Begin_line'][i+1]-1
+
+            # Must do the end slice first in case same line
+            stop_line = sl[stop] if i+1 == len(contents_df) else sl[stop][:contents_df['Begin_pos'][i+1]]
+            if start == stop:
+                aggregate_text = stop_line[contents_df['Begin_pos'][i]:]
+            else:
+                aggregate_text = '\n'.join([sl[start][contents_df['Begin_pos'][i]:]] + sl[start+1: stop] + [stop_line])
+            instrumentation.lap('slice_sections')
+
+            # Clean the text
+            aggregate_text = re.sub(r'<TABLE.*?</TABLE>', repl=tablerep, string=aggregate_text, flags=re.S | re.A | re.IGNORECASE)
+            instrumentation.lap('tablerep')
+            aggregate_text = re.sub(r'<div.*?>', '\n', aggregate_text, flags=re.IGNORECASE)
+            aggregate_text = strip_tags(aggregate_text)
+            instrumentation.lap('strip_tags')
+            aggregate_text = re.sub(r'\s*\d*\s*Table of Contents', ' ', aggregate_text, flags=re.DOTALL| re.IGNORECASE | re.MULTILINE)
+            # Delete repetitive item text at beginning
+            aggregate_text = aggregate_text[delete_repeated_item(contents_df['Item'][i], aggregate_text):]
+            aggregate_text = re.sub(r'\n(item\s+\d+(?:a|b)?\..*)$', '', aggregate_text, flags=re.IGNORECASE)
+            aggregate_text = re.sub(r'^\s*PART II?.*?\n?$', ' ', aggregate_text, flags=re.DOTALL| re.IGNORECASE | re.MULTILINE)
+            aggregate_text = re.sub(r'\n\s*\d*\s*\n', '\n', aggregate_text)
+            if WRITE_OUTPUT_FILE:
+                sections.append(SECTION_MARKER + contents_df['Item'][i] + ' ' + aggregate_text)
+            else:
+                print(f"*****\n{SECTION_MARKER}{contents_df['Item'][i]} {aggregate_text}\n*****")
+            instrumentation.lap('section_regex')
+        cleaned_filing.write_cleaned_filing(output_filename, header_data, ''.join(sections))
+        instrumentation.lap('write')
+        return True
 
 def clean_all_filings():
     """Clean all filings in sec-filings directory"""
     print("cleaning...")
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
 
     company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+    catalog = filing_catalog.FilingCatalog(project_dir)
 
     keep_going = False
     for company in company_list:
@@ -285,40 +321,40 @@ def clean_all_filings():
                 keep_going = True
 
         company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-        os.chdir(company_dir) # abs path to each company directory
-
         print('***Cleaning: {}***'.format(company))
-        for file in os.listdir():  # iterate through all files in the respective company directory
+        for file in os.listdir(company_dir):  # iterate through all files in the respective company directory
             
             # cleaning files
             if 'error' not in file or file.endswith('txt'): 
                 continue
 
-            file = re.sub(r'error_(not_)?(NFI_)?(NFII_)?(seq_)?cleaned_(MT_|ITH_|ITT_)?', '', file )
+            file = re.sub(r'error_(not_)?(NFI_)?(NFII_)?(seq_)?(timeout_)?cleaned_(MT_|ITH_|ITT_|NA_)?', '', file )
 
             if not OVERWRITE_EXISTING:
-                if os.path.exists('cleaned_' + str(file)):
+                if os.path.exists(os.path.join(company_dir, 'cleaned_' + str(file))):
                     continue
             
             if file.endswith('10-K'): filing_type = '10-K'
             else: filing_type = '10-Q'
             
             if (CLEAN_10K and file.endswith('10-K')) or (CLEAN_10Q and file.endswith('10-Q')):
-                clean_filing(input_filename=file, filing_type=filing_type, output_filename='cleaned_' + str(file))
+                if clean_filing(input_filename=os.path.join(company_dir, file), filing_type=filing_type,
+                                output_filename=os.path.join(company_dir, 'cleaned_' + str(file))):
+                    catalog.record_file(os.path.join(company_dir, 'cleaned_' + str(file)), company, filing_type)
                 print('{} filing cleaned'.format(file))
 
 def rename_10_Q_filings():
     """Rename 10Q filings to include the quarter of the filing in the filing name"""
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
     company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+    catalog = filing_catalog.FilingCatalog(project_dir)
     
     for company in company_list:
         company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-        os.chdir(company_dir)
         
         print('***{}***'.format(company))
-        for file in os.listdir():
+        for file in os.listdir(company_dir):
             if file.startswith('cleaned_filings') or file.startswith('cleaned_Q'): 
                 continue
                 
@@ -334,7 +370,8 @@ def rename_10_Q_filings():
                 else:
                     filing_quarter = 'Q3'
 
-                os.rename(file, ('cleaned_'+str(filing_quarter)+'_'+str(get_date)+'_'+'10-Q'))
+                os.rename(os.path.join(company_dir, file), os.path.join(company_dir, 'cleaned_'+str(filing_quarter)+'_'+str(get_date)+'_'+'10-Q'))
+                catalog.move(os.path.join(company_dir, file), os.path.join(company_dir, 'cleaned_'+str(filing_quarter)+'_'+str(get_date)+'_'+'10-Q'))
                 print('{} renamed'.format(file))
             
             else:
@@ -343,9 +380,10 @@ def rename_10_Q_filings():
 def move_10k_10q_to_folder():
     """Move filings to the appropriate folders in each company directory"""
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
     
     company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+    catalog = filing_catalog.FilingCatalog(project_dir)
 
     for company in company_list:    
         # make directory of cleaned files
@@ -353,10 +391,9 @@ def move_10k_10q_to_folder():
         if not os.path.exists(cleaned_files_dir): os.makedirs(cleaned_files_dir)
         
         company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-        os.chdir(company_dir) # abs path to each company directory    
         
         print('***{}***'.format(company))
-        for file in os.listdir():
+        for file in os.listdir(company_dir):
             if file.startswith('cleaned_filings'): continue  # cleaned_filings directory
             if file.startswith('clean') and ('10-Q' in file or '10-K' in file):
                 try:
@@ -366,8 +403,12 @@ def move_10k_10q_to_folder():
                     os.remove(os.path.join(cleaned_files_dir, file))
                     shutil.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
                     print('{} moved to cleaned files folder'.format(file))
+                catalog.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
 
 # Mainline code execution
-clean_all_filings()
-rename_10_Q_filings()
-move_10k_10q_to_folder()
\ No newline at end of file
+if __name__ == '__main__':
+    if INSTRUMENT:
+        instrumentation.enable(os.path.join(directory.find_project_dir(), 'data', instrumentation.LOG_FILE))
+    clean_all_filings()
+    rename_10_Q_filings()
+    move_10k_10q_to_folder()
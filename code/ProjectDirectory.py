@@ -2,13 +2,22 @@ import os
 from pathlib import Path
 
 
+PROJECT_DIRS = [
+    Path.cwd() / '/' / 'Users' / 'bill' / 'Documents' / 'Development' / 'sec-utils',
+    # Path(r'\\DESKTOP-UCOB5Q4\Users\bill\Documents\Development\sec-utils'),
+    Path.cwd() / '/' / 'Volumes' / 'GoogleDrive' / 'My Drive' / 'Jotham' / 'Personal Docs' / 'ML for finance' / 'SEC Sentiment Analysis - Github Upload' / 'sec-sentiment'
+]
+
+
+def find_project_dir():
+    """Return the first project directory that exists, without changing the working directory"""
+    for project_dir in PROJECT_DIRS:
+        if os.path.isdir(project_dir):
+            return project_dir
+    raise FileNotFoundError(f'No project directory found in {[str(d) for d in PROJECT_DIRS]}')
+
 
 def get_project_dir():
-    try:
-        project_dir = Path.cwd() / '/' / 'Users' / 'bill' / 'Documents' / 'Development' / 'sec-utils'
-        # project_dir = r'\\DESKTOP-UCOB5Q4\Users\bill\Documents\Development\sec-utils'
-        os.chdir(project_dir)
-    except BaseException as e:
-        project_dir = Path.cwd() / '/' / 'Volumes' / 'GoogleDrive' / 'My Drive' / 'Jotham' / 'Personal Docs' / 'ML for finance' / 'SEC Sentiment Analysis - Github Upload' / 'sec-sentiment'
-        os.chdir(project_dir)
+    project_dir = find_project_dir()
+    os.chdir(project_dir)
     return project_dir
@@ -6,17 +6,38 @@ import re
 import shutil
 import ProjectDirectory as directory
 import json
+import multiprocessing
+import functools
+import time
+import datetime
+import threading
+import scipy.sparse as sp
+import similarity_matrix
+import token_cache
+import token_diff
+import minhash_index
+import filing_catalog
+import cleaned_filing
+import instrumentation
+import results_store
 
 # preprocess filings
-import string
-from nltk import word_tokenize
-from nltk.stem import PorterStemmer
+import filing_tokenizer
 
 # to vectorize filing
 from sklearn.feature_extraction.text import CountVectorizer
 
 PROCESS_10K = False
 PROCESS_10Q = True
+SECTION_MARKER = 'Â°'
+SIMILARITY_WORKERS = os.cpu_count()     # Processes reading and tokenizing companies. 1 to run in this process
+SIMILARITY_MEASURES = ['cosine', 'jaccard', 'edit', 'simple']  # Lazy Prices measures, for documents and sections
+MINHASH_ON_MISS = True      # Add newly tokenized filings to the near-duplicate section index
+WRITE_RESULTS_CSV = True    # Also write the wide ten_k_results.csv / ten_q_results.csv, besides the results store
+SIMILARITY_BATCH_COMPANIES = 200    # Companies scored and committed to the results store at a time
+SIMILARITY_RESUME = True    # Skip pairs checkpointed by an earlier run. False to score everything again
+PROGRESS_SECONDS = 30       # Seconds between progress lines
+INSTRUMENT = False  # If True, log each pair's and batch's step timings and peak memory to data/instrumentation.jsonl
 
 items_10K = [
     'item 1',    #0
@@ -69,41 +90,31 @@ items_10Q = [
 
 # **Import stopwords from LoughranMcDonald Master Dictionary**
 
-def import_master_dict_stopwords(stopwords_file_path = os.path.join(directory.get_project_dir(), 'master-dict', 'StopWords_Generic.txt')):
-#     os.chdir(stopwords_file_dir)
-#     stopwords = pd.read_csv('StopWords_Generic.txt', header=None)
-    stopwords = pd.read_csv(stopwords_file_path, header=None)[0].tolist()
-    stopwords = frozenset([word.lower() for word in stopwords])
-    return stopwords
+def import_master_dict_stopwords(stopwords_file_path=None):
+    """Stopwords are read from disk once and cached"""
+    if stopwords_file_path is None:
+        stopwords_file_path = os.path.join(directory.find_project_dir(), 'master-dict', 'StopWords_Generic.txt')
+    return filing_tokenizer.load_stopwords(stopwords_file_path)
 
 
-def preprocess_filing(text, stopwords=True, stemming=False):
-    
-    # remove punctuations
-    punctuation_list = set(string.punctuation)
-    text = ''.join(word for word in text if word not in punctuation_list)
-    
-    # Remove n-digit numbers (perhaps do this during clean?)
-    text = re.sub(pattern=r'\b\d+\b', repl='', string=text)
-    
-    tokens = word_tokenize(text)
-    
-    if stopwords:
-        stopwords = import_master_dict_stopwords()
-        tokens = [word for word in tokens if word not in stopwords]
-        tokens = [word.lower() for word in tokens]
+# One tokenizer per (stopwords, stemming) setting, so stopwords and stems are shared across filings
+tokenizers = {}
+
+def get_tokenizer(stopwords=True, stemming=False):
+    if (stopwords, stemming) not in tokenizers:
+        tokenizers[(stopwords, stemming)] = filing_tokenizer.FilingTokenizer(
+            stopwords=import_master_dict_stopwords() if stopwords else None, stemming=stemming)
+    return tokenizers[(stopwords, stemming)]
 
-    if stemming:
-        stemmer = PorterStemmer()
-        tokens = [stemmer.stem(word) for word in tokens]
-                
-    return tokens
+
+def preprocess_filing(text, stopwords=True, stemming=False):
+    return get_tokenizer(stopwords, stemming)(text)
 
 
 def vectorize_and_preprocess_filings(filings_list):
     """vectorizes and preprocesses filings for each company"""
     
-    vectorizer = CountVectorizer(tokenizer=preprocess_filing)
+    vectorizer = CountVectorizer(tokenizer=get_tokenizer(), token_pattern=None)
     X = vectorizer.fit_transform(filings_list)
     return X
 
@@ -114,135 +125,393 @@ def calculate_cosine_similarity(a, b):
     return cos_sim
 
 
-project_dir = directory.get_project_dir()
-company_dir_list = os.listdir(os.chdir(os.path.join(project_dir, 'sec-filings-downloaded')))
-
-# initialize empty dataframes with appropriate cols
-df_ten_k_results = pd.DataFrame(columns=['company', 'comp_URL', 'cosine_similarity', 'latest_filing_dt', 'previous_filing_dt'] + items_10K)
-df_ten_q_results = pd.DataFrame(columns=['company', 'comp_URL', 'cosine_similarity', 'latest_filing_dt', 'latest_filing_quarter', 
-                                        'previous_filing_dt', 'previous_filing_quarter'] + items_10Q)
-
-companies_done = 0
-for company in company_dir_list:
-    # if 'INTERNATIONAL BUSINESS' not in company:
-    #     continue
-    company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-    os.chdir(os.path.join(company_dir, 'cleaned_filings'))
-    companies_done += 1
-    
-    ten_k_dict = {}
-    ten_q_dict = {}
-    
-    for file in os.listdir():
-        if file.endswith('10-K'): 
-            filing_year = int(file[8:12])
-            ten_k_dict[filing_year] = file
-            
-        if file.endswith('10-Q'):
-            filing_quarter = str(file[8:10])
-            filing_year = file[11:15]            
-            ten_q_dict[str(filing_quarter) + '_' + filing_year] = file
-
-    if PROCESS_10K:            
-        # Calculate cosine similarity for 10-K and append to df
-        try:
-            max_ten_k_year = max(ten_k_dict, key=ten_k_dict.get)
-            year_before_max_ten_k = max_ten_k_year - 1
-            print(f'{companies_done}: Calc 10-K sim {company}: {max_ten_k_year} vs {year_before_max_ten_k}')
-
-            with open(ten_k_dict[max_ten_k_year], 'r', encoding='utf-8') as file:
-                latest_ten_k_header_data = file.readline()
-                latest_ten_k_header = json.loads(latest_ten_k_header_data)
-                latest_ten_k = file.read()
-            with open(ten_k_dict[year_before_max_ten_k], 'r', encoding='utf-8') as file:
-                previous_ten_k_header_data = file.readline()
-                previous_ten_k_header = json.loads(previous_ten_k_header_data)
-                previous_ten_k = file.read()
-
-            # Calculate similarity for entire document
-            ten_k_vec = vectorize_and_preprocess_filings([latest_ten_k, previous_ten_k])
-            cosine_sim_ten_k = calculate_cosine_similarity(ten_k_vec.toarray()[0], ten_k_vec.toarray()[1])
-
-            ten_k_result_dict = {
-                'company': company,
-                'comp_URL': f'https://docoh.com/filing/{previous_ten_k_header["CIK"]}/{previous_ten_k_header["edgar_accession"]}/diff/{latest_ten_k_header["edgar_accession"]}',
-                # 'comp_URL': f'http://localhost:8000/abcomp/{previous_ten_k_header["CIK"]}/{previous_ten_k_header["edgar_accession"]}/{previous_ten_k_header["edgar_filename"]}/{latest_ten_k_header["edgar_accession"]}/{latest_ten_k_header["edgar_filename"]}',
-                'latest_filing_dt': ten_k_dict[max_ten_k_year][8:18],
-                'previous_filing_dt': ten_k_dict[year_before_max_ten_k][8:18],
-                'cosine_similarity': cosine_sim_ten_k
-            }
-
-            # Split each document into individual sections (items)
-            latest_ten_k_sections = dict((k.lower(), v) for k,v in dict(x.split(".",1) for x in filter(None, latest_ten_k.split('Â°'))).items())
-            previous_ten_k_sections = dict((k.lower(), v) for k,v in dict(x.split(".",1) for x in filter(None, previous_ten_k.split('Â°'))).items())
-
-            # Calculate similarity for each individual section
-            for latest_section, latest_text in latest_ten_k_sections.items():
-                if latest_section not in previous_ten_k_sections:
-                    continue
-                else:
-                    ten_k_vec = vectorize_and_preprocess_filings([latest_text, previous_ten_k_sections[latest_section]])
-                    cosine_sim_ten_k = calculate_cosine_similarity(ten_k_vec.toarray()[0], ten_k_vec.toarray()[1])
-                    ten_k_result_dict[latest_section] = cosine_sim_ten_k
-                    ten_k_result_dict[(latest_section+'_lwc')] = len(word_tokenize(latest_text))
-                    ten_k_result_dict[(latest_section+'_pwc')] = len(word_tokenize(previous_ten_k_sections[latest_section]))
-
-            df_ten_k_results = df_ten_k_results.append(ten_k_result_dict, ignore_index=True)
-        except BaseException as e:
-            print('Exception during 10-K calc for {}: {}'.format(company, e))
+def read_cleaned_filing(filename):
+    """Output: (header dict written by the cleaner, filing text)"""
+    with open(filename, 'r', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        text = file.read()
+    return header, text
+
+
+split_sections = cleaned_filing.split_sections
+
+
+def measure_column(column, measure):
+    """Result column of a measure: cosine keeps the original names, the others get a suffix"""
+    if measure == 'cosine':
+        return column
+    if column == 'cosine_similarity':
+        return f'{measure}_similarity'
+    return f'{column}_{measure}'
+
+
+def column_measure(column, measures=SIMILARITY_MEASURES):
+    """Inverse of measure_column, and of the _lwc / _pwc word count columns: result column -> (section, measure)"""
+    if column.endswith('_lwc'):
+        return column[:-4], 'latest_words'
+    if column.endswith('_pwc'):
+        return column[:-4], 'previous_words'
+    for measure in measures:
+        if column == measure_column('cosine_similarity', measure):
+            return results_store.DOCUMENT, measure
+    for measure in measures:
+        if measure != 'cosine' and column.endswith('_' + measure):
+            return column[:-len(measure) - 1], measure
+    return column, 'cosine'
+
+
+# Result dict fields that describe the pair rather than hold a similarity
+pair_fields = ['company', 'CIK', 'comp_URL', 'latest_filing_dt', 'previous_filing_dt', 'latest_filing_quarter', 'previous_filing_quarter',
+               'latest_accession', 'previous_accession', 'latest_fiscal_period', 'previous_fiscal_period']
+
+def result_rows(form, result_dict):
+    """Long rows of a scored result dict for results_store, one per section and measure with a value"""
+    pair = (str(result_dict['CIK']), result_dict['company'], form, result_dict['latest_accession'], result_dict['previous_accession'],
+            result_dict['latest_fiscal_period'], result_dict['previous_fiscal_period'],
+            result_dict['latest_filing_dt'], result_dict['previous_filing_dt'])
+    return [pair + column_measure(column) + (float(value),) for column, value in result_dict.items()
+            if column not in pair_fields and not pd.isna(value)]
+
+
+def result_column(section, measure):
+    """Inverse of column_measure"""
+    if measure == 'latest_words':
+        return section + '_lwc'
+    if measure == 'previous_words':
+        return section + '_pwc'
+    return measure_column('cosine_similarity' if section == results_store.DOCUMENT else section, measure)
+
+
+def comp_url(cik, previous_accession, latest_accession):
+    return f'https://docoh.com/filing/{cik}/{previous_accession}/diff/{latest_accession}'
+
+
+def pair_key(pair):
+    """Results store key of a catalog pair: (CIK, latest accession, previous accession)"""
+    return (str(pair['latest_cik']), pair['latest_accession'], pair['previous_accession'])
+
+
+def result_key(result_dict):
+    return (str(result_dict['CIK']), result_dict['latest_accession'], result_dict['previous_accession'])
+
+
+def pair_result_dict(pair):
+    """Result dict of a catalog pair, before any similarity is filled in"""
+    result_dict = {
+        'company': pair['latest_company'],
+        'CIK': pair['latest_cik'],
+        'latest_filing_dt': pair['latest_filing_date'],
+        'previous_filing_dt': pair['previous_filing_date'],
+        'latest_accession': pair['latest_accession'],
+        'previous_accession': pair['previous_accession'],
+        'latest_fiscal_period': pair['latest_fiscal_period'],
+        'previous_fiscal_period': pair['previous_fiscal_period'],
+        'cosine_similarity': np.nan
+    }
+    if pair['form'] == '10-Q':
+        result_dict['latest_filing_quarter'] = pair['latest_fiscal_period'][:2]
+        result_dict['previous_filing_quarter'] = pair['previous_fiscal_period'][:2]
+    return result_dict
+
+
+def queue_filing_pair(result_dict, latest, previous, latest_offset, previous_offset, measures=SIMILARITY_MEASURES):
+    """
+    Lists the document and section rows to compare for two cached filings whose counts start at the given row offsets.
+    Section word counts and the diff-based measures (edit, simple) are stored in result_dict right away, the measures
+    on count rows (cosine, jaccard) once the whole corpus is scored.
+    Output: list of (result column, latest row, previous row)
+    """
+    result_dict['comp_URL'] = comp_url(previous.header["CIK"], previous.header["edgar_accession"], latest.header["edgar_accession"])
+    # result_dict['comp_URL'] = f'http://localhost:8000/abcomp/{previous.header["CIK"]}/{previous.header["edgar_accession"]}/{previous.header["edgar_filename"]}/{latest.header["edgar_accession"]}/{latest.header["edgar_filename"]}'
+
+    # Similarity for entire document
+    rows = [('cosine_similarity', 0, 0)]
+
+    # Similarity for each section (item) found in both filings
+    for section in latest.sections:
+        if section not in previous.sections:
             continue
-
-    # calculate cosine similarity for 10-Q and append to df
-    if PROCESS_10Q:
+        latest_row = latest.section_row(section)
+        previous_row = previous.section_row(section)
+        rows.append((section, latest_row, previous_row))
+        result_dict[(section+'_lwc')] = int(latest.word_counts[latest_row])
+        result_dict[(section+'_pwc')] = int(previous.word_counts[previous_row])
+
+    pending = []
+    diff_measures = [measure for measure in measures if measure in ('edit', 'simple')]
+    for column, latest_row, previous_row in rows:
+        for measure in measures:
+            result_dict[measure_column(column, measure)] = np.nan
+        if diff_measures:
+            similarities = token_diff.diff_similarities(latest.row_tokens(latest_row), previous.row_tokens(previous_row))
+            for measure in diff_measures:
+                result_dict[measure_column(column, measure)] = similarities[measure]
+        pending.append((column, latest_offset + latest_row, previous_offset + previous_row))
+    return pending
+
+
+@instrumentation.instrumented('similarity', name=lambda cache, result_dict, latest_filename, previous_filename: latest_filename)
+def read_filing_pair(cache, result_dict, latest_filename, previous_filename):
+    """
+    Reads the token counts of a pair of filings and lists the document and section rows to compare.
+    Output: (counts matrix with the latest filing's rows then the previous filing's, list of (result column, latest row, previous row))
+    """
+    latest = cache.load(latest_filename)
+    instrumentation.lap('load_latest')
+    previous = cache.load(previous_filename)
+    instrumentation.lap('load_previous')
+    counts = sp.vstack([latest.counts, previous.counts], format='csr')
+    pending = queue_filing_pair(result_dict, latest, previous, 0, latest.counts.shape[0])
+    instrumentation.lap('queue_pairs')
+    return counts, pending
+
+
+# Token cache of each worker process, and of each thread of a streaming pipeline run, created on first use. The
+# MinHash index it feeds holds an SQLite connection, which only the thread that opened it may use
+local = threading.local()
+
+def get_token_cache(project_dir):
+    token_caches = local.__dict__.setdefault('token_caches', {})
+    if project_dir not in token_caches:
+        stopwords_file_path = os.path.join(project_dir, 'master-dict', 'StopWords_Generic.txt')
+        tokenizer = filing_tokenizer.FilingTokenizer(stopwords=import_master_dict_stopwords(stopwords_file_path))
+        on_miss = None
+        if MINHASH_ON_MISS:
+            index = minhash_index.MinHashIndex(os.path.join(project_dir, 'data', minhash_index.MINHASH_DB))
+            on_miss = functools.partial(index_new_filing, index)
+        token_caches[project_dir] = token_cache.TokenCache(os.path.join(project_dir, token_cache.TOKEN_CACHE_DIR), tokenizer, split_sections,
+                                                           on_miss=on_miss)
+    return token_caches[project_dir]
+
+
+def index_new_filing(index, filename, filing):
+    """Token cache hook: a filing seen for the first time goes into the MinHash index under its company folder's name"""
+    company = os.path.basename(os.path.dirname(os.path.dirname(filename)))
+    index.insert_filing(filing, company)
+
+
+def process_company(task, project_dir):
+    """
+    Worker: reads the token counts of the filing pairs selected for a company.
+    task: (company, list of pair dicts from filing_catalog.FilingCatalog.pairs, with their form)
+    Uses absolute paths only, the working directory is never changed.
+    Output: list of (form, result_dict, counts matrix, pending pairs) as plain picklable records
+    """
+    company, pairs = task
+    cache = get_token_cache(project_dir)
+
+    jobs = []
+    for pair in pairs:
+        form = pair['form']
         try:
-            max_ten_q_quarter_year = max(ten_q_dict, key=ten_q_dict.get)
-            year_before_max_ten_q = max_ten_q_quarter_year[0:3]+str(int(filing_year)-1)
-            print(f'{companies_done}: Calc 10-Q sim {company}: {max_ten_q_quarter_year} vs {year_before_max_ten_q}')
-
-            with open(ten_q_dict[max_ten_q_quarter_year], 'r', encoding='utf-8') as file:
-                latest_ten_q_header_data = file.readline()
-                latest_ten_q_header = json.loads(latest_ten_q_header_data)
-                latest_ten_q = file.read()
-            with open(ten_q_dict[year_before_max_ten_q], 'r', encoding='utf-8') as file:
-                previous_ten_q_header_data = file.readline()
-                previous_ten_q_header = json.loads(previous_ten_q_header_data)
-                previous_ten_q = file.read()
-
-            ten_q_vec = vectorize_and_preprocess_filings([latest_ten_q, previous_ten_q])
-            cosine_sim_ten_q = calculate_cosine_similarity(ten_q_vec.toarray()[0], ten_q_vec.toarray()[1])
-
-            ten_q_result_dict = {
-                'company': company,
-                'comp_URL': f'https://docoh.com/filing/{previous_ten_q_header["CIK"]}/{previous_ten_q_header["edgar_accession"]}/diff/{latest_ten_q_header["edgar_accession"]}',
-                # 'comp_URL': f'http://localhost:8000/abcomp/{previous_ten_q_header["CIK"]}/{previous_ten_q_header["edgar_accession"]}/{previous_ten_q_header["edgar_filename"]}/{latest_ten_q_header["edgar_accession"]}/{latest_ten_q_header["edgar_filename"]}',
-                'latest_filing_dt': ten_q_dict[max_ten_q_quarter_year][11:21],
-                'latest_filing_quarter': ten_q_dict[max_ten_q_quarter_year][8:10],
-                'previous_filing_dt': ten_q_dict[year_before_max_ten_q][11:21],
-                'previous_filing_quarter': ten_q_dict[year_before_max_ten_q][8:10],
-                'cosine_similarity': cosine_sim_ten_q
-            }
-
-            # Split each document into individual sections (items)
-            latest_ten_q_sections = dict((k.lower(), v) for k,v in dict(x.split(".",1) for x in filter(None, latest_ten_q.split('Â°'))).items())
-            previous_ten_q_sections = dict((k.lower(), v) for k,v in dict(x.split(".",1) for x in filter(None, previous_ten_q.split('Â°'))).items())
-
-            # Calculate similarity for each individual section
-            for latest_section, latest_text in latest_ten_q_sections.items():
-                if latest_section not in previous_ten_q_sections:
-                    continue
-                else:
-                    ten_q_vec = vectorize_and_preprocess_filings([latest_text, previous_ten_q_sections[latest_section]])
-                    cosine_sim_ten_q = calculate_cosine_similarity(ten_q_vec.toarray()[0], ten_q_vec.toarray()[1])
-                    ten_q_result_dict[latest_section] = cosine_sim_ten_q
-                    ten_q_result_dict[(latest_section+'_lwc')] = len(word_tokenize(latest_text))
-                    ten_q_result_dict[(latest_section+'_pwc')] = len(word_tokenize(previous_ten_q_sections[latest_section]))
-
-            df_ten_q_results = df_ten_q_results.append(ten_q_result_dict, ignore_index=True)
-        except BaseException as e:
-            print('Exception during 10-Q calc for {}: {}'.format(company, e))
-            continue
-if PROCESS_10K:
-    df_ten_k_results.to_csv('../../../data/ten_k_results.csv', encoding='utf-8', index=False)
-
-if PROCESS_10Q:
-    df_ten_q_results.to_csv('../../../data/ten_q_results.csv', encoding='utf-8', index=False)
+            print(f'Calc {form} sim {company}: {pair["latest_fiscal_period"]} vs {pair["previous_fiscal_period"]}')
+            result_dict = pair_result_dict(pair)
+            counts, pending = read_filing_pair(cache, result_dict, os.path.join(project_dir, pair['latest_path']),
+                                               os.path.join(project_dir, pair['previous_path']))
+            jobs.append((form, result_dict, counts, pending))
+        except Exception as e:
+            print('Exception during {} calc for {}: {}'.format(form, company, e))
+    return jobs
+
+
+def catalog_pair_tasks(catalog, forms, latest_only):
+    """Filing pairs from the catalog, grouped by company. Output: list of (company, list of pair dicts)"""
+    tasks = {}
+    for form in forms:
+        df_pairs = catalog.pairs(form, latest_only=latest_only)
+        df_pairs['form'] = form
+        for pair in df_pairs.to_dict('records'):
+            tasks.setdefault(pair['latest_company'], []).append(pair)
+    return sorted(tasks.items())
+
+
+def score_corpus(corpus, measures=SIMILARITY_MEASURES):
+    """Measures on count rows for every queued pair. Output: dict of measure -> array of similarities"""
+    scores = {}
+    if 'cosine' in measures:
+        scores['cosine'] = corpus.cosine()
+    if 'jaccard' in measures:
+        scores['jaccard'] = corpus.jaccard()
+    return scores
+
+
+def fill_similarities(records, pending_pairs, scores):
+    """Copy the scored similarities into the result dicts"""
+    for result_dict, pending in zip(records, pending_pairs):
+        for column, pair in pending:
+            for measure, similarities in scores.items():
+                result_dict[measure_column(column, measure)] = similarities[pair]
+
+
+def results_frame(records, columns):
+    """Build a results dataframe once. Columns outside the initial list (word counts, other sections) follow in order of appearance"""
+    df_results = pd.DataFrame(records)
+    extra_columns = [column for column in df_results.columns if column not in columns]
+    return df_results.reindex(columns=columns + extra_columns)
+
+
+def add_company_pairs(corpus, jobs):
+    """
+    Queue the pairs read by process_company in a corpus
+    Output: list of (form, result_dict, list of (result column, pair index in the corpus))
+    """
+    queued = []
+    for form, result_dict, counts, pending in jobs:
+        rows = corpus.add_matrix(counts)
+        queued.append((form, result_dict, [(column, corpus.add_pair(rows[latest_row], rows[previous_row]))
+                                           for column, latest_row, previous_row in pending]))
+    return queued
+
+
+class Progress:
+    """Prints companies done, rate and ETA every PROGRESS_SECONDS, and at the end"""
+    def __init__(self, total, label, interval=PROGRESS_SECONDS):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = time.time()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.time()
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            rate = self.done / max(now - self.start, 1e-6)
+            eta = datetime.timedelta(seconds=round((self.total - self.done) / rate))
+            print(f'{self.label}: {self.done} of {self.total} companies, {rate:.2f} companies/s, ETA {eta}')
+
+
+@instrumentation.instrumented('similarity_batch', name=lambda store, corpus, batch: f'{len(batch)} pairs')
+def store_batch(store, corpus, batch):
+    """Score a batch's queued pairs and commit them, with their checkpoints, to the results store. Output: pairs stored"""
+    if not batch:
+        return 0
+    scores = score_corpus(corpus)
+    instrumentation.lap('score')
+    fill_similarities([result_dict for _, result_dict, _ in batch], [pending for _, _, pending in batch], scores)
+    instrumentation.lap('fill')
+    store.upsert([row for form, result_dict, _ in batch for row in result_rows(form, result_dict)],
+                 [result_key(result_dict) for _, result_dict, _ in batch])
+    instrumentation.lap('store')
+    return len(batch)
+
+
+def run_similarity_batches(project_dir, tasks, read_company, add_company, label, workers=SIMILARITY_WORKERS,
+                           batch_companies=SIMILARITY_BATCH_COMPANIES, resume=SIMILARITY_RESUME):
+    """
+    Reads companies across a process pool and streams their scored pairs to the results store, batch_companies at
+    a time. A batch's rows and checkpoints are committed together, so a run that stops (crash, Ctrl-C) loses at most
+    the batch in progress, and the next run resumes after the pairs already checkpointed.
+    tasks: list of (company, list of catalog pair dicts with their form)
+    read_company: worker, task -> result
+    add_company: (corpus, result) -> list of (form, result_dict, pending pairs in the corpus), e.g. add_company_pairs
+    Output: number of pairs stored
+    """
+    store = results_store.ResultsStore(project_dir)
+    if resume:
+        done = store.completed_pairs()
+        tasks = [(company, [pair for pair in pairs if pair_key(pair) not in done]) for company, pairs in tasks]
+        tasks = [task for task in tasks if task[1]]
+        print(f'{label}: {len(done)} pairs checkpointed by earlier runs, {len(tasks)} companies left')
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(read_company, tasks, chunksize=4)
+    else:
+        pool = None
+        results = map(read_company, tasks)
+
+    attempted = sum(len(pairs) for _, pairs in tasks)
+    progress = Progress(len(tasks), label)
+    corpus = similarity_matrix.CorpusMatrix(None)
+    batch = []
+    stored = 0
+    try:
+        for result in results:
+            batch.extend(add_company(corpus, result))
+            progress.update()
+            if progress.done % batch_companies == 0:
+                stored += store_batch(store, corpus, batch)
+                corpus = similarity_matrix.CorpusMatrix(None)
+                batch = []
+        stored += store_batch(store, corpus, batch)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        store.close()
+    print(f'{label}: {stored} of {attempted} pairs stored, {attempted - stored} failed')
+    return stored
+
+
+def unstored_pairs(project_dir, forms, latest_only=True):
+    """Catalog pairs of the forms without a checkpoint in the results store, e.g. pairs whose filings could not be read"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    tasks = catalog_pair_tasks(catalog, forms, latest_only)
+    catalog.close()
+    store = results_store.ResultsStore(project_dir)
+    done = store.completed_pairs()
+    store.close()
+    return [pair for _, pairs in tasks for pair in pairs if pair_key(pair) not in done]
+
+
+def stored_results(project_dir, form, pairs, columns):
+    """Wide results dataframe of the given catalog pairs, from the results store. Pairs without stored results are left out"""
+    records = {pair_key(pair): pair_result_dict(pair) for pair in pairs}
+    store = results_store.ResultsStore(project_dir)
+    df_long = store.pair_rows(form, list(records))
+    store.close()
+    found = []
+    for cik, latest_accession, previous_accession, section, measure, value in df_long[
+            ['cik', 'latest_accession', 'previous_accession', 'section', 'measure', 'value']].itertuples(index=False):
+        result_dict = records[(cik, latest_accession, previous_accession)]
+        if 'comp_URL' not in result_dict:
+            result_dict['comp_URL'] = comp_url(cik, previous_accession, latest_accession)
+            found.append(result_dict)
+        result_dict[result_column(section, measure)] = int(value) if measure.endswith('_words') else value
+    return results_frame(found, columns)
+
+
+document_columns = [measure_column('cosine_similarity', measure) for measure in SIMILARITY_MEASURES]
+ten_k_columns = ['company', 'CIK', 'comp_URL'] + document_columns + ['latest_filing_dt', 'previous_filing_dt',
+                 'latest_accession', 'previous_accession', 'latest_fiscal_period', 'previous_fiscal_period'] + items_10K
+ten_q_columns = ['company', 'CIK', 'comp_URL'] + document_columns + ['latest_filing_dt', 'latest_filing_quarter',
+                 'previous_filing_dt', 'previous_filing_quarter', 'latest_accession', 'previous_accession',
+                 'latest_fiscal_period', 'previous_fiscal_period'] + items_10Q
+
+
+def calc_all_similarities(project_dir, workers=SIMILARITY_WORKERS, process_10k=PROCESS_10K, process_10q=PROCESS_10Q):
+    """
+    Compares the latest 10-K and 10-Q of every company in the filing catalog with the filing for the same period a
+    year before. Companies are fanned out across a process pool. Workers return plain records and count matrices,
+    which share one hashed feature space, so each batch's document and section pairs are scored in one sparse
+    operation per measure and committed to the results store. Pairs stored by an earlier run are not scored again.
+    Output: dict of form -> results dataframe, read back from the results store
+    """
+    forms = [form for form, wanted in [('10-K', process_10k), ('10-Q', process_10q)] if wanted]
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    tasks = catalog_pair_tasks(catalog, forms, latest_only=True)
+    catalog.close()
+
+    read_company = functools.partial(process_company, project_dir=project_dir)
+    run_similarity_batches(project_dir, tasks, read_company, add_company_pairs, 'Similarity', workers)
+
+    pairs = [pair for _, company_pairs in tasks for pair in company_pairs]
+    return {
+        '10-K': stored_results(project_dir, '10-K', [pair for pair in pairs if pair['form'] == '10-K'], ten_k_columns),
+        '10-Q': stored_results(project_dir, '10-Q', [pair for pair in pairs if pair['form'] == '10-Q'], ten_q_columns)
+    }
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    if INSTRUMENT:
+        instrumentation.enable(os.path.join(project_dir, 'data', instrumentation.LOG_FILE))
+    df_results = calc_all_similarities(project_dir)
+
+    if PROCESS_10K and WRITE_RESULTS_CSV:
+        df_results['10-K'].to_csv(os.path.join(project_dir, 'data', 'ten_k_results.csv'), encoding='utf-8', index=False)
+
+    if PROCESS_10Q and WRITE_RESULTS_CSV:
+        df_results['10-Q'].to_csv(os.path.join(project_dir, 'data', 'ten_q_results.csv'), encoding='utf-8', index=False)
@@ -10,7 +10,15 @@ import ProjectDirectory as directory
 from io import StringIO
 from html.parser import HTMLParser
 import html
-import json
+import ixbrl
+import filing_catalog
+import cleaned_filing
+import instrumentation
+import functools
+import multiprocessing
+import parser_router
+import item_scanner
+import Parse_10Q_by_index as toc_parser
 
 # Global variables. Make these settable from the command line.
 SECTION_MARKER = 'Â°'
@@ -22,6 +30,14 @@ OVERWRITE_EXISTING = False  # If True, overwrite existing cleaned files, else sk
 EDGAR_PATH = ''     # Will contain full path to the EDGAR website document being parsed
 COMPANY_SCAN_LIST = ['']  # List of company name strings to limit parse, e.g., ['ABBOTT', 'AMERICAN FINANCIAL']
 COMPANY_SCAN_CONTINUE = True    # If True, continue scanning when done with first company in list
+STRIP_INLINE_XBRL = True    # Drop hidden inline XBRL facts and unwrap ix tags, else only remove <ix:header>
+FILING_TIME_BUDGET = 300    # Seconds allowed to clean one filing before it is aborted as a timeout. 0 to disable
+ADAPTIVE_ROUTING = True     # If True, route each filing to the parser that historically works best for its CIK
+INSTRUMENT = False  # If True, log each filing's step timings and peak memory to data/instrumentation.jsonl
+PARSER_STRATEGIES = {       # Parsers available for each filing type, in default order
+    '10-K': ['toc', 'regex'],   # Filings with a hyperlinked TOC skip the item regex entirely
+    '10-Q': ['regex', 'toc']
+}
 
 # List of items_10K found in filings, in order of appearance.
 items_10K = [
@@ -162,6 +178,7 @@ def delete_out_of_seq(in_document, pos_dat, items_list, error_info):
     pos_dat.drop(drop_rows, inplace = True)
     return error_count
     
+@instrumentation.instrumented('clean', parser='regex')
 def clean_filing(input_filename, filing_type, output_filename):
     """
     Cleans a 10-K or 10-Q filing. All arguments take strings as input
@@ -172,18 +189,15 @@ def clean_filing(input_filename, filing_type, output_filename):
     # open file
     with open (input_filename, 'r', encoding='utf-8') as f:
         data = f.read()
+    instrumentation.lap('read')
 
     # Extract EDGAR CIK and filename
-    CIK = re.search(r'(?:CENTRAL INDEX KEY:\s+)(\d+)', data, re.IGNORECASE)[1]
-    edgar_accession = re.search(r'(?:ACCESSION NUMBER:\s+)([\d-]+)', data, re.IGNORECASE)[1]
-    edgar_filename = re.search(r'(?:<FILENAME>)(.+)\n', data, re.IGNORECASE)[1]
+    header_data = filing_catalog.read_submission_header(data)
+    CIK = header_data["CIK"]
+    edgar_accession = header_data["edgar_accession"]
+    edgar_filename = header_data["edgar_filename"]
     EDGAR_PATH = f'https://www.sec.gov/Archives/edgar/data/{CIK}/{edgar_accession.replace("-", "")}/{edgar_filename}'
-
-    header_data = {
-        "CIK": CIK,
-        "edgar_accession": edgar_accession,
-        "edgar_filename": edgar_filename
-    }
+    instrumentation.lap('header')
 
     if filing_type == '10-K':
         # Step 1. Remove all the encoded sections
@@ -194,11 +208,17 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = re.sub(r'<DOCUMENT>\n<TYPE>PDF.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>XML.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>EX.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
-        data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('binary_strip')
+        if STRIP_INLINE_XBRL:
+            data = ixbrl.strip_inline_xbrl(data)    # Drop hidden facts and unwrap ix tags before any other processing
+        else:
+            data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('inline_xbrl')
         #data = re.sub(r'<XBRL.*?</XBRL>', '', data, flags=re.S | re.A | re.IGNORECASE )
 
         # Delete certain HTML that may be embedded in words like ITEM
         data = re.sub(pattern="(?s)(?i)</?(FONT|SPAN|A|B|U|I).*?>", repl='', string=data)
+        instrumentation.lap('inline_tags')
         
         # Replace Unicode strings and special characters like nbsp
         # data = re.sub(pattern=r'(?s)(?i)(&#160;|&#32;|&nbsp;|&#xa0;)', repl=' ', string=data)
@@ -229,9 +249,11 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = data.replace("’", "'")
         data = data.replace('“', '"')
         data = data.replace('”', '"')
+        instrumentation.lap('unescape')
 
         # Intelligently remove tables. Some filers use tables as text alignment so keep the ones with < 10% numeric
         data = re.sub(r'<TABLE.*?</TABLE>', repl=tablerep, string=data, flags=re.S | re.A | re.IGNORECASE)
+        instrumentation.lap('tablerep')
 
         # Regex to find <DOCUMENT> tags
         doc_start_pattern = re.compile(r'<DOCUMENT>')
@@ -256,25 +278,24 @@ def clean_filing(input_filename, filing_type, output_filename):
             if doc_type == '10-K':
                 document[doc_type] = data[doc_start:doc_end]
                 break
+        instrumentation.lap('split_documents')
 
         # Validity check
         if '10-K' not in document:
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write('Could not find document[10-K]\n' + '\n' + doc_start_is + '\n' + doc_end_is + '\n' +doc_types)
                 return
 
-        # STEP 3 : Apply REGEXes to find all Item sections
-        document['10-K'] = re.sub(r'>\s*?(Part I+(?:\.|\||,|\s)*?)?(I?TEM)S?(?:<.*?>)?(\s)*(<.*?>)?(16|15|14|13|12|11|10|9|8|7|6|5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?(\.|\s|<|\:)', '>item \\5\\6.\\7', document['10-K'], 0, re.IGNORECASE)
-        regex = re.compile(r'>item\s(16|15|14|13|12|11|10|9|8|7|6|5|4|3|2|1|I)(A|B)?\.', re.IGNORECASE)
-        
-        # Use finditer to match the regex
-        matches = regex.finditer(document['10-K'])
+        # STEP 3 : Find all Item sections. The scanner only tries the item regex where the text contains "tem"
+        document['10-K'], matches = item_scanner.scan_item_headings(document['10-K'], item_scanner.HEADING_10K,
+            item_scanner.REPLACE_10K, item_scanner.ITEM_10K, literal='tem')
+        instrumentation.lap('item_regex')
 
         # Create the dataframe
-        test_df = pd.DataFrame([(x.group(), x.start(), x.end()) for x in matches])
+        test_df = pd.DataFrame(matches)
         
         if len(test_df.index) == 0:
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(EDGAR_PATH + '\nNo Item matches found in test_df')
                 return
 
@@ -298,7 +319,7 @@ def clean_filing(input_filename, filing_type, output_filename):
         if 'item1' not in pos_dat['item'].values:
             error_info = error_info + '1 '
             error_info = error_info + 'not found\n'
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write(pos_dat.to_string())
             return
@@ -339,7 +360,7 @@ def clean_filing(input_filename, filing_type, output_filename):
 
         # Write sequnce fixes to output file. We can make this optional at some point.    
         if error_count > MAX_SEQ_ERRORS:
-            with open('error_seq_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_seq_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write('\n' + '*' * 66 + '\n' + pos_dat.to_string())
 
@@ -373,15 +394,18 @@ def clean_filing(input_filename, filing_type, output_filename):
         # Set item as the dataframe index
         pos_dat.set_index('item', inplace=True)
 
+        instrumentation.lap('item_positions')
+
         # Use Beautiful Soup to extract text from the raw data 
         aggregate_text = ''
         for index, row in pos_dat.iterrows():
             aggregate_text = aggregate_text + SECTION_MARKER + extract_raw(document['10-K'], pos_dat, index)
+        instrumentation.lap('extract_raw')
 
-        with open(output_filename, 'w', encoding='utf-8') as output:
-            # Write the SEC file numbers for later lookup
-            output.write(json.dumps(header_data) + '\n')
-            output.write(aggregate_text)
+        # Write the SEC file numbers for later lookup, and where each section starts
+        cleaned_filing.write_cleaned_filing(output_filename, header_data, aggregate_text)
+        instrumentation.lap('write')
+        return True
     else:
         # Process 10Q
         # Step 1. Remove all the encoded sections
@@ -393,12 +417,18 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = re.sub(r'<DOCUMENT>\n<TYPE>XML.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>RENDERED XBRL.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
         data = re.sub(r'<DOCUMENT>\n<TYPE>EX.*?</DOCUMENT>', '', data, flags=re.S | re.A | re.I )
-        data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('binary_strip')
+        if STRIP_INLINE_XBRL:
+            data = ixbrl.strip_inline_xbrl(data)    # Drop hidden facts and unwrap ix tags before any other processing
+        else:
+            data = re.sub(r'<ix:header.*?</ix:header>', '', data, flags=re.S | re.A | re.I )
+        instrumentation.lap('inline_xbrl')
         data = re.sub(r'<PDF.*?</PDF>', '', data, flags=re.S | re.A | re.I )
         #data = re.sub(r'<XBRL.*?</XBRL>', '', data, flags=re.S | re.A | re.IGNORECASE )
 
         # Delete certain HTML that may be embedded in words like ITEM
         data = re.sub(pattern="(?s)(?i)</?(FONT|SPAN|A|B|U|I).*?>", repl='', string=data)
+        instrumentation.lap('inline_tags')
         
         data = html.unescape(data)    # This function doesn't convert all the characters as needed, like xa0 and apostrophes
         data = data.replace('\xa0', ' ')
@@ -406,55 +436,56 @@ def clean_filing(input_filename, filing_type, output_filename):
         data = data.replace("’", "'")
         data = data.replace('“', '"')
         data = data.replace('”', '"')
+        instrumentation.lap('unescape')
 
         # Intelligently remove tables. Some filers use tables as text alignment so keep the ones with < 10% numeric
         data = re.sub(r'<TABLE.*?</TABLE>', repl=tablerep, string=data, flags=re.S | re.A | re.IGNORECASE)
+        instrumentation.lap('tablerep')
 
         # Change multiple whitespace to single whitespace
         data = re.sub(r'\s+', repl=' ', string=data, flags=re.S | re.A)
+        instrumentation.lap('whitespace')
 
         # Extract text between PART I and PART II. Will probably get 2 matches
-        part_list = re.findall(r'>\s*?PART (?:I|1)[^I](?:.*?FINANCIAL (?:INFORMATION|STATEMENTS))?(.*?)>\s*?PART II.*?OTHER INFORMATION', string=data, flags=re.S | re.A | re.I)
+        part_i_list, part_ii_list = item_scanner.find_part_sections(data)
+        instrumentation.lap('find_parts')
+        part_list = part_i_list
         if len(part_list) == 0:
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(EDGAR_PATH + '\nCould not parse Part I')
                 return
         dataI = max(part_list, key=len_no_tags)
+        instrumentation.lap('longest_part')
 
-        documentI = re.sub(r'>\s*?(?:ITEM)(?:<.*?>)?(?:\s)*(?:<.*?>)?(5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?', '>item \\1\\2.', dataI, 0, re.IGNORECASE)
-        documentI = documentI.replace('>item I', '>item 1')
-        regex = re.compile(r'>item\s(5|4|3|2|1)(A|B)?\.', re.IGNORECASE)
-
-        # Use finditer to match the regex
-        matches = regex.finditer(documentI)
+        documentI, matches = item_scanner.scan_item_headings(dataI, item_scanner.HEADING_10QI, item_scanner.REPLACE_10QI,
+            item_scanner.ITEM_10QI, fixups=[('>item I', '>item 1')])
+        instrumentation.lap('item_regex')
 
         # Create the dataframe
-        dfI = pd.DataFrame([(x.group(), x.start(), x.end()) for x in matches])
+        dfI = pd.DataFrame(matches)
         if len(dfI.index) == 0 :
-            with open('error_NFI_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_NFI_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(EDGAR_PATH + '\ndfI: No Item matches found')
                 return
 
         # Extract text between PART II and end of document
-        part_list = re.findall(r'>\s*?PART II.*?OTHER INFORMATION(.*?)(?=>\s*?PART (?:I|1)|$)', string=data, flags=re.S | re.A | re.I)
+        part_list = part_ii_list
         if len(part_list) == 0:
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(EDGAR_PATH + '\nCould not parse Part II')
                 return
         dataII = max(part_list, key=len_no_tags)
+        instrumentation.lap('longest_part')
 
-        documentII = re.sub(r'>\s*?(?:ITEM)(?:<.*?>)?(?:\s)*(?:<.*?>)?(6|5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?', '>item 2\\1\\2.', dataII, 0, re.IGNORECASE)
-        documentII = documentII.replace('>item 2I', '>item 21')
-        regex = re.compile(r'>item\s(26|25|24|23|22|21)(A|B)?\.', re.IGNORECASE)
-
-        # Use finditer to match the regex
-        matches = regex.finditer(documentII)
+        documentII, matches = item_scanner.scan_item_headings(dataII, item_scanner.HEADING_10QII, item_scanner.REPLACE_10QII,
+            item_scanner.ITEM_10QII, fixups=[('>item 2I', '>item 21')])
+        instrumentation.lap('item_regex')
 
         # Create the dataframe
-        dfII = pd.DataFrame([(x.group(), x.start(), x.end()) for x in matches])
+        dfII = pd.DataFrame(matches)
         
         if len(dfII.index) == 0 :
-            with open('error_NFII_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_NFII_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(EDGAR_PATH + '\ndfII: No Item matches found')
                 return
 
@@ -476,7 +507,7 @@ def clean_filing(input_filename, filing_type, output_filename):
         if 'item1' not in pos_datI['item'].values:
             error_info = error_info + '1 '
             error_info = error_info + 'not found\n'
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write(pos_datI.to_string())
             return
@@ -484,7 +515,7 @@ def clean_filing(input_filename, filing_type, output_filename):
         if 'item26' not in pos_datII['item'].values:
             error_info = error_info + '21 '
             error_info = error_info + 'not found\n'
-            with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write(pos_datII.to_string())
             return
@@ -509,13 +540,13 @@ def clean_filing(input_filename, filing_type, output_filename):
         error_info = EDGAR_PATH + '\n' + pos_datI.to_string() + '\n' + '*' * 66 + '\n'
         if delete_out_of_seq(documentI, pos_datI, items_10QI, error_info) > MAX_SEQ_ERRORS:
         # Write sequence fixes to output file. We can make this optional at some point.    
-            with open('error_seq_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_seq_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write('\n' + '*' * 66 + '\n' + pos_datI.to_string())
 
         error_info = EDGAR_PATH + '\n' + pos_datII.to_string() + '\n' + '*' * 66 + '\n'
         if delete_out_of_seq(documentII, pos_datII, items_10QII, error_info) > MAX_SEQ_ERRORS:
-            with open('error_seq_' + output_filename, 'w', encoding='utf-8') as output:
+            with open(cleaned_filing.error_filename('error_seq_', output_filename), 'w', encoding='utf-8') as output:
                 output.write(error_info)
                 output.write('\n' + '*' * 66 + '\n' + pos_datII.to_string())
 
@@ -569,6 +600,8 @@ def clean_filing(input_filename, filing_type, output_filename):
         pos_datI.set_index('item', inplace=True)
         pos_datII.set_index('item', inplace=True)
 
+        instrumentation.lap('item_positions')
+
         # Use Beautiful Soup to extract text from the raw data 
         aggregate_text = ''
         for index, row in pos_datI.iterrows():
@@ -579,26 +612,119 @@ def clean_filing(input_filename, filing_type, output_filename):
                 aggregate_text = aggregate_text + SECTION_MARKER + extract_raw(documentII, pos_datII, index)
             except:
                 error_info = EDGAR_PATH + '\n'
-                with open('error_' + output_filename, 'w', encoding='utf-8') as output:
+                with open(cleaned_filing.error_filename('error_', output_filename), 'w', encoding='utf-8') as output:
                     output.write(EDGAR_PATH + '\nError in pos_datII:\n' + pos_datII.to_string())
                 return
+        instrumentation.lap('extract_raw')
+
+        # Write the SEC file numbers for later lookup, and where each section starts
+        cleaned_filing.write_cleaned_filing(output_filename, header_data, aggregate_text)
+        instrumentation.lap('write')
+        return True
+
+def run_parser(parser, sender, input_filename, filing_type, output_filename):
+    """Child process target for clean_filing_with_budget. Sends the parser result back through the pipe"""
+    try:
+        result = parser(input_filename=input_filename, filing_type=filing_type, output_filename=output_filename)
+    except Exception as e:
+        print(f'Exception cleaning {input_filename}: {e}')
+        result = False
+    sender.send(bool(result))
+
+def process_context():
+    """
+    Budgeted parsers run in processes started by a fork server (spawn where there is none) rather than forked, since
+    the streaming pipeline starts them from several threads, and a fork can copy into the child a lock that another
+    thread holds (stdout, SQLite, instrumentation), hanging it until the budget runs out
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['clean_and_filter_data', 'Parse_10Q_by_index'])
+    return context
 
-        with open(output_filename, 'w', encoding='utf-8') as output:
-            # Write the SEC file numbers for later lookup
-            output.write(json.dumps(header_data) + '\n')
-            output.write(aggregate_text)
+def clean_filing_with_budget(input_filename, filing_type, output_filename, parser=clean_filing, budget=FILING_TIME_BUDGET):
+    """
+    Runs a parser in a child process and aborts it if it takes more than budget seconds, so one pathological filing
+    cannot stall the whole batch. A timeout is logged to an error_timeout_ file.
+    Output: True if the parser succeeded
+    """
+    if not budget:
+        return parser(input_filename=input_filename, filing_type=filing_type, output_filename=output_filename)
+
+    context = process_context()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_parser, args=(parser, sender, input_filename, filing_type, output_filename))
+    process.start()
+    process.join(budget)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        if os.path.exists(cleaned_filing.partial_filename(output_filename)):
+            os.remove(cleaned_filing.partial_filename(output_filename))    # Interrupted write. A finished earlier clean is kept
+        error_text = f'{input_filename}\nTimed out after {budget} seconds in {parser.__module__}.{parser.__name__}'
+        print(error_text)
+        with open(cleaned_filing.error_filename('error_timeout_', output_filename), 'w', encoding='utf-8') as output:
+            output.write(error_text)
+        return False
+    return receiver.recv() if receiver.poll() else False
+
+def clean_filing_routed(router, input_filename, filing_type, output_filename):
+    """
+    Cleans a filing with the parser that has historically worked best for its CIK, falling back to the others.
+    router: parser_router.ParserRouter holding the per-CIK statistics
+    Output: name of the parser that succeeded, or None
+    """
+    parsers = {
+        'regex': clean_filing,
+        'toc': toc_parser.clean_filing
+    }
+    attempts = {name: functools.partial(clean_filing_with_budget, input_filename=input_filename, filing_type=filing_type,
+                                        output_filename=output_filename, parser=parsers[name])
+                for name in PARSER_STRATEGIES[filing_type]}
+
+    strategy = router.run(parser_router.read_cik(input_filename), attempts)
+    if strategy:
+        # Remove errors left by strategies that failed before this one. Sequence warnings are kept.
+        filing_dir, filing_name = os.path.split(input_filename)
+        for error_file in glob.glob(os.path.join(glob.escape(filing_dir), 'error_*' + glob.escape(filing_name))):
+            if not os.path.basename(error_file).startswith('error_seq_'):
+                os.remove(error_file)
+    return strategy
+
+def filing_form(file):
+    """Form of a raw or cleaned filing from its file name"""
+    return '10-K' if file.endswith('10-K') else '10-Q'
+
+def clean_company_filing(company_dir, file, router=None, catalog=None, company=None):
+    """
+    Clean one raw filing of a company directory into cleaned_<file> next to it
+    router: parser_router.ParserRouter to route the filing, None to use clean_filing alone
+    catalog: filing_catalog.FilingCatalog to record the cleaned file in
+    Output: True if the filing was cleaned
+    """
+    filing_type = filing_form(file)
+    input_filename = os.path.join(company_dir, file)
+    output_filename = os.path.join(company_dir, 'cleaned_' + str(file))
+    if router is not None:
+        cleaned = clean_filing_routed(router, input_filename=input_filename, filing_type=filing_type, output_filename=output_filename)
+        print('{} filing cleaned by {} parser'.format(file, cleaned))
+    else:
+        cleaned = clean_filing_with_budget(input_filename=input_filename, filing_type=filing_type, output_filename=output_filename)
+        print('{} filing cleaned'.format(file))
+    if cleaned and catalog is not None:
+        catalog.record_file(output_filename, company or os.path.basename(company_dir), filing_type)
+    return bool(cleaned)
 
- 
 def clean_all_filings():
     """Clean all filings in sec-filings directory"""
     print("cleaning...")
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
 
     if USE_EDGAR_FILENAME:      # Use sec-utils download directory structure /10-K/year/quarter
         rootDir = os.path.join(project_dir, 'sec-filings-downloaded')
         for dirName, subdirList, fileList in os.walk(rootDir):
-            os.chdir(dirName)
             print('Found directory: %s' % dirName)
             #if '2020' not in dirName:
             #    print('Skipped')
@@ -616,10 +742,13 @@ def clean_all_filings():
                     continue
 
                 print('***Cleaning: {}***'.format(fName))
-                clean_filing(input_filename=fName, filing_type=filing_type, output_filename='cleaned_' + str(fName))
+                clean_filing(input_filename=os.path.join(dirName, fName), filing_type=filing_type,
+                             output_filename=os.path.join(dirName, 'cleaned_' + str(fName)))
                 print('{} filing cleaned'.format(fName))
     else:
         company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+        router = parser_router.ParserRouter(os.path.join(project_dir, 'data', parser_router.ROUTER_STATS_FILE))
+        catalog = filing_catalog.FilingCatalog(project_dir)
 
         keep_going = False
         for company in company_list:
@@ -631,91 +760,102 @@ def clean_all_filings():
                     keep_going = True
 
             company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-            os.chdir(company_dir) # abs path to each company directory
 
             print('***Cleaning: {}***'.format(company))
-            for file in os.listdir():  # iterate through all files in the respective company directory
+            for file in os.listdir(company_dir):  # iterate through all files in the respective company directory
                 
                 # cleaning files
-                if 'cleaned' in file: 
+                if 'cleaned' in file or file.startswith('error_') or not os.path.isfile(os.path.join(company_dir, file)):
                     continue
 
                 if not OVERWRITE_EXISTING:
-                    if os.path.exists('cleaned_' + str(file)):
+                    if os.path.exists(os.path.join(company_dir, 'cleaned_' + str(file))):
                         continue
                 
-                if file.endswith('10-K'): filing_type = '10-K'
-                else: filing_type = '10-Q'
-                
                 if (CLEAN_10K and file.endswith('10-K')) or (CLEAN_10Q and file.endswith('10-Q')):
-                    clean_filing(input_filename=file, filing_type=filing_type, output_filename='cleaned_' + str(file))
-                    print('{} filing cleaned'.format(file))
+                    clean_company_filing(company_dir, file, router if ADAPTIVE_ROUTING else None, catalog, company)
+            if ADAPTIVE_ROUTING:
+                router.save()
+
+def quarter_filename(file):
+    """Name of a cleaned 10-Q with its filing quarter, e.g. cleaned_2019-05-01_10-Q -> cleaned_Q1_2019-05-01_10-Q. None if not a 10-Q to rename"""
+    if file.startswith('cleaned_filings') or file.startswith('cleaned_Q'):
+        return None
+    if not (file.startswith('cleaned') and file.endswith('10-Q')):
+        return None
+    get_date = file[8:18]
+    get_month = int(file[13:15])
+
+    if get_month >= 1 and get_month <= 5:
+        filing_quarter = 'Q1'
+    elif get_month >= 6 and get_month <= 8:
+        filing_quarter = 'Q2'
+    else:
+        filing_quarter = 'Q3'
+    return 'cleaned_'+str(filing_quarter)+'_'+str(get_date)+'_'+'10-Q'
+
+def rename_10_Q_filing(company_dir, file, catalog):
+    """Rename one cleaned 10-Q to include its quarter. Output: new file name, None if not renamed"""
+    new_file = quarter_filename(file)
+    if new_file is None:
+        return None
+    os.rename(os.path.join(company_dir, file), os.path.join(company_dir, new_file))
+    catalog.move(os.path.join(company_dir, file), os.path.join(company_dir, new_file))
+    return new_file
 
 def rename_10_Q_filings():
     """Rename 10Q filings to include the quarter of the filing in the filing name"""
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
     company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+    catalog = filing_catalog.FilingCatalog(project_dir)
     
     for company in company_list:
         company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-        os.chdir(company_dir)
         
         print('***{}***'.format(company))
-        for file in os.listdir():
-            if file.startswith('cleaned_filings') or file.startswith('cleaned_Q'): 
-                continue
-                
-            if file.startswith('cleaned') and file.endswith('10-Q'):
-                get_date = file[8:18]
-                get_year = file[8:12]
-                get_month = int(file[13:15])
-
-                if get_month >= 1 and get_month <= 5:
-                    filing_quarter = 'Q1'
-                elif get_month >= 6 and get_month <= 8:
-                    filing_quarter = 'Q2'
-                else:
-                    filing_quarter = 'Q3'
-
-                os.rename(file, ('cleaned_'+str(filing_quarter)+'_'+str(get_date)+'_'+'10-Q'))
+        for file in os.listdir(company_dir):
+            if rename_10_Q_filing(company_dir, file, catalog):
                 print('{} renamed'.format(file))
-            
             else:
                 print('{} not renamed'.format(file))
 
+def move_to_cleaned_folder(company_dir, file, catalog):
+    """Move one cleaned filing into the company's cleaned_filings folder. Output: True if moved"""
+    if file.startswith('cleaned_filings') or not (file.startswith('clean') and ('10-Q' in file or '10-K' in file)):
+        return False
+    cleaned_files_dir = os.path.join(company_dir, 'cleaned_filings')
+    os.makedirs(cleaned_files_dir, exist_ok=True)
+    if os.path.exists(os.path.join(cleaned_files_dir, file)):
+        os.remove(os.path.join(cleaned_files_dir, file))
+    shutil.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
+    catalog.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
+    return True
+
 def move_10k_10q_to_folder():
     """Move filings to the appropriate folders in each company directory"""
     
-    project_dir = directory.get_project_dir()
+    project_dir = directory.find_project_dir()
     
     company_list = os.listdir(os.path.join(project_dir, 'sec-filings-downloaded'))  
+    catalog = filing_catalog.FilingCatalog(project_dir)
 
     for company in company_list:    
-        # make directory of cleaned files
-        cleaned_files_dir = os.path.join(project_dir, 'sec-filings-downloaded', company, 'cleaned_filings')
-        if not os.path.exists(cleaned_files_dir): os.makedirs(cleaned_files_dir)
-        
         company_dir = os.path.join(project_dir, 'sec-filings-downloaded', company)
-        os.chdir(company_dir) # abs path to each company directory    
         
         print('***{}***'.format(company))
-        for file in os.listdir():
-            if file.startswith('cleaned_filings'): continue  # cleaned_filings directory
-            if file.startswith('clean') and ('10-Q' in file or '10-K' in file):
-                try:
-                    shutil.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
-                    print('{} moved to cleaned files folder'.format(file))
-                except Exception as e:
-                    os.remove(os.path.join(cleaned_files_dir, file))
-                    shutil.move(os.path.join(company_dir, file), os.path.join(cleaned_files_dir, file))
-                    print('{} moved to cleaned files folder'.format(file))
-
-clean_all_filings()
-
-#rename_10_Q_filings()
-
-#move_10k_10q_to_folder()
+        for file in os.listdir(company_dir):
+            if move_to_cleaned_folder(company_dir, file, catalog):
+                print('{} moved to cleaned files folder'.format(file))
+
+if __name__ == '__main__':
+    if INSTRUMENT:
+        instrumentation.enable(os.path.join(directory.find_project_dir(), 'data', instrumentation.LOG_FILE))
+    clean_all_filings()
+
+    #rename_10_Q_filings()
+
+    #move_10k_10q_to_folder()
 
 
 
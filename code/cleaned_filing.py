@@ -0,0 +1,99 @@
+#
+#   Reading and writing cleaned filing files.
+#
+#       A cleaned filing is a JSON header line followed by the sections, each introduced by SECTION_MARKER and its
+#       name up to the first '.'. The cleaners also store a byte-offset table of the sections in the header, relative
+#       to the first byte after the header line, so a reader can mmap the file and decode only the sections it wants
+#       instead of reading and splitting the whole filing. Files cleaned before the table existed are read in full
+#       and split, with the same result.
+
+import os
+import json
+import mmap
+
+SECTION_MARKER = 'Â°'
+SECTION_MARKER_BYTES = SECTION_MARKER.encode('utf-8')
+
+def normalize_newlines(text):
+    """Same newline handling as reading the file in text mode"""
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def split_sections(text):
+    """Split a cleaned filing into a dict of lower case section name -> section text"""
+    return dict((k.lower(), v) for k,v in dict(x.split(".",1) for x in filter(None, text.split(SECTION_MARKER))).items())
+
+def section_offsets(body):
+    """
+    Byte offsets of each section's text in the encoded body, as split_sections would return it: the name is the text
+    up to the first '.', and a later section with the same name replaces the earlier one
+    Output: dict of lower case section name -> [start, end]
+    """
+    data = body.encode('utf-8')
+    offsets = {}
+    position = 0
+    for chunk in data.split(SECTION_MARKER_BYTES):
+        dot = chunk.find(b'.')
+        if dot >= 0:
+            offsets[chunk[:dot].decode('utf-8').lower()] = [position + dot + 1, position + len(chunk)]
+        position += len(chunk) + len(SECTION_MARKER_BYTES)
+    return offsets
+
+def error_filename(prefix, filename):
+    """Error file next to a filing: ('error_seq_', '/company/cleaned_x') -> '/company/error_seq_cleaned_x'"""
+    return os.path.join(os.path.dirname(filename), prefix + os.path.basename(filename))
+
+def partial_filename(output_filename):
+    """Name a cleaned filing is written under until it is complete"""
+    return output_filename + '.part'
+
+def write_cleaned_filing(output_filename, header_data, body):
+    """
+    Write the header line, with the section offset table, and the body. Newlines are written as is so offsets hold.
+    The file is written under partial_filename and renamed when complete, so an interrupted write leaves any earlier
+    cleaned file in place
+    """
+    header_data = dict(header_data, sections=section_offsets(body))
+    with open(partial_filename(output_filename), 'w', encoding='utf-8', newline='') as output:
+        # Write the SEC file numbers for later lookup
+        output.write(json.dumps(header_data) + '\n')
+        output.write(body)
+    os.replace(partial_filename(output_filename), output_filename)
+
+def read_header(filename):
+    """Output: (header dict, byte position where the body starts)"""
+    with open(filename, 'rb') as file:
+        line = file.readline()
+    return json.loads(line.decode('utf-8')), len(line)
+
+def read_sections(filename, sections=None):
+    """
+    Text of the requested sections of a cleaned filing, reading only their bytes when the file has an offset table
+    sections: list of lower case section names, None for all
+    Output: dict of section name -> text, for the requested sections present in the filing
+    """
+    header, body_start = read_header(filename)
+    offsets = header.get('sections')
+    if not isinstance(offsets, dict):
+        # Older file without an offset table: read and split it all
+        with open(filename, 'r', encoding='utf-8') as file:
+            file.readline()
+            found = split_sections(file.read())
+        return {name: text for name, text in found.items() if sections is None or name in sections}
+
+    wanted = [name for name in (offsets if sections is None else sections) if name in offsets]
+    if not wanted or os.path.getsize(filename) <= body_start:
+        return {name: '' for name in wanted}
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return {name: normalize_newlines(data[body_start + offsets[name][0]:body_start + offsets[name][1]].decode('utf-8'))
+                for name in wanted}
+
+def read_section(filename, section):
+    """Text of one section, None if the filing does not have it"""
+    return read_sections(filename, [section]).get(section)
+
+def section_names(filename):
+    """Section names of a cleaned filing, from the offset table when there is one"""
+    header, _ = read_header(filename)
+    if isinstance(header.get('sections'), dict):
+        return list(header['sections'])
+    return list(read_sections(filename))
@@ -0,0 +1,90 @@
+#
+#   Compare the item regex parser (clean_and_filter_data) against the table of contents parser (Parse_10Q_by_index)
+#   on the same corpus of downloaded filings.
+#
+#       Each raw filing is copied into a scratch directory and cleaned by both parsers, so existing cleaned files and
+#       error files are left alone. Reports the success rate, per-filing latency and number of sections found.
+
+import os
+import time
+import shutil
+import tempfile
+import pandas as pd
+import ProjectDirectory as directory
+import clean_and_filter_data as regex_parser
+import Parse_10Q_by_index as toc_parser
+
+COMPARE_FILING_TYPE = '10-K'
+COMPANY_SCAN_LIST = ['']   # List of company name strings to limit the comparison, e.g., ['ABBOTT', 'AMERICAN FINANCIAL']
+
+def run_parser(parser, input_filename, filing_type):
+    """Run one parser on input_filename, writing next to it. Output: (success, seconds, number of sections written)"""
+    output_filename = os.path.join(os.path.dirname(input_filename), 'cleaned_' + os.path.basename(input_filename))
+    start = time.perf_counter()
+    try:
+        success = bool(parser(input_filename=input_filename, filing_type=filing_type, output_filename=output_filename))
+    except Exception as e:
+        print(f'Exception: {e}')
+        success = False
+    seconds = time.perf_counter() - start
+
+    sections = 0
+    if success and os.path.exists(output_filename):
+        with open(output_filename, 'r', encoding='utf-8') as f:
+            sections = f.read().count(regex_parser.SECTION_MARKER)
+    return success, seconds, sections
+
+def compare_parsers(filing_type=COMPARE_FILING_TYPE):
+    """Clean every raw filing of filing_type with both parsers. Output: dataframe with one row per filing and parser"""
+    project_dir = directory.find_project_dir()
+    downloaded_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    parsers = {
+        'regex': regex_parser.clean_filing,
+        'toc': toc_parser.clean_filing
+    }
+
+    results = []
+    for company in os.listdir(downloaded_dir):
+        if not any(x in company for x in COMPANY_SCAN_LIST):
+            continue
+        company_dir = os.path.join(downloaded_dir, company)
+        if not os.path.isdir(company_dir):
+            continue
+
+        for file in os.listdir(company_dir):
+            if 'cleaned' in file or not file.endswith(filing_type):
+                continue
+            for name, parser in parsers.items():
+                with tempfile.TemporaryDirectory() as scratch_dir:
+                    scratch_filename = shutil.copy(os.path.join(company_dir, file), scratch_dir)
+                    success, seconds, sections = run_parser(parser, scratch_filename, filing_type)
+                results.append({
+                    'company': company,
+                    'file': file,
+                    'parser': name,
+                    'success': success,
+                    'seconds': seconds,
+                    'sections': sections
+                })
+                print(f'{company} {file} {name}: {"ok" if success else "failed"} in {seconds:.2f}s, {sections} sections')
+
+    return pd.DataFrame(results, columns=['company', 'file', 'parser', 'success', 'seconds', 'sections'])
+
+def summarize_comparison(df_results):
+    """Success rate, latency and section counts for each parser, plus how often each one rescues the other"""
+    summary = df_results.groupby('parser').agg(
+        filings=('file', 'count'),
+        success_rate=('success', 'mean'),
+        median_seconds=('seconds', 'median'),
+        mean_seconds=('seconds', 'mean'),
+        mean_sections=('sections', 'mean')
+    )
+    outcome = df_results.pivot_table(index=['company', 'file'], columns='parser', values='success', aggfunc='first')
+    summary['only_success'] = [(outcome[name] & ~outcome.drop(columns=name).any(axis=1)).sum() for name in summary.index]
+    return summary
+
+if __name__ == '__main__':
+    df_results = compare_parsers()
+    print(summarize_comparison(df_results).to_string())
+    df_results.to_csv(os.path.join(directory.find_project_dir(), 'data', f'parser_comparison_{COMPARE_FILING_TYPE}.csv'),
+                      encoding='utf-8', index=False)
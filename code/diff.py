@@ -1,66 +1,101 @@
 #!/usr/bin/python3
 """HTML Diff: http://www.aaronsw.com/2002/diff
-Rough code, badly documented. Send me comments and patches."""
+Rough code, badly documented. Send me comments and patches.
+
+Tokens are interned as integers and diffed with token_diff (prefix/suffix trim, patience anchors, linear-space
+Myers), instead of difflib.SequenceMatcher over the raw token lists, so a pair of full 10-Ks takes seconds.
+Cleaned filings are diffed section by section, and the markup can be streamed to a file as it is produced."""
 
 __author__ = 'Aaron Swartz <me@aaronsw.com>'
 __copyright__ = '(C) 2003 Aaron Swartz. GNU GPL 2 or 3.'
-__version__ = '0.22'
+__version__ = '0.23'
 
-import difflib, string
+import re, html
 import sys
+import token_diff
+import cleaned_filing
+
+MAX_DIFF_TOKENS = 500000	# Larger sections (both sides together) are marked modified as a whole instead of diffed
+TOKEN = re.compile(r'<[^>]*>|<[^>]*$|[^<\s]*\s|[^<\s]+', re.ASCII)	# ASCII \s, as string.whitespace: \xa0 stays in its word
 
 def isTag(x): return x[0] == "<" and x[-1] == ">"
 
-def textDiff(a, b):
-	"""Takes in strings a and b and returns a human-readable HTML diff."""
+def intern(a, b):
+	"""Integer IDs of the tokens of a and b, equal tokens get equal IDs"""
+	ids = {}
+	return [ids.setdefault(t, len(ids)) for t in a], [ids.setdefault(t, len(ids)) for t in b]
 
-	out = []
+def iterDiff(a, b, escape=False, max_tokens=MAX_DIFF_TOKENS):
+	"""Takes in strings a and b and yields a human-readable HTML diff, a piece at a time.
+	escape: a and b are plain text (e.g. cleaned filings), escape them rather than keep their tags"""
+
+	if escape:
+		a, b = html.escape(a, quote=False), html.escape(b, quote=False)
 	a, b = html2list(a), html2list(b)
-	s = difflib.SequenceMatcher(None, a, b)
-	for e in s.get_opcodes():
+	if len(a) + len(b) > max_tokens:
+		opcodes = [("replace", 0, len(a), 0, len(b))] if a and b else [("delete" if a else "insert", 0, len(a), 0, len(b))]
+	else:
+		opcodes = token_diff.get_opcodes(*intern(a, b))
+	for e in opcodes:
 		if e[0] == "replace":
 			# @@ need to do something more complicated here
 			# call textDiff but not for html, but for some html... ugh
 			# gonna cop-out for now
-			out.append('<del class="diff modified">'+''.join(a[e[1]:e[2]]) + '</del><ins class="diff modified">'+''.join(b[e[3]:e[4]])+"</ins>")
+			yield '<del class="diff modified">'+''.join(a[e[1]:e[2]]) + '</del><ins class="diff modified">'+''.join(b[e[3]:e[4]])+"</ins>"
 		elif e[0] == "delete":
-			out.append('<del class="diff">'+ ''.join(a[e[1]:e[2]]) + "</del>")
+			yield '<del class="diff">'+ ''.join(a[e[1]:e[2]]) + "</del>"
 		elif e[0] == "insert":
-			out.append('<ins class="diff">'+''.join(b[e[3]:e[4]]) + "</ins>")
+			yield '<ins class="diff">'+''.join(b[e[3]:e[4]]) + "</ins>"
 		elif e[0] == "equal":
-			out.append(''.join(b[e[3]:e[4]]))
+			yield ''.join(b[e[3]:e[4]])
 		else: 
-			raise( f"Um, something's broken. I didn't expect a {e[0]}.")
-	return ''.join(out)
+			raise ValueError(f"Um, something's broken. I didn't expect a {e[0]}.")
+
+def textDiff(a, b, escape=False):
+	"""Takes in strings a and b and returns a human-readable HTML diff."""
+	return ''.join(iterDiff(a, b, escape))
 
 def html2list(x, b=0):
-	mode = 'char'
-	cur = ''
-	out = []
-	for c in x:
-		if mode == 'tag':
-			if c == '>': 
-				if b: cur += ']'
-				else: cur += c
-				out.append(cur); cur = ''; mode = 'char'
-			else: cur += c
-		elif mode == 'char':
-			if c == '<': 
-				out.append(cur)
-				if b: cur = '['
-				else: cur = c
-				mode = 'tag'
-			elif c in string.whitespace: out.append(cur+c); cur = ''
-			else: cur += c
-	out.append(cur)
-	return filter(lambda x: x is not '', out)
+	"""Tags, and words with the whitespace character that follows them. b: write tags as [tag] instead of <tag>"""
+	out = TOKEN.findall(x)
+	if b:
+		out = ['[' + t[1:-1] + ']' if isTag(t) else '[' + t[1:] if t[0] == '<' else t for t in out]
+	return out
+
+def iterSectionDiff(previous, latest, sections=None, max_tokens=MAX_DIFF_TOKENS):
+	"""Yields the HTML diff of two cleaned filings' sections, one section after the other.
+	previous, latest: dicts of section name -> text, as cleaned_filing.read_sections returns them
+	Sections only in one filing are shown whole as deleted or inserted. sections: names to diff, None for all"""
+
+	names = sections if sections is not None else list(latest) + [name for name in previous if name not in latest]
+	for name in names:
+		if name not in previous and name not in latest:
+			continue
+		yield f'<h2 class="section">{html.escape(name.strip().upper())}</h2>\n<div class="section">'
+		yield from iterDiff(previous.get(name, ''), latest.get(name, ''), escape=True, max_tokens=max_tokens)
+		yield '</div>\n'
+
+def filingDiff(previous_path, latest_path, out, sections=None):
+	"""Writes the section by section diff of two cleaned filing files to the file object out, as it is computed.
+	Only the wanted sections are read from files with a section offset table"""
+
+	previous = cleaned_filing.read_sections(previous_path, sections)
+	latest = cleaned_filing.read_sections(latest_path, sections)
+	for piece in iterSectionDiff(previous, latest, sections):
+		out.write(piece)
 
 if __name__ == '__main__':
     import sys
+    args = [arg for arg in sys.argv[1:] if arg != '-s']
     try:
-        a, b = sys.argv[1:3]
+        a, b = args[0:2]
     except ValueError:
         print("htmldiff: highlight the differences between two html files")
-        print(f'usage: {sys.argv[0]} a b')
+        print(f'usage: {sys.argv[0]} [-s] a b')
+        print('  -s: a and b are cleaned filings, diff them section by section')
         sys.exit(1)
-    print( textDiff(open(a).read(), open(b).read()) )
\ No newline at end of file
+    if '-s' in sys.argv[1:]:
+        filingDiff(a, b, sys.stdout)
+    else:
+        for piece in iterDiff(open(a).read(), open(b).read()):
+            sys.stdout.write(piece)
@@ -0,0 +1,120 @@
+#
+#   Local HTML diff reports of flagged filing pairs.
+#
+#       Every pair in the results store whose similarity is below DIFF_THRESHOLD gets a section by section HTML diff
+#       of its two cleaned filings, rendered across a process pool with diff.filingDiff, instead of a link to a third
+#       party viewer. Reports are named by CIK and accession pair and never rendered twice: a pair whose file exists
+#       is skipped. index.html lists every report, least similar first.
+
+import os
+import html
+import functools
+import multiprocessing
+import ProjectDirectory as directory
+import diff
+import filing_catalog
+import results_store
+import calc_doc_similarity as similarity
+
+DIFF_REPORT_DIR = 'diff-reports'    # Under project_dir
+DIFF_MEASURE = 'cosine'
+DIFF_THRESHOLD = 0.9        # Pairs whose whole-document similarity is below this get a report
+DIFF_WORKERS = similarity.SIMILARITY_WORKERS
+
+STYLE = '''<style>
+body { font-family: sans-serif; max-width: 60em; margin: auto; }
+del { background: #fdd; color: #900; }
+ins { background: #dfd; color: #060; text-decoration: none; }
+div.section { white-space: pre-wrap; }
+table { border-collapse: collapse; } td, th { padding: 2px 8px; text-align: left; }
+</style>'''
+
+def report_name(cik, latest_accession, previous_accession):
+    return f'{cik}_{previous_accession}_{latest_accession}.html'
+
+def flagged_pairs(project_dir, measure=DIFF_MEASURE, threshold=DIFF_THRESHOLD):
+    """
+    Pairs in the results store below the threshold, with their cleaned filing paths from the catalog
+    Output: list of dicts, least similar first
+    """
+    store = results_store.ResultsStore(project_dir)
+    df_pairs = store.query(section=results_store.DOCUMENT, measure=measure)
+    store.close()
+    df_pairs = df_pairs[df_pairs['value'] < threshold].sort_values('value')
+
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    paths = dict(catalog.filings()[['accession', 'path']].itertuples(index=False))
+    catalog.close()
+    pairs = []
+    for pair in df_pairs.to_dict('records'):
+        if pair['latest_accession'] in paths and pair['previous_accession'] in paths:
+            pair['latest_path'] = os.path.join(project_dir, paths[pair['latest_accession']])
+            pair['previous_path'] = os.path.join(project_dir, paths[pair['previous_accession']])
+            pair['report'] = report_name(pair['cik'], pair['latest_accession'], pair['previous_accession'])
+            pairs.append(pair)
+    return pairs
+
+def section_table(project_dir, pair):
+    """Stored similarities of each section of the pair, as an HTML table"""
+    store = results_store.ResultsStore(project_dir)
+    df_long = store.pair_rows(pair['form'], [(pair['cik'], pair['latest_accession'], pair['previous_accession'])])
+    store.close()
+    df_table = df_long.pivot_table(index='section', columns='measure', values='value', aggfunc='first')
+    return df_table.to_html(float_format=lambda value: f'{value:.0f}' if value == int(value) else f'{value:.3f}', na_rep='')
+
+def render_report(pair, project_dir, report_dir):
+    """Worker: write the diff report of one pair, unless it exists. Output: (report name, True if rendered now)"""
+    path = os.path.join(report_dir, pair['report'])
+    if os.path.exists(path):
+        return pair['report'], False
+    title = f'{pair["company"]} {pair["form"]} {pair["period"]} vs {pair["previous_period"]}'
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as out:
+            out.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>{STYLE}</head><body>\n')
+            out.write(f'<h1>{html.escape(title)}</h1>\n<p>Filed {pair["previous_filing_dt"]} ({pair["previous_accession"]}) '
+                      f'and {pair["latest_filing_dt"]} ({pair["latest_accession"]})</p>\n')
+            out.write(section_table(project_dir, pair))
+            diff.filingDiff(pair['previous_path'], pair['latest_path'], out)
+            out.write('</body></html>\n')
+        os.replace(temp_path, path)
+    except Exception as e:
+        print('Exception rendering {} {}: {}'.format(pair['company'], pair['report'], e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return pair['report'], False
+    return pair['report'], True
+
+def write_index(report_dir, pairs, measure=DIFF_MEASURE):
+    rows = []
+    for pair in pairs:
+        if os.path.exists(os.path.join(report_dir, pair['report'])):
+            rows.append(f'<tr><td>{html.escape(pair["company"])}</td><td>{pair["form"]}</td><td>{pair["period"]}</td>'
+                        f'<td>{pair["previous_period"]}</td><td>{pair["value"]:.3f}</td>'
+                        f'<td><a href="{html.escape(pair["report"])}">diff</a></td></tr>')
+    with open(os.path.join(report_dir, 'index.html'), 'w', encoding='utf-8') as out:
+        out.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Filing diffs</title>{STYLE}</head><body>\n'
+                  f'<h1>Filing pairs by {measure} similarity</h1>\n<table><tr><th>Company</th><th>Form</th><th>Period</th>'
+                  f'<th>Compared with</th><th>{measure}</th><th></th></tr>\n' + '\n'.join(rows) + '\n</table></body></html>\n')
+
+def render_reports(project_dir, measure=DIFF_MEASURE, threshold=DIFF_THRESHOLD, workers=DIFF_WORKERS):
+    """Render the missing reports of the flagged pairs and rewrite the index. Output: number of reports rendered"""
+    report_dir = os.path.join(project_dir, DIFF_REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    pairs = flagged_pairs(project_dir, measure, threshold)
+    missing = [pair for pair in pairs if not os.path.exists(os.path.join(report_dir, pair['report']))]
+    print(f'{len(pairs)} pairs below {measure} {threshold}, {len(missing)} reports to render')
+
+    render = functools.partial(render_report, project_dir=project_dir, report_dir=report_dir)
+    if workers > 1 and len(missing) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            rendered = sum(new for _, new in pool.imap_unordered(render, missing))
+    else:
+        rendered = sum(new for _, new in map(render, missing))
+    write_index(report_dir, pairs, measure)
+    return rendered
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    print(f'{render_reports(project_dir)} diff reports rendered in {os.path.join(project_dir, DIFF_REPORT_DIR)}')
@@ -0,0 +1,185 @@
+#
+#   Metadata catalog of cleaned filings.
+#
+#       One SQLite table with the CIK, company, form, fiscal period, filing date, accession, path and section list of
+#       every cleaned filing. The cleaners record each file as they write it, and the rename and move steps keep the
+#       path current, so the similarity jobs select filings and pairs with indexed queries instead of listing every
+#       cleaned_filings directory of the (often network-mounted) project tree and slicing dates out of file names.
+#
+#       Paths are stored relative to the project directory, so the catalog works from any of the project roots.
+
+import os
+import re
+import json
+import sqlite3
+import datetime
+import pandas as pd
+
+CATALOG_DB = 'filing_catalog.sqlite'    # Under project_dir/data
+SECTION_MARKER = 'Â°'
+PAIR_WINDOW_DAYS = 45       # A prior-year filing matches if its period ends within this many days of a year earlier
+
+SECTION_NAME = re.compile(re.escape(SECTION_MARKER) + r'([^.' + re.escape(SECTION_MARKER) + r']*)\.')
+
+def edgar_date(value):
+    """20200331 -> 2020-03-31, None if missing"""
+    return f'{value[0:4]}-{value[4:6]}-{value[6:8]}' if value else None
+
+def read_submission_header(data):
+    """
+    Header fields of an EDGAR full submission text file, as written on the first line of each cleaned filing.
+    CIK, accession and filename are required, the period of report and filing date are None if missing
+    """
+    optional = lambda pattern: (re.search(pattern, data, re.IGNORECASE) or [None, None])[1]
+    return {
+        "CIK": re.search(r'(?:CENTRAL INDEX KEY:\s+)(\d+)', data, re.IGNORECASE)[1],
+        "edgar_accession": re.search(r'(?:ACCESSION NUMBER:\s+)([\d-]+)', data, re.IGNORECASE)[1],
+        "edgar_filename": re.search(r'(?:<FILENAME>)(.+)\n', data, re.IGNORECASE)[1],
+        "period_of_report": edgar_date(optional(r'(?:CONFORMED PERIOD OF REPORT:\s+)(\d{8})')),
+        "filing_date": edgar_date(optional(r'(?:FILED AS OF DATE:\s+)(\d{8})'))
+    }
+
+def fiscal_period(form, period):
+    """FY2020 for a 10-K, Q1_2020 (calendar quarter in which the period ends) for a 10-Q"""
+    date = datetime.date.fromisoformat(period)
+    return f'FY{date.year}' if form == '10-K' else f'Q{(date.month - 1) // 3 + 1}_{date.year}'
+
+def date_from_filename(file):
+    """Filing date in a cleaned file name: cleaned_2020-05-01_10-Q or cleaned_Q1_2020-05-01_10-Q"""
+    match = re.search(r'(\d{4}-\d{2}-\d{2})_10-[KQ]$', file)
+    return match[1] if match else None
+
+def read_cleaned_header(path):
+    """Header dict and section names of a cleaned filing, from the header's offset table when it has one"""
+    with open(path, 'r', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if isinstance(header.get('sections'), dict):
+            return header, [name.strip() for name in header['sections']]
+        sections = [name.strip().lower() for name in SECTION_NAME.findall(file.read())]
+    return header, sections
+
+class FilingCatalog:
+    """
+    project_dir: project root, paths in the catalog are relative to it
+    db_path: SQLite file, project_dir/data/filing_catalog.sqlite by default
+    """
+    def __init__(self, project_dir, db_path=None):
+        self.project_dir = str(project_dir)
+        self.conn = sqlite3.connect(db_path or os.path.join(self.project_dir, 'data', CATALOG_DB), timeout=120)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS filings (
+                accession TEXT PRIMARY KEY,
+                cik TEXT, company TEXT, form TEXT,
+                period TEXT,            -- period of report, or the filing date less PAIR_WINDOW_DAYS for older files
+                fiscal_period TEXT, filing_date TEXT, path TEXT, sections TEXT);
+            CREATE INDEX IF NOT EXISTS filings_by_cik ON filings (cik, form, period);
+            CREATE INDEX IF NOT EXISTS filings_by_company ON filings (company, form, period);
+            CREATE INDEX IF NOT EXISTS filings_by_period ON filings (form, fiscal_period);
+            CREATE UNIQUE INDEX IF NOT EXISTS filings_by_path ON filings (path);
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.project_dir)
+
+    def absolute(self, path):
+        return os.path.join(self.project_dir, path)
+
+    def record_file(self, path, company=None, form=None):
+        """
+        Catalog a cleaned filing from its header line and section markers. Called by the cleaners once the output is written
+        company: defaults to the company directory the file is in
+        """
+        header, sections = read_cleaned_header(path)
+        path = self.relative(path)
+        parts = path.split(os.sep)
+        if company is None:
+            company = parts[-3] if len(parts) >= 3 and parts[-2] == 'cleaned_filings' else parts[-2]
+        form = form or ('10-K' if path.endswith('10-K') else '10-Q')
+        filing_date = header.get('filing_date') or date_from_filename(parts[-1])
+        period = header.get('period_of_report')
+        if not period and filing_date:
+            period = (datetime.date.fromisoformat(filing_date) - datetime.timedelta(days=PAIR_WINDOW_DAYS)).isoformat()
+        with self.conn:
+            self.conn.execute('DELETE FROM filings WHERE path = ? AND accession != ?', (path, header['edgar_accession']))
+            self.conn.execute('INSERT OR REPLACE INTO filings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (header['edgar_accession'], str(header['CIK']), company, form, period,
+                               fiscal_period(form, period) if period else None, filing_date, path, json.dumps(sections)))
+
+    def move(self, old_path, new_path):
+        """Keep the catalog in step when a cleaned file is renamed or moved"""
+        with self.conn:
+            self.conn.execute('DELETE FROM filings WHERE path = ?', (self.relative(new_path),))
+            self.conn.execute('UPDATE filings SET path = ? WHERE path = ?', (self.relative(new_path), self.relative(old_path)))
+
+    def sync(self):
+        """
+        Catalog cleaned filings written before the catalog existed and drop entries whose file is gone.
+        Only needed once, or after files are changed by hand. Output: (number added, number removed)
+        """
+        known = set(row[0] for row in self.conn.execute('SELECT path FROM filings'))
+        found = set()
+        downloaded_dir = os.path.join(self.project_dir, 'sec-filings-downloaded')
+        for company in sorted(os.listdir(downloaded_dir)):
+            company_dir = os.path.join(downloaded_dir, company)
+            for directory in [company_dir, os.path.join(company_dir, 'cleaned_filings')]:
+                if not os.path.isdir(directory):
+                    continue
+                for file in os.listdir(directory):
+                    if not file.startswith('cleaned_') or not (file.endswith('10-K') or file.endswith('10-Q')):
+                        continue
+                    path = os.path.join(directory, file)
+                    found.add(self.relative(path))
+                    if self.relative(path) not in known:
+                        try:
+                            self.record_file(path, company)
+                        except Exception as e:
+                            print('Exception cataloging {}: {}'.format(path, e))
+        removed = known - found
+        with self.conn:
+            self.conn.executemany('DELETE FROM filings WHERE path = ?', [(path,) for path in removed])
+        return len(found - known), len(removed)
+
+    def companies(self):
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT company FROM filings ORDER BY company')]
+
+    def filings(self, form=None, company=None):
+        """Output: dataframe of catalogued filings, sections as lists, oldest period first"""
+        query = 'SELECT * FROM filings WHERE (? IS NULL OR form = ?) AND (? IS NULL OR company = ?) ORDER BY company, form, period'
+        df_filings = pd.read_sql_query(query, self.conn, params=(form, form, company, company))
+        df_filings['sections'] = df_filings['sections'].map(json.loads)
+        return df_filings
+
+    def pairs(self, form, company=None, latest_only=False):
+        """
+        Each filing of the form with the same filer's filing for the same period a year earlier: the one whose period
+        ends closest to a year before, within PAIR_WINDOW_DAYS
+        latest_only: only the pair of each company's most recent filing
+        Output: dataframe with latest_* and previous_* columns, one row per pair
+        """
+        columns = ['accession', 'cik', 'company', 'period', 'fiscal_period', 'filing_date', 'path']
+        selected = ', '.join([f'l.{c} AS latest_{c}' for c in columns] + [f'p.{c} AS previous_{c}' for c in columns])
+        latest = '''AND l.period = (SELECT MAX(period) FROM filings m WHERE m.company = l.company AND m.form = l.form)''' if latest_only else ''
+        query = f'''
+            SELECT * FROM (
+                SELECT {selected}, ROW_NUMBER() OVER (
+                    PARTITION BY l.accession
+                    ORDER BY ABS(julianday(p.period) - julianday(date(l.period, '-1 year')))) AS match
+                FROM filings l JOIN filings p
+                    ON p.cik = l.cik AND p.form = l.form
+                    AND p.period BETWEEN date(l.period, '-1 year', '-{PAIR_WINDOW_DAYS} days') AND date(l.period, '-1 year', '+{PAIR_WINDOW_DAYS} days')
+                WHERE l.form = ? AND (? IS NULL OR l.company = ?) {latest})
+            WHERE match = 1 ORDER BY latest_company, latest_period'''
+        return pd.read_sql_query(query, self.conn, params=(form, company, company)).drop(columns='match')
+
+
+if __name__ == '__main__':
+    import ProjectDirectory as directory
+
+    catalog = FilingCatalog(directory.find_project_dir())
+    added, removed = catalog.sync()
+    print(f'{added} cleaned filings added to the catalog, {removed} removed')
+    catalog.close()
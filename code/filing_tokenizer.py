@@ -0,0 +1,104 @@
+#
+#   Tokenization engine for calc_doc_similarity.
+#
+#       preprocess_filing used to reload the stopword list from disk on every call, strip punctuation one character at
+#       a time, run NLTK word_tokenize (Punkt plus Treebank) and build a new PorterStemmer for every filing. Here the
+#       stopwords are loaded once, punctuation and numbers are removed with str.translate and a single regex, tokens
+#       are split with a regex, and stems are memoized on unique tokens across all filings.
+
+import re
+import time
+import string
+import functools
+import hashlib
+from collections import Counter
+import numpy as np
+import pandas as pd
+from nltk import word_tokenize
+from nltk.stem import PorterStemmer
+
+TOKENIZER_MODE = 'regex'    # 'regex' for the fast tokenizer, 'nltk' for word_tokenize
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+NUMBERS = re.compile(r'\b\d+\b')
+TOKEN = re.compile(r'\S+')
+
+@functools.lru_cache(maxsize=None)
+def load_stopwords(stopwords_file_path):
+    """Read a LoughranMcDonald stopword list once. Output: frozenset of lower case stopwords"""
+    stopwords = pd.read_csv(stopwords_file_path, header=None)[0].tolist()
+    return frozenset([word.lower() for word in stopwords])
+
+def count_words(text):
+    """
+    Number of words in the raw text, used for the _lwc/_pwc section word counts. Always word_tokenize, whatever the
+    tokenizer mode, since its Treebank handling of numbers, contractions and abbreviations defines the published counts
+    """
+    return len(word_tokenize(text))
+
+class FilingTokenizer:
+    """
+    Callable tokenizer, e.g. CountVectorizer(tokenizer=FilingTokenizer(stopwords))
+    stopwords: set of lower case words to drop, or None to keep every word
+    stemming: if True, reduce each token with the Porter stemmer
+    mode: 'regex' splits on whitespace once punctuation is gone, 'nltk' uses word_tokenize
+    """
+    def __init__(self, stopwords=None, stemming=False, mode=TOKENIZER_MODE):
+        self.stopwords = stopwords or frozenset()
+        self.stemming = stemming
+        self.mode = mode
+        self.stemmer = PorterStemmer() if stemming else None
+        self.stems = {}     # Memo of token -> stem, shared by every filing this tokenizer sees
+        self.ids = {}       # Memo of token -> interned integer ID
+
+    def __call__(self, text):
+        # Remove punctuation, then n-digit numbers
+        text = text.translate(PUNCTUATION_TABLE)
+        text = NUMBERS.sub('', text)
+
+        tokens = TOKEN.findall(text) if self.mode == 'regex' else word_tokenize(text)
+        stopwords = self.stopwords
+        tokens = [word for word in map(str.lower, tokens) if word not in stopwords]
+
+        if self.stemming:
+            stems = self.stems
+            for word in set(tokens).difference(stems):
+                stems[word] = self.stemmer.stem(word)
+            tokens = [stems[word] for word in tokens]
+        return tokens
+
+    def token_ids(self, tokens):
+        """
+        Intern tokens as 64-bit integers, for the token-level diff. IDs are a hash of the token, so they are the same
+        in every process and every run, and sequences from different filings can be compared directly
+        """
+        ids = self.ids
+        for word in set(tokens).difference(ids):
+            ids[word] = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+        return np.array([ids[word] for word in tokens], dtype=np.int64)
+
+def benchmark_tokenizers(texts, stopwords=None, stemming=False):
+    """
+    Compare the regex tokenizer against word_tokenize on the same texts, e.g. a sample of full 10-Ks
+    Output: dataframe with tokens per second for each mode, and the share of texts whose token counts are identical
+    """
+    results = {}
+    tokens = {}
+    for mode in ['nltk', 'regex']:
+        tokenizer = FilingTokenizer(stopwords, stemming, mode)
+        start = time.perf_counter()
+        tokens[mode] = [tokenizer(text) for text in texts]
+        seconds = time.perf_counter() - start
+        total = sum(len(t) for t in tokens[mode])
+        results[mode] = {'tokens': total, 'seconds': seconds, 'tokens_per_second': total / seconds if seconds else float('inf')}
+
+    df_results = pd.DataFrame(results).T
+    df_results['speedup'] = df_results['tokens_per_second'] / df_results.loc['nltk', 'tokens_per_second']
+
+    # Equivalence is judged on bags of words, which is what the vectorizer sees
+    identical = [Counter(a) == Counter(b) for a, b in zip(tokens['nltk'], tokens['regex'])]
+    mismatched = sum(sum((Counter(a) - Counter(b)).values()) + sum((Counter(b) - Counter(a)).values())
+                     for a, b in zip(tokens['nltk'], tokens['regex']))
+    df_results['identical_share'] = sum(identical) / len(texts) if texts else 1.0
+    df_results['mismatched_tokens'] = mismatched
+    return df_results
@@ -10,47 +10,46 @@ import re
 
 pd.options.mode.chained_assignment = None
 DOWNLOAD_FROM_EDGAR = True
+INDEX_DIR = 'sec-filings-index'     # Under project_dir
+CIK_FILE = 'market_cap_GT_1B.csv'   # Under project_dir/data. Also 'cik_ticker_list.csv', '1_analysts_202010151718.csv'
+FROM_DATE = '2016-01-01'
+URL_PREFIX = 'https://www.sec.gov/Archives/'
 
-# ## generate df with all companies and URLs
-project_dir = directory.get_project_dir()
-os.chdir(os.path.join(project_dir, 'sec-filings-index'))
-
-# filing_year = 2020   # uncomment to run, choose year to get all edgar filings from
-# edgar.download_index(os.getcwd(), filing_year)
-
-# Get list of all DFs 
-table_list = []
+def sync_index(project_dir, since_year):
+    """Download the EDGAR quarterly index files from since_year on. Files already present are kept, except the latest quarter's"""
+    edgar.download_index(os.path.join(project_dir, INDEX_DIR), since_year, skip_all_present_except_last=True)
 
-for i in os.listdir():
-    if not os.path.isdir(i) and i.endswith('.tsv'):
-        table_list.append(pd.read_csv(i, sep='|', header=None, encoding='latin-1', parse_dates=[3], dtype={0: int}))
+# ## generate df with all companies and URLs
+def load_index(project_dir):
+    """Read all the .tsv index files into one dataframe of filings"""
+    index_dir = os.path.join(project_dir, INDEX_DIR)
 
-# append all dfs into a single df
-df = pd.DataFrame(columns=[0,1,2,3,4,5])   # downloaded file has 6 columns
+    # Get list of all DFs
+    table_list = []
 
-for i in range(len(table_list)):
-        df = pd.concat([df, table_list[i]], ignore_index=True, axis=0)
+    for i in sorted(os.listdir(index_dir)):
+        path = os.path.join(index_dir, i)
+        if not os.path.isdir(path) and i.endswith('.tsv'):
+            table_list.append(pd.read_csv(path, sep='|', header=None, encoding='latin-1', parse_dates=[3], dtype={0: int}))
 
-df.columns= ['cik', 'company_name', 'filing_type', 'filing_date', 'url', 'url2']
+    # append all dfs into a single df
+    df = pd.DataFrame(columns=[0,1,2,3,4,5])   # downloaded file has 6 columns
 
-# Fix up company names
-df['company_name'] = [re.sub(r'\s*\\.*|/.*|[\.\,]*', '', str(x)) for x in df['company_name']]
+    for i in range(len(table_list)):
+            df = pd.concat([df, table_list[i]], ignore_index=True, axis=0)
 
-# ## Check if dataframe correctly generated
-count_list = []
-for i in range(len(table_list)):
-    count_list.append(len(table_list[i]))
+    df.columns= ['cik', 'company_name', 'filing_type', 'filing_date', 'url', 'url2']
+    df['filing_date'] = pd.to_datetime(df['filing_date'])     # concat with the empty frame leaves an object column
 
-if df.shape[0] == sum(count_list):
-    print('df tallies with individual files. Total rows = {}'.format(df.shape[0]))
-else:
-    print('ERROR. df does not tally!!')
+    # Fix up company names
+    df['company_name'] = [re.sub(r'\s*\\.*|/.*|[\.\,]*', '', str(x)) for x in df['company_name']]
 
-# ## Get CIK df
-# cik_ticker_list.csv contains cik tickets of companies
-# df_cik = pd.read_csv(os.path.join(project_dir, 'data', 'cik_ticker_list.csv'))
-# df_cik = pd.read_csv(os.path.join(project_dir, 'data', '1_analysts_202010151718.csv'))
-df_cik = pd.read_csv(os.path.join(project_dir, 'data', 'market_cap_GT_1B.csv'))
+    # ## Check if dataframe correctly generated
+    if df.shape[0] == sum(len(table) for table in table_list):
+        print('df tallies with individual files. Total rows = {}'.format(df.shape[0]))
+    else:
+        print('ERROR. df does not tally!!')
+    return df
 
 def company_name_search(df, company_name_list):
     for company in company_name_list:
@@ -62,7 +61,7 @@ def company_name_search(df, company_name_list):
             for j in df_company['CIK'].tolist():
                 print(i, j)
         print('*' * 50)
-        
+
 def get_cik_from_company_name(df, company_name_list=None):
     cik_list = []
     if company_name_list is not None:
@@ -70,7 +69,7 @@ def get_cik_from_company_name(df, company_name_list=None):
             cik_series = df[df['Name'].str.contains(company, case=False)]['CIK']
             cik_list.append(cik_series.values[0])
     else:
-        cik_list = df['CIK'].tolist()        
+        cik_list = df['CIK'].tolist()
     return cik_list
 
 def get_company_name_from_cik(df, cik_list):
@@ -80,88 +79,113 @@ def get_company_name_from_cik(df, cik_list):
         company_list.append(company_series.values[0])
     return company_list
 
-companies_list = ['']
+# ## Get CIK list
+def load_cik_list(project_dir, cik_file=CIK_FILE, company_name_list=None):
+    """CIKs of the companies in the CIK file, or of the ones matching company_name_list (None for all)"""
+    df_cik = pd.read_csv(os.path.join(project_dir, 'data', cik_file))
+    return get_cik_from_company_name(df_cik, company_name_list)
 
-# company_name_search(df_cik, companies_list)
+def select_filings(df, cik_num_list, from_date=FROM_DATE):
+    """filter df with company CIK, filing type (10-K and 10-Q) and date"""
+    df_filtered = df [(df['cik'].isin(cik_num_list)) &
+                      ((df['filing_type']=='10-K') | (df['filing_type'] == '10-Q')) &
+                      (df['filing_date'] > from_date)]
+    df_filtered['filing_date'] = df_filtered['filing_date'].astype(str)   # convert to 'object' to name file
+    return df_filtered
 
-# cik_list = get_cik_from_company_name(df_cik, companies_list)    # Just get these companies' data
-cik_list = get_cik_from_company_name(df_cik)  # Get all company data
+def filing_name(row):
+    """File name of a downloaded filing, e.g. 2019-05-01_10-Q"""
+    return row['filing_date'] + str('_') + row['filing_type']
 
 # ## download data
-def download_filings(cik_num_list, from_date='2016-01-01'):
+def download_filing(sec_filings_dir, row, from_edgar=DOWNLOAD_FROM_EDGAR):
+    """
+    Download one filing of the index into its company directory, or move it there from the sec-utils directories
+    Output: path of the filing, None if it could not be found
+    """
+    company_dir = os.path.join(sec_filings_dir, row['company_name'])
+    os.makedirs(company_dir, exist_ok=True)
+    url = URL_PREFIX + row['url']
+    filing_path = os.path.join(company_dir, filing_name(row))
+    if os.path.isfile(filing_path):
+        print('{} file already exists'.format(filing_name(row)))
+        return filing_path
+
+    if from_edgar:
+        print('Downloading: {}'.format(filing_name(row)))
+        response = requests.get(url, stream=True, timeout=30)
+        response.raise_for_status()
+        temp_path = filing_path + '.part'      # Renamed when complete, so an interrupted download is fetched again
+        with open(temp_path, 'wb') as handle:
+            for data in tqdm(response.iter_content(chunk_size=65536)):
+                handle.write(data)
+        os.replace(temp_path, filing_path)
+        return filing_path
+
+    # Instead of downloading here, we'll move from existing directory. This should be a command line parameter
+    # Parse the filing date as '2013-03-04'
+    filing_date = row['filing_date']
+    get_year = filing_date[0:4]
+    get_month = int(filing_date[5:7])
+
+    if get_month >= 1 and get_month <= 3:
+        filing_quarter = 'Q1'
+    elif get_month >= 4 and get_month <= 6:
+        filing_quarter = 'Q2'
+    elif get_month >= 7 and get_month <= 9:
+        filing_quarter = 'Q3'
+    else:
+        filing_quarter = 'Q4'
+
+    quarter_dir = os.path.join(sec_filings_dir, row['filing_type'], get_year, filing_quarter)
+    filename = os.path.join(quarter_dir, url[url.rfind('/')+1:])
+    print(f'Moving: {filename} to {filing_path}')
+    try:
+        os.rename(filename, filing_path)
+        cleaned_filename = os.path.join(quarter_dir, 'cleaned_' + url[url.rfind('/')+1:])
+        cleaned_filing_name = os.path.join(company_dir, 'cleaned_' + filing_name(row))
+        print(f'Moving: {cleaned_filename} to {cleaned_filing_name}')
+        os.rename(cleaned_filename, cleaned_filing_name)
+    except OSError:
+        print('Not found. Skipped.')
+        return filing_path if os.path.isfile(filing_path) else None
+    return filing_path
+
+def download_filings(df, cik_num_list, from_date=FROM_DATE, project_dir=None):
     """Function to filter the appropriate filings and download them in the folder"""
-    
-    project_dir = directory.get_project_dir()
-    
-    # filter df with company CIK,filing type (10-K and 10-Q) and date  
-    df_filtered = df [(df['cik'].isin(cik_num_list)) & 
-                      ((df['filing_type']=='10-K') | (df['filing_type'] == '10-Q')) & 
-                      (df['filing_date'] > from_date)]
-    
-    company_names = df_filtered['company_name'].unique().tolist()
-    
-    # check if folders for each company already exists    
-    sec_filings_dir = os.path.join(project_dir, 'sec-filings-downloaded')  # dir to download SEC filingsa
-    os.chdir(sec_filings_dir)
-
-    for company in company_names:
-        company_dir = os.path.join(sec_filings_dir, company)
-
-        if not os.path.exists(company_dir):
-            os.makedirs(company_dir)
+
+    project_dir = project_dir or directory.find_project_dir()
+    df_filtered = select_filings(df, cik_num_list, from_date)
+
+    # check if folders for each company already exists
+    sec_filings_dir = os.path.join(project_dir, 'sec-filings-downloaded')  # dir to download SEC filings
+
+    for company, df_filtered_co in df_filtered.groupby('company_name', sort=False):
+        if not os.path.exists(os.path.join(sec_filings_dir, company)):
             print('\n created dir: {}'.format(company))
         else:
             print('\n{} directory exists'.format(company))
-            
-        os.chdir(company_dir)
-        
-        # create company specific df to iterate over    
-        df_filtered_co = df_filtered[df_filtered['company_name'] == company]  # get df with the company only
-        df_filtered_co['filing_date'] = df_filtered_co['filing_date'].astype(str)   # convert to 'object' to name file
-        
-        for i in range(len(df_filtered_co)):
-            url_prefix = 'https://www.sec.gov/Archives/'
-            row = df_filtered_co.iloc[i,:]
-            url = url_prefix + row['url']
-            
-            filing_name = row['filing_date'] + str('_') + row['filing_type']
-            if os.path.isfile(filing_name):
-                print('{} file already exists'.format(filing_name))
-            else:
-                if DOWNLOAD_FROM_EDGAR:
-                    print('Downloading: {}'.format(filing_name))
-                    response = requests.get(url, stream=True, timeout=30)
-                    with open('{}'.format(filing_name), 'wb') as handle:
-                        for data in tqdm(response.iter_content()):
-                            handle.write(data)
-                else:
-                    # Instead of downloading here, we'll move from existing directory. This should be a command line parameter
-                    # Parse the filing date as '2013-03-04'
-                    filing_date = row['filing_date']
-                    get_date = filing_date[0:10]
-                    get_year = filing_date[0:4]
-                    get_month = int(filing_date[5:7])
-
-                    if get_month >= 1 and get_month <= 3:
-                        filing_quarter = 'Q1'
-                    elif get_month >= 4 and get_month <= 6:
-                        filing_quarter = 'Q2'
-                    elif get_month >= 7 and get_month <= 9:
-                        filing_quarter = 'Q3'
-                    else:
-                        filing_quarter = 'Q4'
-
-                    filename = '../' + row['filing_type'] + '/' + get_year + '/' + filing_quarter + '/' + url[url.rfind('/')+1:]
-                    print(f'Moving: {filename} to {filing_name}')
-                    try:
-                        os.rename(filename, filing_name)
-                        cleaned_filename = '../' + row['filing_type'] + '/' + get_year + '/' + filing_quarter + '/' + 'cleaned_' + url[url.rfind('/')+1:]
-                        cleaned_filing_name = 'cleaned_' + filing_name
-                        print(f'Moving: {cleaned_filename} to {cleaned_filing_name}')
-                        os.rename(cleaned_filename, cleaned_filing_name)
-                    except:
-                        print('Not found. Skipped.')
-                        continue
+
+        for row in df_filtered_co.to_dict('records'):
+            try:
+                download_filing(sec_filings_dir, row)
+            except Exception as e:
+                print('Exception downloading {} {}: {}'.format(company, filing_name(row), e))
 
 # ### ↓ Automated download of filings. If the filing exists in the directory, the download will skip and move on the the next filing
-download_filings(cik_list)
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+
+    # filing_year = 2020   # uncomment to run, choose year to get all edgar filings from
+    # sync_index(project_dir, filing_year)
+
+    df = load_index(project_dir)
+
+    companies_list = ['']
+
+    # company_name_search(pd.read_csv(os.path.join(project_dir, 'data', CIK_FILE)), companies_list)
+
+    # cik_list = load_cik_list(project_dir, company_name_list=companies_list)    # Just get these companies' data
+    cik_list = load_cik_list(project_dir)  # Get all company data
+
+    download_filings(df, cik_list, project_dir=project_dir)
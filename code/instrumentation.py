@@ -0,0 +1,167 @@
+#
+#   Per-filing step timings and peak memory.
+#
+#       A function decorated with instrumented() becomes one record per call (a filing for the cleaners, a filing
+#       pair or a scoring batch for the similarity job). Inside it, lap('name') closes the step that ran since the
+#       previous lap, so a parser is instrumented by a lap call after each of its steps without reindenting it. Steps
+#       with the same name add up, e.g. extract_raw over every item. When the call returns, the record is appended to
+#       a JSON lines log with the total and per-step seconds, calls and peak memory, and whether the call succeeded.
+#
+#       Peak memory is the resident set size, sampled by a background thread every MEMORY_SAMPLE_SECONDS and at every
+#       lap, and taken from the process high-water mark when that grows during a step, since a long regex holds the
+#       GIL and the sampler cannot run until it ends. The cleaners run each filing in a fresh process, so the
+#       high-water mark is the filing's own.
+#
+#       Instrumentation is off until enable() is called, and then costs one perf_counter call per lap. The log path
+#       is kept in the environment, so cleaner child processes write to the same log. instrumentation_summary.py
+#       reports the percentiles of each step and the slowest filings.
+
+import os
+import sys
+import json
+import time
+import datetime
+import functools
+import threading
+
+try:
+    import resource
+except ImportError:     # Windows: no high-water mark, sampling only
+    resource = None
+
+LOG_ENV = 'SEC_INSTRUMENT_LOG'
+LOG_FILE = 'instrumentation.jsonl'  # Under project_dir/data
+MEMORY_SAMPLE_SECONDS = 0.01
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024     # ru_maxrss is in bytes on macOS, KB on Linux
+
+local = threading.local()
+active = set()
+active_lock = threading.Lock()
+sampler = None
+
+def enable(path):
+    """Log records to path, in this process and the processes it starts"""
+    os.environ[LOG_ENV] = os.path.abspath(path)
+
+def disable():
+    os.environ.pop(LOG_ENV, None)
+
+def log_path():
+    return os.environ.get(LOG_ENV)
+
+def current_rss():
+    """Resident set size in bytes, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+def max_rss():
+    """Process high-water mark of the resident set size in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_BYTES if resource else 0
+
+def sample_memory():
+    while True:
+        time.sleep(MEMORY_SAMPLE_SECONDS)
+        rss = current_rss()
+        if rss is None:
+            return
+        with active_lock:
+            for record in active:
+                record.step_peak = max(record.step_peak, rss)
+
+def start_sampler():
+    global sampler
+    if sampler is None or not sampler.is_alive():
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+
+class FilingRecord:
+    """Steps of one instrumented call"""
+    def __init__(self, kind, name, fields):
+        self.kind = kind
+        self.name = name
+        self.fields = fields
+        self.steps = {}
+        self.started = datetime.datetime.now().isoformat(timespec='milliseconds')
+        self.start = self.last = time.perf_counter()
+        self.last_max_rss = max_rss()
+        self.step_peak = self.peak = current_rss() or 0
+
+    def lap(self, step):
+        now = time.perf_counter()
+        high_water = max_rss()
+        peak = max(self.step_peak, current_rss() or 0, high_water if high_water > self.last_max_rss else 0)
+        timing = self.steps.setdefault(step, {'seconds': 0.0, 'calls': 0, 'peak_rss_mb': 0.0})
+        timing['seconds'] += now - self.last
+        timing['calls'] += 1
+        timing['peak_rss_mb'] = max(timing['peak_rss_mb'], round(peak / 2**20, 1))
+        self.peak = max(self.peak, peak)
+        self.last, self.last_max_rss = time.perf_counter(), high_water
+        self.step_peak = current_rss() or 0
+
+    def finish(self, ok, error=None):
+        if time.perf_counter() - self.last > 0.001:
+            self.lap('other')       # Time after the last lap, e.g. an early return
+        return dict(self.fields, kind=self.kind, filing=self.name, started=self.started, pid=os.getpid(), ok=ok, error=error,
+                    seconds=round(time.perf_counter() - self.start, 4), peak_rss_mb=round(self.peak / 2**20, 1),
+                    steps={step: dict(timing, seconds=round(timing['seconds'], 4)) for step, timing in self.steps.items()})
+
+def write_record(path, record):
+    """Append one JSON line with a single write, so processes logging at the same time do not interleave"""
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def lap(step):
+    """Close the step that ran since the previous lap of this thread's record. Does nothing when not recording"""
+    record = getattr(local, 'record', None)
+    if record is not None:
+        record.lap(step)
+
+def first_argument(*args, **kwargs):
+    return kwargs.get('input_filename', args[0] if args else None)
+
+def instrumented(kind, name=first_argument, **fields):
+    """
+    Decorator: record each call of the function while instrumentation is enabled
+    kind: what the records are, e.g. 'clean' or 'similarity'
+    name: function of the call's arguments giving the record's filing, by default input_filename or the first argument
+    fields: constant fields added to every record, e.g. parser='regex'
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            path = log_path()
+            if not path or getattr(local, 'record', None) is not None:
+                return function(*args, **kwargs)
+            record = FilingRecord(kind, str(name(*args, **kwargs)), dict(fields, **{key: kwargs[key] for key in ['filing_type'] if key in kwargs}))
+            local.record = record
+            with active_lock:
+                active.add(record)
+            start_sampler()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                write_record(path, record.finish(False, f'{type(e).__name__}: {e}'))
+                raise
+            else:
+                write_record(path, record.finish(result is not None and result is not False))
+                return result
+            finally:
+                local.record = None
+                with active_lock:
+                    active.discard(record)
+        return wrapper
+    return decorate
+
+def read_log(path):
+    """Output: list of the records in a log"""
+    with open(path, 'r', encoding='utf-8') as log:
+        return [json.loads(line) for line in log if line.strip()]
@@ -0,0 +1,122 @@
+#
+#   Summary of the instrumentation log.
+#
+#       Reads data/instrumentation.jsonl, written when instrumentation is enabled (INSTRUMENT = True in the cleaners or
+#       calc_doc_similarity, or pipeline.py --instrument), and prints the p50 / p95 / p99 seconds and peak memory of
+#       every step of every parser, then the slowest filings with their slowest step. With --profile N the N slowest
+#       cleaned filings are cleaned again under cProfile, into a scratch directory, and the profiles are saved to
+#       data/profiles for snakeviz or pstats, with their top functions printed.
+
+import os
+import argparse
+import cProfile
+import pstats
+import io
+import tempfile
+import pandas as pd
+import ProjectDirectory as directory
+import instrumentation
+import clean_and_filter_data as regex_parser
+import Parse_10Q_by_index as toc_parser
+
+TOP_FILINGS = 20
+PROFILE_DIR = 'profiles'    # Under project_dir/data
+PROFILE_LINES = 25
+
+PARSERS = {'regex': regex_parser.clean_filing, 'toc': toc_parser.clean_filing}
+
+def step_frame(records):
+    """Output: dataframe with one row per record and step"""
+    return pd.DataFrame([{'kind': record['kind'], 'parser': record.get('parser', ''), 'filing': record['filing'], 'step': step, **timing}
+                         for record in records for step, timing in record['steps'].items()])
+
+def filing_frame(records):
+    """Output: dataframe with one row per record, with its slowest step"""
+    rows = []
+    for record in records:
+        slowest = max(record['steps'].items(), key=lambda step: step[1]['seconds'], default=(None, {'seconds': 0}))
+        rows.append({'kind': record['kind'], 'parser': record.get('parser', ''), 'filing': record['filing'],
+                     'form': record.get('filing_type', ''), 'ok': record['ok'], 'seconds': record['seconds'],
+                     'peak_rss_mb': record['peak_rss_mb'], 'slowest_step': slowest[0], 'slowest_step_seconds': slowest[1]['seconds']})
+    return pd.DataFrame(rows, columns=['kind', 'parser', 'filing', 'form', 'ok', 'seconds', 'peak_rss_mb', 'slowest_step', 'slowest_step_seconds'])
+
+def step_percentiles(records):
+    """p50 / p95 / p99 of each step's seconds per record, with its share of all the time of its kind and parser"""
+    df_steps = step_frame(records)
+    if not len(df_steps):
+        return df_steps
+    grouped = df_steps.groupby(['kind', 'parser', 'step'])
+    df_summary = grouped['seconds'].quantile([0.5, 0.95, 0.99]).unstack()
+    df_summary.columns = ['p50', 'p95', 'p99']
+    df_summary['filings'] = grouped.size()
+    df_summary['total'] = grouped['seconds'].sum()
+    df_summary['share'] = df_summary['total'] / df_summary.groupby(level=['kind', 'parser'])['total'].transform('sum')
+    df_summary['peak_rss_mb'] = grouped['peak_rss_mb'].max()
+    return df_summary.reset_index().sort_values(['kind', 'parser', 'p95'], ascending=[True, True, False])
+
+def slowest_filings(records, top=TOP_FILINGS, kind=None):
+    df_filings = filing_frame(records)
+    if kind:
+        df_filings = df_filings[df_filings['kind'] == kind]
+    return df_filings.sort_values('seconds', ascending=False).head(top)
+
+def profile_filing(record, profile_dir):
+    """
+    Clean a logged filing again under cProfile, writing the cleaned output to a scratch directory
+    Output: (path of the saved profile, its top functions by cumulative time)
+    """
+    parser = PARSERS[record['parser']]
+    name = f'{os.path.basename(os.path.dirname(record["filing"]))}_{os.path.basename(record["filing"])}_{record["parser"]}'
+    profile_path = os.path.join(profile_dir, name.replace(' ', '_') + '.prof')
+    log = instrumentation.log_path()
+    instrumentation.disable()   # Profile the parser, not the instrumentation
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            profiler = cProfile.Profile()
+            profiler.runcall(parser, input_filename=record['filing'], filing_type=record.get('filing_type', '10-K'),
+                             output_filename=os.path.join(scratch, 'cleaned_' + os.path.basename(record['filing'])))
+    finally:
+        if log:
+            instrumentation.enable(log)
+    profiler.dump_stats(profile_path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return profile_path, text.getvalue()
+
+def profile_outliers(records, project_dir, top):
+    """Profile the top slowest cleaned filings. Output: list of saved profile paths"""
+    profile_dir = os.path.join(project_dir, 'data', PROFILE_DIR)
+    os.makedirs(profile_dir, exist_ok=True)
+    cleaned = sorted([record for record in records if record['kind'] == 'clean' and record.get('parser') in PARSERS],
+                     key=lambda record: record['seconds'], reverse=True)
+    paths = []
+    for record in cleaned[:top]:
+        if not os.path.exists(record['filing']):
+            print(f'{record["filing"]} no longer exists, not profiled')
+            continue
+        path, top_functions = profile_filing(record, profile_dir)
+        print(f'*** {record["filing"]} ({record["parser"]}, {record["seconds"]:.1f}s logged) -> {path}\n{top_functions}')
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Step percentiles and slowest filings of the instrumentation log')
+    argument_parser.add_argument('--log', help='JSON lines log, project_dir/data/instrumentation.jsonl by default')
+    argument_parser.add_argument('--kind', help='Only records of this kind: clean, similarity or similarity_batch')
+    argument_parser.add_argument('--top', type=int, default=TOP_FILINGS, help='Number of slowest filings to list')
+    argument_parser.add_argument('--profile', type=int, default=0, metavar='N', help='Clean the N slowest filings again under cProfile')
+    args = argument_parser.parse_args()
+
+    project_dir = directory.find_project_dir()
+    records = instrumentation.read_log(args.log or os.path.join(project_dir, 'data', instrumentation.LOG_FILE))
+    if args.kind:
+        records = [record for record in records if record['kind'] == args.kind]
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(f'{len(records)} records, {sum(not record["ok"] for record in records)} failed\n')
+        print(step_percentiles(records).to_string(index=False))
+        print(f'\nSlowest {args.top}:')
+        print(slowest_filings(records, args.top).to_string(index=False))
+    if args.profile:
+        profile_outliers(records, project_dir, args.profile)
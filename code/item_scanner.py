@@ -0,0 +1,156 @@
+#
+#   Fast item-heading scanner.
+#
+#       The item regexes in clean_and_filter_data start with '>' and are tried at every '>' in a multi-MB document.
+#       Instead, find candidate headings with a cheap case-insensitive literal search for "tem"/"item", step back to
+#       the '>' that opens the heading and validate it with the same pattern anchored at that position. Produces the
+#       same rewritten document and (item, start, end) tuples as re.sub() followed by finditer().
+
+import re
+import bisect
+
+# 10-K: the full heading pattern (any Part prefix, ITEM/TEM, item number and letter) and its normalized replacement
+HEADING_10K = re.compile(r'>\s*?(Part I+(?:\.|\||,|\s)*?)?(I?TEM)S?(?:<.*?>)?(\s)*(<.*?>)?(16|15|14|13|12|11|10|9|8|7|6|5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?(\.|\s|<|\:)', re.IGNORECASE)
+REPLACE_10K = '>item \\5\\6.\\7'
+ITEM_10K = re.compile(r'>item\s(16|15|14|13|12|11|10|9|8|7|6|5|4|3|2|1|I)(A|B)?\.', re.IGNORECASE)
+
+# 10-Q: Part I and Part II headings. Part II items are renumbered 21, 22...
+HEADING_10QI = re.compile(r'>\s*?(?:ITEM)(?:<.*?>)?(?:\s)*(?:<.*?>)?(5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?', re.IGNORECASE)
+REPLACE_10QI = '>item \\1\\2.'
+ITEM_10QI = re.compile(r'>item\s(5|4|3|2|1)(A|B)?\.', re.IGNORECASE)
+
+HEADING_10QII = re.compile(r'>\s*?(?:ITEM)(?:<.*?>)?(?:\s)*(?:<.*?>)?(6|5|4|3|2|1|I)?(?:\s)?(?:\(?\.?(A|B)?\)?)?', re.IGNORECASE)
+REPLACE_10QII = '>item 2\\1\\2.'
+ITEM_10QII = re.compile(r'>item\s(26|25|24|23|22|21)(A|B)?\.', re.IGNORECASE)
+
+def find_candidates(document, literal):
+    """Yield the position of every case-insensitive occurrence of literal, using plain substring search"""
+    lowered = document.lower()
+    if len(lowered) != len(document) or '\u0131' in lowered:
+        # A few Unicode characters change length when lowered, which would shift the positions, and the
+        # regex engine also treats the dotless i as an I
+        for match in re.finditer(re.escape(literal), document, re.IGNORECASE):
+            yield match.start()
+        return
+    pos = lowered.find(literal)
+    while pos >= 0:
+        yield pos
+        pos = lowered.find(literal, pos + 1)
+
+def rewrite_item_headings(document, heading_regex, replacement, literal):
+    """
+    Equivalent of heading_regex.sub(replacement, document) for patterns that start with '>' and contain literal
+    before any other '>'.
+    literal: lower case text every heading contains, e.g. 'tem' for I?TEM
+    Output: rewritten document, list of positions of each replacement in the rewritten document
+    """
+    pieces = []
+    starts = []
+    copied_to = 0       # Position in document up to which text has been copied to pieces
+    new_length = 0      # Length of the rewritten document so far
+    last_open = -1      # Last '>' that was tried, each one is tried only once like re.sub does
+
+    for pos in find_candidates(document, literal):
+        # A heading never has a letter or digit right before the literal, other than the I of ITEM or PART I
+        if pos > 0 and document[pos-1].isalnum() and document[pos-1] not in 'iI\u0130\u0131':
+            continue
+        open_pos = document.rfind('>', copied_to, pos)
+        if open_pos < 0 or open_pos == last_open:
+            continue
+        last_open = open_pos
+        match = heading_regex.match(document, open_pos)
+        if not match:
+            continue
+
+        pieces.append(document[copied_to:open_pos])
+        new_length += open_pos - copied_to
+        replaced = match.expand(replacement)
+        starts.append(new_length)
+        pieces.append(replaced)
+        new_length += len(replaced)
+        copied_to = match.end()
+
+    pieces.append(document[copied_to:])
+    return ''.join(pieces), starts
+
+def scan_item_headings(document, heading_regex, replacement, item_regex, literal='item', fixups=()):
+    """
+    Rewrite item headings and locate the normalized items.
+    fixups: (old, new) string replacements of equal length applied to the rewritten document, e.g. ('>item I', '>item 1')
+    Output: rewritten document, list of (item, start, end) tuples as item_regex.finditer() would return them
+    """
+    rewritten, starts = rewrite_item_headings(document, heading_regex, replacement, literal)
+    for old, new in fixups:
+        rewritten = rewritten.replace(old, new)
+
+    items = []
+    for start in starts:
+        match = item_regex.match(rewritten, start)
+        if match:
+            items.append((match.group(), match.start(), match.end()))
+    return rewritten, items
+
+# Part headings of a 10-Q. PART_HEADING finds every heading once, the other two classify it
+PART_HEADING = re.compile(r'>\s*?PART (?:I|1)', re.IGNORECASE | re.ASCII)
+PART_I = re.compile(r'>\s*?PART (?:I|1)[^I]', re.IGNORECASE | re.ASCII)
+PART_II = re.compile(r'>\s*?PART II', re.IGNORECASE | re.ASCII)
+FINANCIAL_TITLE = re.compile(r'FINANCIAL (?:INFORMATION|STATEMENTS)', re.IGNORECASE | re.ASCII)
+OTHER_TITLE = re.compile(r'OTHER INFORMATION', re.IGNORECASE | re.ASCII)
+
+def find_part_sections(data):
+    """
+    Linear-time equivalent of the 10-Q Part I and Part II findall() regexes
+        >\\s*?PART (?:I|1)[^I](?:.*?FINANCIAL (?:INFORMATION|STATEMENTS))?(.*?)>\\s*?PART II.*?OTHER INFORMATION
+        >\\s*?PART II.*?OTHER INFORMATION(.*?)(?=>\\s*?PART (?:I|1)|$)
+    which backtrack through nested lazy groups on unusual filings. All headings and titles are located once,
+    then paired with binary searches.
+    Output: (list of Part I texts, list of Part II texts)
+    """
+    headings = [match.start() for match in PART_HEADING.finditer(data)]
+    part_i = [(pos, PART_I.match(data, pos)) for pos in headings]
+    part_i = [(pos, match.end()) for pos, match in part_i if match]
+    part_ii = [(pos, PART_II.match(data, pos)) for pos in headings]
+    part_ii = [(pos, match.end()) for pos, match in part_ii if match]
+    financial = [(match.start(), match.end()) for match in FINANCIAL_TITLE.finditer(data)]
+    other = [(match.start(), match.end()) for match in OTHER_TITLE.finditer(data)]
+    if not other:
+        return [], []
+
+    # A Part II heading can close Part I only if OTHER INFORMATION follows it somewhere
+    last_other = other[-1][0]
+    closing = [(pos, end) for pos, end in part_ii if end <= last_other]
+    closing_starts = [pos for pos, end in closing]
+    financial_starts = [pos for pos, end in financial]
+    other_starts = [pos for pos, end in other]
+
+    part_i_text = []
+    search_from = 0
+    for pos, end in part_i:
+        if pos < search_from:
+            continue
+        if bisect.bisect_left(closing_starts, end) == len(closing):
+            break   # No Part II heading left to close this or any later Part I
+        start = end
+        f = bisect.bisect_left(financial_starts, end)
+        if f < len(financial) and bisect.bisect_left(closing_starts, financial[f][1]) < len(closing):
+            start = financial[f][1]   # Skip the FINANCIAL INFORMATION title
+        close_pos, close_end = closing[bisect.bisect_left(closing_starts, start)]
+        part_i_text.append(data[start:close_pos])
+        search_from = other[bisect.bisect_left(other_starts, close_end)][1]
+
+    # Part II runs from its OTHER INFORMATION title to the next PART heading, or the end of the document
+    data_end = len(data) - 1 if data.endswith('\n') else len(data)
+    part_ii_text = []
+    search_from = 0
+    for pos, end in part_ii:
+        if pos < search_from:
+            continue
+        o = bisect.bisect_left(other_starts, end)
+        if o == len(other):
+            break
+        start = other[o][1]
+        h = bisect.bisect_left(headings, start)
+        stop = headings[h] if h < len(headings) and headings[h] < data_end else data_end
+        part_ii_text.append(data[start:stop])
+        search_from = stop
+    return part_i_text, part_ii_text
@@ -0,0 +1,63 @@
+#
+#   Inline XBRL aware stripping pass.
+#
+#       Modern 10-K/10-Q primary documents are inline XBRL. Besides the <ix:header> block, every tagged fact is wrapped
+#       in <ix:nonNumeric>/<ix:nonFraction>/<ix:continuation> elements, and hidden facts sit in display:none blocks.
+#       One pass over the tags drops the hidden blocks and unwraps the ix elements, keeping the visible text, so the
+#       table and item processing in clean_filing works on a smaller and simpler document.
+
+import re
+
+TAG = re.compile(r'<(/?)([a-z][\w:.-]*)([^>]*)>', re.IGNORECASE)
+HIDDEN_STYLE = re.compile(r'display\s*:\s*none', re.IGNORECASE)
+IXBRL_MARKER = re.compile(r'<ix:', re.IGNORECASE)
+VOID_TAGS = {'area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'wbr'}
+HIDDEN_TAGS = {'ix:header'}     # Always removed with their content, whether or not they are styled hidden
+
+def is_inline_xbrl(data):
+    return IXBRL_MARKER.search(data) is not None
+
+def strip_inline_xbrl(data):
+    """
+    Removes hidden blocks and ix tags from an inline XBRL filing in a single pass over its tags
+    Input: filing text
+    Output: filing text with hidden blocks dropped and ix elements unwrapped. Non-iXBRL filings are returned unchanged
+    """
+    if not is_inline_xbrl(data):
+        return data
+
+    pieces = []
+    copied_to = 0       # Position in data up to which text has been kept or dropped
+    hidden_tag = None   # Name of the element whose content is being dropped
+    hidden_start = 0
+    hidden_depth = 0
+
+    for tag in TAG.finditer(data):
+        closing = tag.group(1) == '/'
+        name = tag.group(2).lower()
+        self_closing = name in VOID_TAGS or tag.group(3).endswith('/')
+
+        if hidden_tag:
+            # Skip everything up to the matching close of the hidden element
+            if name == hidden_tag and not self_closing:
+                hidden_depth += -1 if closing else 1
+                if hidden_depth == 0:
+                    hidden_tag = None
+                    copied_to = tag.end()
+            continue
+
+        if not closing and not self_closing and (name in HIDDEN_TAGS or HIDDEN_STYLE.search(tag.group(3))):
+            pieces.append(data[copied_to:tag.start()])
+            hidden_tag = name
+            hidden_start = tag.start()
+            hidden_depth = 1
+        elif name.startswith('ix:'):
+            # Unwrap: drop the tag itself, keep its content
+            pieces.append(data[copied_to:tag.start()])
+            copied_to = tag.end()
+
+    if hidden_tag:
+        # Hidden element never closed, so the markup is not what we expect. Keep the rest as is.
+        copied_to = hidden_start
+    pieces.append(data[copied_to:])
+    return ''.join(pieces)
@@ -0,0 +1,231 @@
+#
+#   Loughran-McDonald dictionary scores.
+#
+#       The master dictionary CSV (not shipped, download it into master-dict/ from
+#       https://sraf.nd.edu/loughranmcdonald-master-dictionary/) is read once and every word is passed through the
+#       same tokenizer as the filings, then turned into the 64-bit token IDs the token cache keeps for every row. The
+#       result is a sorted array of dictionary token IDs with one sparse indicator column per category, cached as a
+#       small .npz. Words are matched on their IDs rather than on the hashed feature columns, since an ordinary word
+#       sharing a hash bucket with a dictionary word would otherwise be counted in its categories. The hashed counts
+#       are only used for the row totals. Nothing is tokenized again.
+#
+#       Changed text is scored the same way from the difference of two filings' dictionary word counts: the positive
+#       part is the words added since the previous filing, the negative part the words removed.
+
+import os
+import glob
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import ProjectDirectory as directory
+import similarity_matrix
+import token_cache
+import calc_doc_similarity as similarity
+import filing_catalog
+
+LM_DICTIONARY_GLOB = 'LoughranMcDonald_MasterDictionary*.csv'   # Under project_dir/master-dict, latest version wins
+LM_CATEGORIES = ['Negative', 'Positive', 'Uncertainty', 'Litigious', 'Constraining', 'Strong_Modal', 'Weak_Modal']
+LM_SCORE_FILES = {'10-K': 'lm_scores_10-K.csv', '10-Q': 'lm_scores_10-Q.csv'}      # Under project_dir/data
+LM_CHANGE_FILES = {'10-K': 'lm_changes_10-K.csv', '10-Q': 'lm_changes_10-Q.csv'}
+
+def find_lm_dictionary(project_dir):
+    files = sorted(glob.glob(os.path.join(project_dir, 'master-dict', LM_DICTIONARY_GLOB)))
+    if not files:
+        raise FileNotFoundError(f'No {LM_DICTIONARY_GLOB} in {os.path.join(project_dir, "master-dict")}')
+    return files[-1]
+
+def read_category_words(dictionary_path, categories=LM_CATEGORIES):
+    """
+    Words of each category. A category column holds the year a word was added, negative if it was later dropped.
+    Older releases have a single Modal column: 1 strong, 2 moderate, 3 weak
+    Output: dict of category -> list of words
+    """
+    df_dict = pd.read_csv(dictionary_path, keep_default_na=False)     # 'NULL' and 'NA' are words here
+    words = df_dict['Word'].astype(str)
+    category_words = {}
+    for category in categories:
+        if category in df_dict.columns:
+            selected = pd.to_numeric(df_dict[category], errors='coerce').fillna(0) > 0
+        elif category in ('Strong_Modal', 'Weak_Modal') and 'Modal' in df_dict.columns:
+            selected = pd.to_numeric(df_dict['Modal'], errors='coerce') == (1 if category == 'Strong_Modal' else 3)
+        else:
+            raise KeyError(f'{category} is not a column of {dictionary_path}')
+        category_words[category] = words[selected].tolist()
+    return category_words
+
+class LMDictionary:
+    """
+    categories: list of category names
+    word_ids: sorted int64 array of the token IDs of the dictionary words
+    indicators: sparse len(word_ids) x len(categories) matrix, 1 where a word belongs to the category
+    """
+    def __init__(self, categories, word_ids, indicators):
+        self.categories = categories
+        self.word_ids = np.asarray(word_ids, dtype=np.int64)
+        self.indicators = sp.csc_matrix(indicators)
+
+    def word_counts(self, filing, rows):
+        """Counts of the dictionary words in rows of a token_cache.CachedFiling. Output: sparse len(rows) x words matrix"""
+        row_index, columns = [], []
+        for i, row in enumerate(rows):
+            ids = filing.token_ids[filing.token_indptr[row]:filing.token_indptr[row + 1]]
+            if not len(self.word_ids) or not len(ids):
+                continue
+            position = np.minimum(np.searchsorted(self.word_ids, ids), len(self.word_ids) - 1)
+            found = position[self.word_ids[position] == ids]
+            row_index.append(np.full(len(found), i))
+            columns.append(found)
+        if not columns:
+            return sp.csr_matrix((len(rows), len(self.word_ids)))
+        columns = np.concatenate(columns)
+        return sp.csr_matrix((np.ones(len(columns)), (np.concatenate(row_index), columns)), shape=(len(rows), len(self.word_ids)))
+
+    def counts(self, W):
+        """Category word counts of each row of a dictionary word count matrix. Output: dense rows x categories array"""
+        return np.asarray((sp.csr_matrix(W) @ self.indicators).todense())
+
+    def scores(self, filing):
+        """Category counts and shares of every row of a filing. Output: (counts, shares), shares NaN for empty rows"""
+        counts = self.counts(self.word_counts(filing, range(filing.counts.shape[0])))
+        totals = np.asarray(sp.csr_matrix(filing.counts).sum(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return counts, np.where(totals > 0, counts / totals, np.nan)
+
+    def changes(self, latest, previous, latest_rows, previous_rows):
+        """
+        Category counts of the words added to and removed from rows of latest relative to the matching rows of previous
+        Output: (added, removed)
+        """
+        delta = self.word_counts(latest, latest_rows) - self.word_counts(previous, previous_rows)
+        added = delta.maximum(0)
+        removed = (-delta).maximum(0)
+        return self.counts(added), self.counts(removed)
+
+def build_lm_dictionary(category_words, tokenizer):
+    category_ids = [set(tokenizer.token_ids([token for word in category_words[category] for token in tokenizer(word)]).tolist())
+                    for category in category_words]
+    word_ids = np.array(sorted(set().union(*category_ids)), dtype=np.int64)
+    rows = [np.searchsorted(word_ids, sorted(ids)) for ids in category_ids]
+    columns = [np.full(len(positions), c) for c, positions in enumerate(rows)]
+    indicators = sp.csc_matrix((np.ones(sum(len(positions) for positions in rows)), (np.concatenate(rows), np.concatenate(columns))),
+                               shape=(len(word_ids), len(category_ids)))
+    return LMDictionary(list(category_words), word_ids, indicators)
+
+def load_lm_dictionary(dictionary_path, tokenizer, cache_dir, categories=LM_CATEGORIES, n_features=similarity_matrix.HASH_FEATURES):
+    """The dictionary's token IDs and indicator columns, built once per dictionary file and tokenizer configuration and cached"""
+    with open(dictionary_path, 'rb') as file:
+        digest = hashlib.sha1(file.read())
+    digest.update(('|'.join(categories) + '|' + token_cache.tokenizer_config(tokenizer, n_features)).encode('utf-8'))
+    path = os.path.join(cache_dir, f'lm-words-{digest.hexdigest()[:16]}.npz')
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as entry:
+            indicators = sp.csc_matrix((entry['data'], entry['indices'], entry['indptr']), shape=tuple(entry['shape']))
+            return LMDictionary(entry['categories'].tolist(), entry['word_ids'], indicators)
+
+    lm = build_lm_dictionary(read_category_words(dictionary_path, categories), tokenizer)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        np.savez_compressed(file, categories=np.array(lm.categories, dtype=str), word_ids=lm.word_ids, data=lm.indicators.data,
+                            indices=lm.indicators.indices, indptr=lm.indicators.indptr, shape=np.array(lm.indicators.shape))
+    os.replace(temp_path, path)
+    return lm
+
+# Dictionary of each worker process, loaded on first use
+lm_dictionaries = {}
+
+def get_lm_dictionary(project_dir):
+    if project_dir not in lm_dictionaries:
+        cache = similarity.get_token_cache(project_dir)
+        lm_dictionaries[project_dir] = load_lm_dictionary(find_lm_dictionary(project_dir), cache.tokenizer, cache.cache_dir)
+    return lm_dictionaries[project_dir]
+
+def row_names(filing):
+    return ['document'] + filing.sections
+
+def score_company(task, project_dir):
+    """
+    Worker: dictionary scores of every filing of a company, and of the text changed between consecutive same-period filings
+    task: (company, list of filing dicts from the catalog, list of pair dicts from the catalog)
+    Output: (list of score records, list of change records), each tagged with its form
+    """
+    company, filings, pairs = task
+    lm = get_lm_dictionary(project_dir)
+    cache = similarity.get_token_cache(project_dir)
+
+    loaded = {}
+    score_records = []
+    for entry in filings:
+        try:
+            filing = cache.load(os.path.join(project_dir, entry['path']))
+        except Exception as e:
+            print('Exception reading {} {}: {}'.format(company, entry['path'], e))
+            continue
+        loaded[entry['accession']] = filing
+        counts, shares = lm.scores(filing)
+        for row, section in enumerate(row_names(filing)):
+            record = {'form': entry['form'], 'company': company, 'CIK': entry['cik'], 'accession': entry['accession'],
+                      'fiscal_period': entry['fiscal_period'], 'filing_dt': entry['filing_date'], 'section': section,
+                      'words': int(filing.counts[row].sum())}
+            for c, category in enumerate(lm.categories):
+                record[category] = int(counts[row, c])
+                record[category + '_share'] = shares[row, c]
+            score_records.append(record)
+
+    change_records = []
+    for pair in pairs:
+        if pair['latest_accession'] not in loaded or pair['previous_accession'] not in loaded:
+            continue
+        latest, previous = loaded[pair['latest_accession']], loaded[pair['previous_accession']]
+        rows = [('document', 0, 0)] + [(section, latest.section_row(section), previous.section_row(section))
+                                       for section in latest.sections if section in previous.sections]
+        added, removed = lm.changes(latest, previous, [row for _, row, _ in rows], [row for _, _, row in rows])
+        for i, (section, _, _) in enumerate(rows):
+            record = {'form': pair['form'], 'company': company, 'CIK': pair['latest_cik'],
+                      'latest_accession': pair['latest_accession'], 'previous_accession': pair['previous_accession'],
+                      'latest_filing_dt': pair['latest_filing_date'], 'previous_filing_dt': pair['previous_filing_date'],
+                      'section': section}
+            for c, category in enumerate(lm.categories):
+                record[category + '_added'] = int(added[i, c])
+                record[category + '_removed'] = int(removed[i, c])
+            change_records.append(record)
+    return score_records, change_records
+
+def score_all_companies(project_dir, forms=('10-K', '10-Q'), workers=similarity.SIMILARITY_WORKERS):
+    """Output: (dict of form -> scores dataframe, dict of form -> changed text dataframe)"""
+    get_lm_dictionary(project_dir)     # Build the cached dictionary once, before the workers look for it
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    filings = {}
+    for form in forms:
+        for entry in catalog.filings(form).drop(columns='sections').to_dict('records'):
+            filings.setdefault(entry['company'], []).append(entry)
+    pairs = dict(similarity.catalog_pair_tasks(catalog, forms, latest_only=False))
+    catalog.close()
+    tasks = [(company, filings[company], pairs.get(company, [])) for company in sorted(filings)]
+
+    read_company = functools.partial(score_company, project_dir=project_dir)
+    score_records, change_records = [], []
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for scores, changes in pool.imap(read_company, tasks, chunksize=4):
+                score_records.extend(scores)
+                change_records.extend(changes)
+    else:
+        for scores, changes in map(read_company, tasks):
+            score_records.extend(scores)
+            change_records.extend(changes)
+
+    df_scores, df_changes = pd.DataFrame(score_records), pd.DataFrame(change_records)
+    by_form = lambda df, form: df[df['form'] == form].drop(columns='form').reset_index(drop=True) if len(df) else df
+    return {form: by_form(df_scores, form) for form in forms}, {form: by_form(df_changes, form) for form in forms}
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    df_scores, df_changes = score_all_companies(project_dir)
+    for form in df_scores:
+        df_scores[form].to_csv(os.path.join(project_dir, 'data', LM_SCORE_FILES[form]), encoding='utf-8', index=False)
+        df_changes[form].to_csv(os.path.join(project_dir, 'data', LM_CHANGE_FILES[form]), encoding='utf-8', index=False)
@@ -0,0 +1,224 @@
+#
+#   MinHash / LSH index of cleaned sections.
+#
+#       Finds sections that are near-duplicates of each other, e.g. boilerplate risk factors copied across companies,
+#       without comparing every pair of filings. Each section's token ID sequence is cut into overlapping shingles of
+#       SHINGLE_SIZE tokens, and NUM_PERM min-hashes of the shingle set form its signature: the share of equal
+#       min-hashes between two signatures estimates the Jaccard similarity of their shingle sets. Signatures are split
+#       into BANDS bands, and sections that agree on a whole band share a bucket. The buckets live in an indexed SQLite
+#       table, so a query only looks at the sections that share at least one bucket with it, and new filings are
+#       inserted as they are tokenized.
+#
+#       With b bands of r rows, a pair with Jaccard s shares a bucket with probability 1 - (1 - s^r)^b; the default
+#       32 x 4 finds pairs above 0.6 almost surely and rarely bothers with pairs below 0.3.
+
+import os
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+import ProjectDirectory as directory
+
+MINHASH_DB = 'minhash.sqlite'   # Under project_dir/data
+NUM_PERM = 128
+BANDS = 32
+SHINGLE_SIZE = 5        # Tokens per shingle
+MIN_TOKENS = 50         # Shorter sections ("None.", "Not applicable.") are not indexed
+SEED = 1
+CHUNK = 4096            # Shingles hashed at a time, to bound memory on long sections
+
+def permutations(num_perm=NUM_PERM, seed=SEED):
+    """Multiply-shift hash functions: odd 64-bit multipliers and 64-bit offsets"""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.int64).astype(np.uint64)
+    return a, b
+
+def shingles(token_ids, shingle_size=SHINGLE_SIZE):
+    """Unique 64-bit hashes of every run of shingle_size consecutive token IDs"""
+    ids = np.asarray(token_ids, dtype=np.int64).view(np.uint64)
+    if len(ids) < shingle_size:
+        return np.zeros(0, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        hashes = np.zeros(len(ids) - shingle_size + 1, dtype=np.uint64)
+        for i in range(shingle_size):
+            hashes = hashes * np.uint64(0x100000001b3) + ids[i:len(ids) - shingle_size + 1 + i]
+    return np.unique(hashes)
+
+def signature(token_ids, perms, shingle_size=SHINGLE_SIZE):
+    """MinHash signature of a token ID sequence: uint32 array of len(perms[0]), or None if it has no shingles"""
+    values = shingles(token_ids, shingle_size)
+    if len(values) == 0:
+        return None
+    a, b = perms
+    minimum = np.full(len(a), np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for start in range(0, len(values), CHUNK):
+            chunk = values[start:start + CHUNK, None]
+            np.minimum(minimum, ((chunk * a + b) >> np.uint64(32)).min(axis=0), out=minimum)
+    return minimum.astype(np.uint32)
+
+def estimated_jaccard(left, right):
+    return float(np.mean(left == right))
+
+def band_buckets(sig, bands=BANDS):
+    """One bucket key per band: a 64-bit hash of the band's rows"""
+    return [int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), 'little', signed=True)
+            for band in np.array_split(sig, bands)]
+
+class MinHashIndex:
+    """
+    Persistent LSH index of section signatures
+    db_path: SQLite file, created if missing. Several processes may insert at once, SQLite serializes the writes
+    """
+    def __init__(self, db_path, num_perm=NUM_PERM, bands=BANDS, shingle_size=SHINGLE_SIZE):
+        self.conn = sqlite3.connect(db_path, timeout=120)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS sections (
+                section_id INTEGER PRIMARY KEY,
+                cik TEXT, company TEXT, accession TEXT, section TEXT, n_tokens INTEGER, signature BLOB,
+                UNIQUE (accession, section));
+            CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, section_id INTEGER);
+            CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket);
+        ''')
+        settings = dict(self.conn.execute('SELECT name, value FROM settings'))
+        wanted = {'num_perm': num_perm, 'bands': bands, 'shingle_size': shingle_size, 'seed': SEED}
+        if settings and settings != wanted:
+            raise ValueError(f'{db_path} was built with {settings}, not {wanted}')
+        if not settings:
+            with self.conn:
+                self.conn.executemany('INSERT OR IGNORE INTO settings VALUES (?, ?)', wanted.items())
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.perms = permutations(num_perm)
+
+    def close(self):
+        self.conn.close()
+
+    def signature(self, token_ids):
+        return signature(token_ids, self.perms, self.shingle_size)
+
+    def size(self):
+        return self.conn.execute('SELECT COUNT(*) FROM sections').fetchone()[0]
+
+    def contains(self, accession):
+        return self.conn.execute('SELECT 1 FROM sections WHERE accession = ? LIMIT 1', (accession,)).fetchone() is not None
+
+    def insert_filing(self, filing, company=None):
+        """Index every section of a token_cache.CachedFiling long enough to matter. Output: number of sections added"""
+        accession = filing.header.get('edgar_accession')
+        rows = []
+        for section in filing.sections:
+            token_ids = filing.row_tokens(filing.section_row(section))
+            if len(token_ids) < MIN_TOKENS:
+                continue
+            sig = self.signature(token_ids)
+            if sig is not None:
+                rows.append((section, len(token_ids), sig))
+
+        added = 0
+        with self.conn:
+            for section, n_tokens, sig in rows:
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO sections (cik, company, accession, section, n_tokens, signature) VALUES (?, ?, ?, ?, ?, ?)',
+                    (filing.header.get('CIK'), company, accession, section, n_tokens, sig.tobytes()))
+                if cursor.rowcount == 0:
+                    continue
+                self.conn.executemany('INSERT INTO buckets VALUES (?, ?, ?)',
+                                      [(band, bucket, cursor.lastrowid) for band, bucket in enumerate(band_buckets(sig, self.bands))])
+                added += 1
+        return added
+
+    def candidates(self, sig):
+        """Sections sharing at least one band bucket with the signature"""
+        ids = set()
+        for band, bucket in enumerate(band_buckets(sig, self.bands)):
+            ids.update(row[0] for row in self.conn.execute('SELECT section_id FROM buckets WHERE band = ? AND bucket = ?', (band, bucket)))
+        return ids
+
+    def query(self, token_ids, threshold=0.8, exclude_cik=None):
+        """
+        Near-duplicates of a token ID sequence
+        Output: dataframe of cik, company, accession, section and estimated jaccard, most similar first
+        """
+        sig = self.signature(token_ids)
+        return self.query_signature(sig, threshold, exclude_cik) if sig is not None else self.matches([])
+
+    def query_signature(self, sig, threshold=0.8, exclude_cik=None):
+        matches = []
+        ids = sorted(self.candidates(sig))
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for cik, company, accession, section, blob in self.conn.execute(
+                    f'SELECT cik, company, accession, section, signature FROM sections WHERE section_id IN ({",".join("?" * len(chunk))})', chunk):
+                if exclude_cik is not None and cik == exclude_cik:
+                    continue
+                jaccard = estimated_jaccard(sig, np.frombuffer(blob, dtype=np.uint32))
+                if jaccard >= threshold:
+                    matches.append((cik, company, accession, section, jaccard))
+        return self.matches(matches)
+
+    @staticmethod
+    def matches(rows):
+        return pd.DataFrame(rows, columns=['cik', 'company', 'accession', 'section', 'jaccard']).sort_values('jaccard', ascending=False, ignore_index=True)
+
+    def cross_company_duplicates(self, threshold=0.8):
+        """
+        Every pair of sections from different companies that share a bucket and pass the threshold: copied boilerplate
+        Output: dataframe with both sides of each pair and the estimated jaccard
+        """
+        # Same-company pairs, e.g. consecutive filings sharing nearly every band, are dropped in the join rather
+        # than read back. The signatures are only read once per distinct pair
+        query = '''
+            SELECT l.cik, l.company, l.accession, l.section, l.signature, r.cik, r.company, r.accession, r.section, r.signature
+            FROM (SELECT DISTINCT a.section_id AS left_id, b.section_id AS right_id FROM buckets a
+                  JOIN buckets b ON a.band = b.band AND a.bucket = b.bucket AND a.section_id < b.section_id
+                  JOIN sections sa ON sa.section_id = a.section_id
+                  JOIN sections sb ON sb.section_id = b.section_id
+                  WHERE sa.cik IS NOT sb.cik) pairs
+            JOIN sections l ON l.section_id = pairs.left_id
+            JOIN sections r ON r.section_id = pairs.right_id'''
+        rows = []
+        for row in self.conn.execute(query):
+            jaccard = estimated_jaccard(np.frombuffer(row[4], dtype=np.uint32), np.frombuffer(row[9], dtype=np.uint32))
+            if jaccard >= threshold:
+                rows.append(row[:4] + row[5:9] + (jaccard,))
+        rows.sort(key=lambda row: -row[-1])
+        return pd.DataFrame(rows, columns=['cik', 'company', 'accession', 'section',
+                                           'peer_cik', 'peer_company', 'peer_accession', 'peer_section', 'jaccard'])
+
+def index_all_filings(project_dir, index, cache):
+    """
+    Insert the sections of every cleaned filing not yet in the index, including those the token cache has seen
+    before the index existed. Output: number of sections added
+    """
+    before = index.size()
+    downloaded_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    for company in sorted(os.listdir(downloaded_dir)):
+        cleaned_dir = os.path.join(downloaded_dir, company, 'cleaned_filings')
+        if not os.path.isdir(cleaned_dir):
+            continue
+        for file in sorted(os.listdir(cleaned_dir)):
+            if file.startswith('error_') or not (file.endswith('10-K') or file.endswith('10-Q')):
+                continue
+            try:
+                filing = cache.load(os.path.join(cleaned_dir, file))
+                if not index.contains(filing.header.get('edgar_accession')):
+                    index.insert_filing(filing, company)
+            except Exception as e:
+                print('Exception indexing {} {}: {}'.format(company, file, e))
+    return index.size() - before
+
+
+if __name__ == '__main__':
+    import calc_doc_similarity as similarity
+
+    project_dir = directory.find_project_dir()
+    index = MinHashIndex(os.path.join(project_dir, 'data', MINHASH_DB))
+    print(f'{index_all_filings(project_dir, index, similarity.get_token_cache(project_dir))} sections added to the index')
+    df_duplicates = index.cross_company_duplicates(threshold=0.8)
+    df_duplicates.to_csv(os.path.join(project_dir, 'data', 'near_duplicate_sections.csv'), encoding='utf-8', index=False)
+    print(f'{len(df_duplicates)} near-duplicate section pairs across companies')
+    index.close()
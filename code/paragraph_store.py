@@ -0,0 +1,212 @@
+#
+#   Paragraph-deduplicated store of a company's cleaned filings.
+#
+#       Successive filings of a company repeat most of their paragraphs. Here each CIK has one SQLite file holding a
+#       dictionary of its distinct paragraphs, keyed by a 64-bit hash of their bytes, and every cleaned filing is kept
+#       as the sequence of its paragraph hashes and lengths. The paragraphs a filing adds to the dictionary are zlib
+#       compressed together as one block, since single sentences compress poorly on their own. A filing's bytes are the join of
+#       its paragraphs, so it can be rebuilt exactly, and a section is read from only the paragraphs that overlap its
+#       range in the header's offset table. Two filings share a paragraph exactly when they share its hash, so
+#       "identical paragraph" detection between any two filings of the company is a set intersection.
+#
+#       The 10-Q cleaner collapses all whitespace, so a cleaned 10-Q is one line after the header, and 10-K lines are
+#       whatever the HTML source lines were. Units are therefore cut at every line break, at every sentence end (a
+#       '.', '!' or '?' and the spaces after it, before a capital, digit or quote), and before every section marker,
+#       which also keeps each section's offsets on unit boundaries. Each unit keeps its trailing spaces or line break.
+
+import os
+import re
+import json
+import zlib
+import sqlite3
+import hashlib
+import numpy as np
+import ProjectDirectory as directory
+import cleaned_filing
+import filing_catalog
+
+PARAGRAPH_STORE_DIR = 'paragraph-store'     # Under the project directory, one <CIK>.sqlite per company
+COMPRESSION_LEVEL = 6
+PARAGRAPH_END = re.compile(rb'\n|[.!?]["\')]*\s+(?=["\'(]?[A-Z0-9])')     # Line break, or sentence end and its spaces
+SECTION_START = re.compile(re.escape(cleaned_filing.SECTION_MARKER_BYTES))
+
+def paragraph_hash(paragraph):
+    return int.from_bytes(hashlib.blake2b(paragraph, digest_size=8).digest(), 'little', signed=True)
+
+def split_paragraphs(content):
+    """Sentences and lines of the file's bytes, with their trailing spaces or line break, so b''.join gives the content back"""
+    cuts = {match.end() for match in PARAGRAPH_END.finditer(content)} | {match.start() for match in SECTION_START.finditer(content)}
+    cuts = sorted(cut for cut in cuts if 0 < cut < len(content))
+    return [content[start:end] for start, end in zip([0] + cuts, cuts + [len(content)])] if content else []
+
+class ParagraphStore:
+    """
+    Cleaned filings of one CIK
+    db_path: SQLite file, project_dir/paragraph-store/<CIK>.sqlite by default
+    """
+    def __init__(self, project_dir, cik, db_path=None):
+        store_dir = os.path.join(str(project_dir), PARAGRAPH_STORE_DIR)
+        os.makedirs(store_dir, exist_ok=True)
+        self.cik = str(cik)
+        self.conn = sqlite3.connect(db_path or os.path.join(store_dir, f'{self.cik}.sqlite'), timeout=120)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS blocks (block INTEGER PRIMARY KEY, text BLOB);
+            CREATE TABLE IF NOT EXISTS units (hash INTEGER PRIMARY KEY, block INTEGER, start INTEGER, length INTEGER);
+            CREATE TABLE IF NOT EXISTS filings (
+                accession TEXT PRIMARY KEY, path TEXT,
+                hashes BLOB, lengths BLOB,      -- int64 paragraph hashes and int32 byte lengths, in order
+                size INTEGER);
+        ''')
+        # Stores written before paragraphs were grouped into blocks keep them one by one in a paragraphs table
+        self.legacy = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'paragraphs'").fetchone() is not None
+
+    def close(self):
+        self.conn.close()
+
+    def accessions(self):
+        return [row[0] for row in self.conn.execute('SELECT accession FROM filings ORDER BY accession')]
+
+    def add_file(self, path, relative_path=None):
+        """Store a cleaned filing. Output: (paragraphs in the filing, paragraphs new to the dictionary)"""
+        with open(path, 'rb') as file:
+            content = file.read()
+        accession = json.loads(content.partition(b'\n')[0].decode('utf-8'))['edgar_accession']
+        paragraphs = split_paragraphs(content)
+        hashes = np.array([paragraph_hash(paragraph) for paragraph in paragraphs], dtype=np.int64)
+        lengths = np.array([len(paragraph) for paragraph in paragraphs], dtype=np.int32)
+        known = self.known_hashes(set(hashes.tolist()))
+        new = {}
+        for h, paragraph in zip(hashes.tolist(), paragraphs):
+            if h not in known and h not in new:
+                new[h] = paragraph
+        starts = np.cumsum([0] + [len(paragraph) for paragraph in new.values()])
+        with self.conn:
+            if new:
+                block = self.conn.execute('INSERT INTO blocks (text) VALUES (?)',
+                                          (zlib.compress(b''.join(new.values()), COMPRESSION_LEVEL),)).lastrowid
+                self.conn.executemany('INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?)',
+                                      [(h, block, int(start), len(paragraph)) for (h, paragraph), start in zip(new.items(), starts)])
+            self.conn.execute('INSERT OR REPLACE INTO filings VALUES (?, ?, ?, ?, ?)',
+                              (accession, relative_path or path, hashes.tobytes(), lengths.tobytes(), len(content)))
+        return len(paragraphs), len(new)
+
+    def known_hashes(self, hashes):
+        known = set()
+        hashes = list(hashes)
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            known.update(row[0] for row in self.conn.execute(
+                f'SELECT hash FROM units WHERE hash IN ({",".join("?" * len(chunk))})', chunk))
+        return known
+
+    def paragraph_sequence(self, accession):
+        """Output: (int64 array of paragraph hashes, int32 array of their lengths)"""
+        row = self.conn.execute('SELECT hashes, lengths FROM filings WHERE accession = ?', (accession,)).fetchone()
+        if row is None:
+            raise KeyError(f'{accession} is not in the paragraph store of CIK {self.cik}')
+        return np.frombuffer(row[0], dtype=np.int64), np.frombuffer(row[1], dtype=np.int32)
+
+    def paragraphs(self, hashes):
+        """Output: dict of hash -> paragraph bytes, decompressing each block they come from once"""
+        locations = {}
+        unique = list(set(int(h) for h in hashes))
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            for h, block, offset, length in self.conn.execute(
+                    f'SELECT hash, block, start, length FROM units WHERE hash IN ({",".join("?" * len(chunk))})', chunk):
+                locations[h] = (block, offset, length)
+        blocks = {}
+        needed = list(set(block for block, _, _ in locations.values()))
+        for start in range(0, len(needed), 500):
+            chunk = needed[start:start + 500]
+            for block, text in self.conn.execute(f'SELECT block, text FROM blocks WHERE block IN ({",".join("?" * len(chunk))})', chunk):
+                blocks[block] = zlib.decompress(text)
+        texts = {h: blocks[block][offset:offset + length] for h, (block, offset, length) in locations.items()}
+        missing = [h for h in unique if h not in texts] if self.legacy else []
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            for h, text in self.conn.execute(f'SELECT hash, text FROM paragraphs WHERE hash IN ({",".join("?" * len(chunk))})', chunk):
+                texts[h] = zlib.decompress(text)
+        return texts
+
+    def read_bytes(self, accession, start=0, stop=None):
+        """Bytes start:stop of a stored filing, decompressing only the paragraphs that overlap them"""
+        hashes, lengths = self.paragraph_sequence(accession)
+        ends = np.cumsum(lengths, dtype=np.int64)
+        if stop is None:
+            stop = int(ends[-1]) if len(ends) else 0
+        first = int(np.searchsorted(ends, start, side='right'))
+        last = int(np.searchsorted(ends, stop, side='left')) + 1
+        texts = self.paragraphs(hashes[first:last])
+        content = b''.join(texts[int(h)] for h in hashes[first:last])
+        offset = int(ends[first - 1]) if first > 0 else 0
+        return content[start - offset:stop - offset]
+
+    def read_filing(self, accession):
+        """Header dict and text of a stored filing, as cleaned_filing readers see the file"""
+        header_line, _, text = cleaned_filing.normalize_newlines(self.read_bytes(accession).decode('utf-8')).partition('\n')
+        return json.loads(header_line), text
+
+    def read_sections(self, accession, sections=None):
+        """Text of the requested sections, like cleaned_filing.read_sections, from the paragraphs they span"""
+        hashes, lengths = self.paragraph_sequence(accession)
+        header_line = self.read_bytes(accession, 0, int(lengths[0]) if len(lengths) else 0)
+        header = json.loads(header_line.decode('utf-8'))
+        offsets = header.get('sections')
+        if not isinstance(offsets, dict):
+            found = cleaned_filing.split_sections(self.read_filing(accession)[1])
+            return {name: text for name, text in found.items() if sections is None or name in sections}
+        body_start = len(header_line)
+        return {name: cleaned_filing.normalize_newlines(self.read_bytes(accession, body_start + offsets[name][0], body_start + offsets[name][1]).decode('utf-8'))
+                for name in (offsets if sections is None else sections) if name in offsets}
+
+    def restore(self, accession, path):
+        """Write a stored filing back to a cleaned file, byte for byte"""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(self.read_bytes(accession))
+        os.replace(temp_path, path)
+
+    def identical_paragraphs(self, accession, other_accession):
+        """
+        Paragraphs of a filing that appear word for word in another filing of the company
+        Output: (number of such paragraphs, their share of the filing's bytes)
+        """
+        hashes, lengths = self.paragraph_sequence(accession)
+        other, _ = self.paragraph_sequence(other_accession)
+        shared = np.isin(hashes, other)
+        return int(shared.sum()), float(lengths[shared].sum() / lengths.sum()) if lengths.sum() else float('nan')
+
+    def storage(self):
+        """Output: (bytes of the stored filings, bytes of the SQLite file holding them)"""
+        filings = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM filings').fetchone()[0]
+        pages = self.conn.execute('PRAGMA page_count').fetchone()[0] - self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return filings, pages * self.conn.execute('PRAGMA page_size').fetchone()[0]
+
+def store_all_filings(project_dir):
+    """Add every catalogued cleaned filing not yet stored to its CIK's store. Output: (original bytes, stored bytes)"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    df_filings = catalog.filings()
+    catalog.close()
+    total, stored = 0, 0
+    for cik, df_cik in df_filings.groupby('cik'):
+        store = ParagraphStore(project_dir, cik)
+        done = set(store.accessions())
+        for accession, path in df_cik[['accession', 'path']].itertuples(index=False):
+            if accession in done:
+                continue
+            try:
+                store.add_file(os.path.join(project_dir, path), path)
+            except Exception as e:
+                print('Exception storing {}: {}'.format(path, e))
+        cik_total, cik_stored = store.storage()
+        total += cik_total
+        stored += cik_stored
+        store.close()
+    return total, stored
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    total, stored = store_all_filings(project_dir)
+    print(f'{total / 1e6:.1f} MB of cleaned filings held in {stored / 1e6:.1f} MB of paragraphs ({total / max(stored, 1):.1f}x)')
@@ -0,0 +1,96 @@
+#
+#   Adaptive routing between the filing parsers.
+#
+#       clean_and_filter_data.clean_filing locates each "Item" heading with regexes, while Parse_10Q_by_index.clean_filing
+#       maps sections from the hyperlinked table of contents. Some filers consistently fail one strategy and succeed with
+#       the other, so running the wrong one first wastes a full parse on every filing. Keep per-CIK statistics of which
+#       strategy succeeded on recent filings, and how fast, and try the historically best strategy first. A small
+#       exploration rate occasionally tries another strategy first so routing adapts when a filer changes its layout.
+
+import os
+import re
+import json
+import time
+import random
+import threading
+
+ROUTER_HISTORY = 8          # Number of recent outcomes kept per CIK and strategy
+ROUTER_EXPLORE_RATE = 0.1   # Fraction of filings routed to a non-preferred strategy first
+ROUTER_STATS_FILE = 'parser_stats.json'
+
+def read_cik(input_filename, max_bytes=8192):
+    """Read the CIK from the SEC header at the top of a raw filing, without loading the whole file"""
+    with open(input_filename, 'r', encoding='utf-8', errors='ignore') as f:
+        header = f.read(max_bytes)
+    match = re.search(r'(?:CENTRAL INDEX KEY:\s+)(\d+)', header, re.IGNORECASE)
+    return match[1] if match else None
+
+class ParserRouter:
+    """
+    Keeps a rolling history of (success, seconds) outcomes for each CIK and parsing strategy
+    stats_path: JSON file used to persist the statistics between runs
+    history: number of recent outcomes kept per CIK and strategy
+    explore_rate: probability of trying a non-preferred strategy first
+    """
+    def __init__(self, stats_path, history=ROUTER_HISTORY, explore_rate=ROUTER_EXPLORE_RATE, seed=None):
+        self.stats_path = stats_path
+        self.history = history
+        self.explore_rate = explore_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()     # The streaming pipeline routes filings from several threads
+        self.stats = {}
+        if os.path.exists(stats_path):
+            with open(stats_path, 'r', encoding='utf-8') as f:
+                self.stats = json.load(f)
+
+    def score(self, cik, strategy):
+        """Return (success rate, mean seconds) for a strategy. Unseen strategies get an uninformed prior of 0.5"""
+        outcomes = self.stats.get(cik, {}).get(strategy, [])
+        successes = sum(1 for success, seconds in outcomes if success)
+        success_rate = (successes + 1) / (len(outcomes) + 2)    # Laplace smoothing
+        timings = [seconds for success, seconds in outcomes if success]
+        mean_seconds = sum(timings) / len(timings) if timings else float('inf')
+        return success_rate, mean_seconds
+
+    def order(self, cik, strategies):
+        """Order strategies best first: highest success rate, then fastest. Ties keep the default order"""
+        ranked = sorted(strategies, key=lambda s: (-self.score(cik, s)[0], self.score(cik, s)[1]))
+        if len(ranked) > 1 and self.random.random() < self.explore_rate:
+            explore = self.random.choice(ranked[1:])
+            ranked.remove(explore)
+            ranked.insert(0, explore)
+        return ranked
+
+    def record(self, cik, strategy, success, seconds):
+        outcomes = self.stats.setdefault(cik, {}).setdefault(strategy, [])
+        outcomes.append([bool(success), round(seconds, 4)])
+        del outcomes[:-self.history]
+
+    def run(self, cik, attempts):
+        """
+        Try each parsing strategy in routed order until one succeeds
+        cik: CIK of the filer, or None if it could not be read
+        attempts: dict of strategy name -> callable returning True on success
+        Output: name of the successful strategy, or None if all of them failed
+        """
+        with self.lock:
+            strategies = self.order(cik, list(attempts))
+        for strategy in strategies:
+            start = time.perf_counter()
+            try:
+                success = attempts[strategy]()
+            except Exception as e:
+                print(f'Parser {strategy} raised: {e}')
+                success = False
+            if cik:
+                with self.lock:
+                    self.record(cik, strategy, success, time.perf_counter() - start)
+            if success:
+                return strategy
+        return None
+
+    def save(self):
+        temp_path = self.stats_path + '.tmp'
+        with self.lock, open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.stats, f)
+        os.replace(temp_path, self.stats_path)
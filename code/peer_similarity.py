@@ -0,0 +1,144 @@
+#
+#   Cross-sectional peer similarity within industry groups.
+#
+#       For every SIC group and period, each filing's section is compared with the same section of every other filer
+#       in the group: how much does a company's Item 1A resemble its industry peers' this quarter. Rows come from the
+#       token cache, are L2-normalized, and the group's cosine matrix is computed in row blocks (block @ group.T), so
+#       at most PEER_BLOCK_ELEMENTS similarities are held in memory whatever the size of the group. Each block is
+#       reduced to the top-k peers and the mean peer similarity before the next one is computed.
+
+import os
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+import ProjectDirectory as directory
+import calc_doc_similarity as similarity
+import filing_catalog
+
+PEER_SIC_FILE = 'market_cap_GT_1B.csv'  # Under project_dir/data, e.g. 'cik_ticker_list.csv' for every filer
+SIC_DIGITS = 4              # 2 or 3 to group by major group or industry group instead of industry
+PEER_TOP_K = 5
+PEER_BLOCK_ELEMENTS = 2 ** 24   # Largest block of the similarity matrix held at once (float64: 128 MB)
+PEER_SECTIONS = {
+    '10-K': ['item 1', 'item 1a', 'item 7'],
+    '10-Q': ['item 2', 'item 21a']
+}
+PEER_FILES = {'10-K': 'peer_similarity_10-K.csv', '10-Q': 'peer_similarity_10-Q.csv'}  # Under project_dir/data
+
+def load_sic_groups(project_dir, sic_file=PEER_SIC_FILE, digits=SIC_DIGITS):
+    """Output: dict of CIK (string, no leading zeros) -> SIC group, for filers with a SIC code"""
+    df_cik = pd.read_csv(os.path.join(project_dir, 'data', sic_file), dtype={'CIK': str, 'SIC': str})
+    df_cik = df_cik.dropna(subset=['CIK', 'SIC'])
+    return dict(zip(df_cik['CIK'].str.lstrip('0'), df_cik['SIC'].str.zfill(4).str[:digits]))
+
+def list_periods(project_dir, forms):
+    """Output: dict of (form, fiscal period) -> list of (company, path of the cleaned filing), from the filing catalog"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    periods = {}
+    for form in forms:
+        for company, period, path in catalog.filings(form)[['company', 'fiscal_period', 'path']].itertuples(index=False):
+            periods.setdefault((form, period), []).append((company, os.path.join(project_dir, path)))
+    catalog.close()
+    return periods
+
+def read_section_rows(task, project_dir, sections):
+    """
+    Worker: count rows of the wanted sections of one filing, from the token cache
+    Output: (company, CIK, accession, dict of section -> 1 x n_features sparse row), or None if it cannot be read
+    """
+    company, path = task
+    try:
+        filing = similarity.get_token_cache(project_dir).load(path)
+    except Exception as e:
+        print('Exception reading {}: {}'.format(path, e))
+        return None
+    rows = {section: filing.counts[filing.section_row(section)] for section in sections if section in filing.sections}
+    return company, str(filing.header.get('CIK', '')).lstrip('0'), filing.header.get('edgar_accession'), rows
+
+def peer_scores(X, top_k=PEER_TOP_K, block_elements=PEER_BLOCK_ELEMENTS):
+    """
+    All-pairs cosine of the rows of X, one block of rows at a time
+    Output: (indices of the top_k peers of each row, their similarities, mean similarity to all peers), -1 / NaN where
+            there are fewer peers. Empty rows have no similarity to anyone
+    """
+    n = X.shape[0]
+    k = min(top_k, n - 1)
+    Xn = normalize(sp.csr_matrix(X), norm='l2', axis=1)
+    empty = np.diff(Xn.indptr) == 0
+    XnT = Xn.T.tocsc()
+    top_index = np.full((n, top_k), -1, dtype=np.int64)
+    top_similarity = np.full((n, top_k), np.nan)
+    mean_similarity = np.full(n, np.nan)
+    block = max(1, block_elements // max(n, 1))
+    for start in range(0, n, block):
+        stop = min(n, start + block)
+        S = (Xn[start:stop] @ XnT).toarray()
+        S[:, empty] = np.nan
+        S[empty[start:stop]] = np.nan
+        S[np.arange(stop - start), np.arange(start, stop)] = np.nan     # A filing is not its own peer
+        peers = np.sum(~np.isnan(S), axis=1)
+        with np.errstate(invalid='ignore'):
+            mean_similarity[start:stop] = np.where(peers > 0, np.nansum(S, axis=1) / np.maximum(peers, 1), np.nan)
+        if k > 0:
+            ranked = np.where(np.isnan(S), -np.inf, S)
+            candidates = np.argpartition(-ranked, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(ranked, candidates, axis=1), axis=1)
+            best = np.take_along_axis(candidates, order, axis=1)
+            best_similarity = np.take_along_axis(ranked, best, axis=1)
+            valid = np.isfinite(best_similarity)
+            top_index[start:stop, :k] = np.where(valid, best, -1)
+            top_similarity[start:stop, :k] = np.where(valid, best_similarity, np.nan)
+    return top_index, top_similarity, mean_similarity
+
+def peer_similarity(project_dir, forms=('10-K', '10-Q'), top_k=PEER_TOP_K, workers=similarity.SIMILARITY_WORKERS):
+    """
+    Output: dict of form -> dataframe with one row per filing and section: SIC group, number of peers, mean peer
+            similarity and the top_k peers with their similarities
+    """
+    sic_groups = load_sic_groups(project_dir)
+    periods = list_periods(project_dir, forms)
+    records = {form: [] for form in forms}
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for (form, period), filings in sorted(periods.items()):
+            read_filing = functools.partial(read_section_rows, project_dir=project_dir, sections=PEER_SECTIONS[form])
+            results = pool.imap(read_filing, filings, chunksize=8) if pool else map(read_filing, filings)
+
+            # Section rows of the period by SIC group
+            groups = {}
+            for result in results:
+                if result is None or result[1] not in sic_groups:
+                    continue
+                company, cik, accession, rows = result
+                for section, row in rows.items():
+                    groups.setdefault((sic_groups[cik], section), []).append((company, cik, accession, row))
+
+            for (sic, section), members in sorted(groups.items()):
+                if len(members) < 2:
+                    continue
+                X = sp.vstack([row for _, _, _, row in members], format='csr')
+                top_index, top_similarity, mean_similarity = peer_scores(X, top_k)
+                for i, (company, cik, accession, _) in enumerate(members):
+                    record = {'company': company, 'CIK': cik, 'accession': accession, 'SIC': sic, 'period': period,
+                              'section': section, 'n_peers': len(members) - 1, 'mean_peer_similarity': mean_similarity[i]}
+                    for rank in range(top_k):
+                        peer = top_index[i, rank]
+                        record[f'peer_{rank + 1}'] = members[peer][0] if peer >= 0 else None
+                        record[f'peer_{rank + 1}_similarity'] = top_similarity[i, rank]
+                    records[form].append(record)
+            print(f'Peer similarity {form} {period}: {len(filings)} filings, {len(groups)} SIC group sections')
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return {form: pd.DataFrame(records[form]) for form in forms}
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    df_results = peer_similarity(project_dir)
+    for form, df_peers in df_results.items():
+        df_peers.to_csv(os.path.join(project_dir, 'data', PEER_FILES[form]), encoding='utf-8', index=False)
@@ -0,0 +1,644 @@
+#
+#   Resumable pipeline of the filing stages.
+#
+#       Runs index sync -> download -> clean -> organize (rename 10-Qs, move to cleaned_filings) -> similarity as a
+#       DAG of stages, configured from a JSON file and the command line instead of the scripts' module flags, e.g.
+#
+#           python pipeline.py --config pipeline.json --stages clean organize --forms 10-Q
+#
+#       Every stage records the items it has processed (a filing, or a form for the similarity jobs) in
+#       data/pipeline_state.sqlite, with a signature of its input: size and modification time of a raw filing and the
+#       stage's configuration, or the catalogued filings of a form. A rerun only processes items whose signature has
+#       changed, so an interrupted run picks up where it stopped, and a run after new filings arrive only downloads,
+#       cleans and scores those. Failed items are not retried until their input changes, or with --retry-failed.
+#       All paths are absolute: the working directory is never changed.
+#
+#       With --stream the download, clean, organize and scoring stages run at the same time, joined by bounded queues:
+#       each filing is cleaned as soon as it is downloaded and scored as soon as its comparison filing is catalogued,
+#       rather than after the whole stage before it has finished. The queue depths are printed and written to
+#       data/pipeline_stream_status.json every status_seconds.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import threading
+import queue
+import ProjectDirectory as directory
+import get_sec_filings_df as sec_filings
+import clean_and_filter_data as cleaner
+import filing_catalog
+import parser_router
+import calc_doc_similarity as similarity
+import similarity_panel
+import similarity_matrix
+import results_store
+import cleaned_filing
+import instrumentation
+
+STATE_DB = 'pipeline_state.sqlite'  # Under project_dir/data
+STREAM_STATUS_FILE = 'pipeline_stream_status.json'     # Under project_dir/data, queue depths of a running --stream
+
+# Stage -> stages it depends on
+STAGES = {
+    'index': [],
+    'download': ['index'],
+    'clean': ['download'],
+    'organize': ['clean'],
+    'similarity': ['organize'],
+}
+
+DEFAULT_CONFIG = {
+    'stages': list(STAGES),
+    'forms': ['10-K', '10-Q'],
+    'companies': None,              # Company name substrings to limit download, clean and organize to. None for all
+    'index_since_year': None,       # Download the EDGAR index from this year on. None to use the index files present
+    'cik_file': sec_filings.CIK_FILE,
+    'from_date': sec_filings.FROM_DATE,
+    'download_from_edgar': True,    # Else move the filings from the sec-utils download directories
+    'adaptive_routing': True,       # Route each filing to the parser that works best for its CIK, else regex cleaner only
+    'similarity_jobs': ['latest', 'panel'],     # calc_doc_similarity on the latest pairs, similarity_panel on every pair
+    'write_results_csv': True,
+    'workers': similarity.SIMILARITY_WORKERS,
+    'instrument': False,            # Log step timings and peak memory of every filing to data/instrumentation.jsonl
+    'stream_queue_size': 32,        # --stream: filings a stage's queue holds before the stage feeding it waits
+    'download_threads': 4,          # --stream: concurrent downloads
+    'clean_threads': os.cpu_count(),    # --stream: filings cleaned at a time, each in its own process (FILING_TIME_BUDGET)
+    'score_batch': 50,              # --stream: most cleaned filings whose pairs are scored and committed together
+    'status_seconds': 30,           # --stream: seconds between queue depth reports
+}
+
+# Configuration each stage's signatures depend on: changing it makes the stage's items out of date
+STAGE_CONFIG = {
+    'download': ['download_from_edgar'],
+    'clean': ['adaptive_routing'],
+    'similarity': ['write_results_csv'],
+}
+
+class PipelineState:
+    """
+    Items each stage has processed, with the signature of their input when they were
+    db_path: SQLite file, project_dir/data/pipeline_state.sqlite by default
+    """
+    def __init__(self, project_dir, db_path=None):
+        self.conn = sqlite3.connect(db_path or os.path.join(str(project_dir), 'data', STATE_DB), timeout=120)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS stage_state (
+                stage TEXT, item TEXT, signature TEXT, finished TEXT, ok INTEGER,
+                PRIMARY KEY (stage, item)) WITHOUT ROWID;
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def recorded(self, stage):
+        """Output: dict of item -> (signature, ok) of the stage"""
+        return {item: (signature, bool(ok)) for item, signature, ok in
+                self.conn.execute('SELECT item, signature, ok FROM stage_state WHERE stage = ?', (stage,))}
+
+    def record(self, stage, item, signature, ok):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO stage_state VALUES (?, ?, ?, ?, ?)',
+                              (stage, item, signature, datetime.datetime.now().isoformat(timespec='seconds'), int(ok)))
+
+    def summary(self):
+        """Output: list of (stage, items done, items failed, last finished)"""
+        return self.conn.execute('''SELECT stage, SUM(ok), SUM(1 - ok), MAX(finished) FROM stage_state GROUP BY stage''').fetchall()
+
+def config_digest(config, stage):
+    return hashlib.sha1(json.dumps([config[key] for key in STAGE_CONFIG.get(stage, [])]).encode('utf-8')).hexdigest()[:12]
+
+def file_signature(path, digest):
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}:{digest}'
+
+def stage_order(stages):
+    """The given stages in dependency order"""
+    ordered = []
+    def visit(stage):
+        for dependency in STAGES[stage]:
+            visit(dependency)
+        if stage not in ordered:
+            ordered.append(stage)
+    for stage in STAGES:
+        visit(stage)
+    return [stage for stage in ordered if stage in stages]
+
+def upstream(stage):
+    """The stage and every stage it depends on"""
+    return {stage}.union(*[upstream(dependency) for dependency in STAGES[stage]])
+
+def out_of_date(recorded, item, signature, force=False, retry_failed=False):
+    """recorded: PipelineState.recorded of the item's stage"""
+    previous = recorded.get(item)
+    return force or previous is None or previous[0] != signature or (not previous[1] and retry_failed)
+
+def run_items(state, stage, items, work, force=False, retry_failed=False):
+    """
+    Process the items of a stage that are out of date and record them
+    items: list of (item, signature); an item is up to date if it was recorded with the same signature
+    work: function of an item, True if it succeeded
+    Output: (items processed, items failed)
+    """
+    recorded = state.recorded(stage)
+    processed, failed = 0, 0
+    for item, signature in items:
+        if not out_of_date(recorded, item, signature, force, retry_failed):
+            continue
+        try:
+            ok = bool(work(item))
+        except Exception as e:
+            print('Exception in {} of {}: {}'.format(stage, item, e))
+            ok = False
+        state.record(stage, item, signature, ok)
+        processed += 1
+        failed += not ok
+    return processed, failed
+
+def company_dirs(project_dir, config):
+    """Company directories under sec-filings-downloaded, limited to config['companies']"""
+    downloaded_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    companies = config['companies']
+    return [os.path.join(downloaded_dir, company) for company in sorted(os.listdir(downloaded_dir))
+            if os.path.isdir(os.path.join(downloaded_dir, company))
+            and company not in ['10-K', '10-Q']     # sec-utils download directories
+            and (not companies or any(name in company for name in companies))]
+
+def wanted_form(file, config):
+    return any(file.endswith(form) for form in config['forms'])
+
+def relative(project_dir, path):
+    return os.path.relpath(path, project_dir)
+
+def run_index(project_dir, config, state, force=False, retry_failed=False):
+    """Download the EDGAR index files, at most once a day"""
+    if config['index_since_year'] is None:
+        print('No index_since_year configured, using the index files present')
+        return 0, 0
+    signature = f'{config["index_since_year"]}:{datetime.date.today().isoformat()}'
+    sync = lambda item: sec_filings.sync_index(project_dir, config['index_since_year']) or True
+    return run_items(state, 'index', [('index', signature)], sync, force, retry_failed)
+
+def download_items(project_dir, config):
+    """
+    Filings of the index selected by the config that are not in their company directory yet
+    Output: (dict of item -> index row, list of (item, signature))
+    """
+    df_index = sec_filings.load_index(project_dir)
+    df_filings = sec_filings.select_filings(df_index, sec_filings.load_cik_list(project_dir, config['cik_file']), config['from_date'])
+    df_filings = df_filings[df_filings['filing_type'].isin(config['forms'])]
+    if config['companies']:
+        df_filings = df_filings[df_filings['company_name'].map(lambda company: any(name in company for name in config['companies']))]
+
+    sec_filings_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    digest = config_digest(config, 'download')
+    rows, items = {}, []
+    for row in df_filings.to_dict('records'):
+        path = os.path.join(sec_filings_dir, row['company_name'], sec_filings.filing_name(row))
+        if os.path.isfile(path):
+            continue
+        item = relative(project_dir, path)
+        rows[item] = row
+        items.append((item, f'{row["url"]}:{digest}'))
+    return rows, items
+
+def run_download(project_dir, config, state, force=False, retry_failed=False):
+    """Download the selected filings of the index that are not in their company directory yet"""
+    sec_filings_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    rows, items = download_items(project_dir, config)
+    download = lambda item: sec_filings.download_filing(sec_filings_dir, rows[item], config['download_from_edgar'])
+    return run_items(state, 'download', items, download, force, retry_failed)
+
+def cleaned_outputs(company_dir, file):
+    """Where the cleaned file of a raw filing can be: next to it, or renamed and moved by the organize stage"""
+    cleaned_file = 'cleaned_' + file
+    outputs = [os.path.join(company_dir, cleaned_file), os.path.join(company_dir, 'cleaned_filings', cleaned_file)]
+    quarter_file = cleaner.quarter_filename(cleaned_file)
+    if quarter_file:
+        outputs.append(os.path.join(company_dir, 'cleaned_filings', quarter_file))
+    return outputs
+
+def clean_items(project_dir, config, state, force=False):
+    """
+    Raw filings in the company directories, with their signatures. Filings cleaned before the pipeline kept state
+    are recorded as up to date rather than listed
+    Output: (dict of item -> (company directory, file), list of (item, signature))
+    """
+    digest = config_digest(config, 'clean')
+    recorded = state.recorded('clean')
+    files, items = {}, []
+    for company_dir in company_dirs(project_dir, config):
+        for file in sorted(os.listdir(company_dir)):
+            path = os.path.join(company_dir, file)
+            if 'cleaned' in file or file.startswith('error_') or not wanted_form(file, config) or not os.path.isfile(path):
+                continue
+            item = relative(project_dir, path)
+            signature = file_signature(path, digest)
+            # Filings cleaned before the pipeline kept state are taken as up to date
+            if item not in recorded and not force and any(os.path.exists(output) for output in cleaned_outputs(company_dir, file)):
+                state.record('clean', item, signature, True)
+                continue
+            files[item] = (company_dir, file)
+            items.append((item, signature))
+    return files, items
+
+def make_router(project_dir, config):
+    """Parser router of the clean stage, None when adaptive routing is off"""
+    if not config['adaptive_routing']:
+        return None
+    return parser_router.ParserRouter(os.path.join(project_dir, 'data', parser_router.ROUTER_STATS_FILE))
+
+def run_clean(project_dir, config, state, force=False, retry_failed=False):
+    """Clean the raw filings that are new or changed since they were cleaned"""
+    files, items = clean_items(project_dir, config, state, force)
+    router = make_router(project_dir, config)
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    def clean(item):
+        company_dir, file = files[item]
+        cleaned = cleaner.clean_company_filing(company_dir, file, router, catalog)
+        if router is not None:
+            router.save()
+        return cleaned
+    try:
+        return run_items(state, 'clean', items, clean, force, retry_failed)
+    finally:
+        catalog.close()
+
+def organize_filing(company_dir, file, catalog):
+    """Rename a cleaned 10-Q with its quarter and move it to cleaned_filings. Output: its new path, None if not moved"""
+    file = cleaner.rename_10_Q_filing(company_dir, file, catalog) or file
+    if not cleaner.move_to_cleaned_folder(company_dir, file, catalog):
+        return None
+    return os.path.join(company_dir, 'cleaned_filings', file)
+
+def run_organize(project_dir, config, state, force=False, retry_failed=False):
+    """Rename the cleaned 10-Qs with their quarter and move every cleaned filing to its cleaned_filings folder"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    files, items = {}, []
+    for company_dir in company_dirs(project_dir, config):
+        for file in sorted(os.listdir(company_dir)):
+            path = os.path.join(company_dir, file)
+            if file.startswith('cleaned_') and wanted_form(file, config) and os.path.isfile(path):
+                item = relative(project_dir, path)
+                files[item] = (company_dir, file)
+                items.append((item, file_signature(path, '')))
+    organize = lambda item: organize_filing(*files[item], catalog)
+    try:
+        # A cleaned file left in the company directory always needs organizing, whatever was recorded
+        return run_items(state, 'organize', items, organize, True, retry_failed)
+    finally:
+        catalog.close()
+
+def catalog_signature(project_dir, form, config):
+    """Digest of the catalogued filings of a form, which changes when a filing is added, cleaned again or moved"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    df_filings = catalog.filings(form)
+    catalog.close()
+    filings = sorted(zip(df_filings['accession'], df_filings['path'], df_filings['sections'].map(json.dumps)))
+    return hashlib.sha1(json.dumps(filings).encode('utf-8')).hexdigest()[:16] + ':' + config_digest(config, 'similarity')
+
+def run_similarity(project_dir, config, state, force=False, retry_failed=False):
+    """Score the latest pairs and the panel of each form whose catalogued filings changed since they were scored"""
+    items = [(f'{job}:{form}', catalog_signature(project_dir, form, config))
+             for job in config['similarity_jobs'] for form in config['forms']]
+    results_files = {'10-K': 'ten_k_results.csv', '10-Q': 'ten_q_results.csv'}
+    def score(item):
+        job, form = item.split(':')
+        if job == 'panel':
+            similarity_panel.update_panels(project_dir, form == '10-K', form == '10-Q', config['workers'])
+        else:
+            df_results = similarity.calc_all_similarities(project_dir, config['workers'], form == '10-K', form == '10-Q')
+            if config['write_results_csv']:
+                df_results[form].to_csv(os.path.join(project_dir, 'data', results_files[form]), encoding='utf-8', index=False)
+        # Pair failures are caught per company, so the item only succeeded if every pair has a checkpoint
+        unstored = similarity.unstored_pairs(project_dir, [form], latest_only=job != 'panel')
+        if unstored:
+            print(f'{item}: {len(unstored)} pairs not scored')
+        return not unstored
+    return run_items(state, 'similarity', items, score, force, retry_failed)
+
+class StreamStatus:
+    """Queues of a streaming run and what each stage has done, reported every status_seconds"""
+    def __init__(self, queues, path):
+        self.queues = queues
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = {stage: [0, 0] for stage in ['download', 'clean', 'organize', 'score']}
+        self.start = time.time()
+
+    def count(self, stage, ok, n=1):
+        with self.lock:
+            self.counts[stage][0] += n
+            self.counts[stage][1] += (not ok) * n
+
+    def snapshot(self):
+        with self.lock:
+            return {'elapsed': round(time.time() - self.start), 'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'queues': {name: {'depth': q.qsize(), 'size': q.maxsize} for name, q in self.queues.items()},
+                    'processed': {stage: done for stage, (done, _) in self.counts.items()},
+                    'failed': {stage: failed for stage, (_, failed) in self.counts.items()}}
+
+    def report(self):
+        status = self.snapshot()
+        queues = ', '.join(f'{name} {depth["depth"]}/{depth["size"]}' for name, depth in status['queues'].items())
+        done = ', '.join(f'{stage} {n} ({status["failed"][stage]} failed)' for stage, n in status['processed'].items())
+        print(f'Stream {status["elapsed"]}s: queues {queues} | {done}')
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(status, file)
+        os.replace(temp_path, self.path)
+
+    def monitor(self, stop, interval):
+        while not stop.wait(interval):
+            self.report()
+
+# Marks the end of a stream queue, one per consumer thread
+END = None
+
+def stream_download(project_dir, config, status, rows, downloads, cleans, force, retry_failed):
+    """Thread: download the filings queued by the feeder and queue them for cleaning as each one lands"""
+    state = PipelineState(project_dir)
+    sec_filings_dir = os.path.join(project_dir, 'sec-filings-downloaded')
+    digest = config_digest(config, 'clean')
+    try:
+        while True:
+            task = downloads.get()
+            if task is END:
+                return
+            item, signature = task
+            try:
+                path = sec_filings.download_filing(sec_filings_dir, rows[item], config['download_from_edgar'])
+            except Exception as e:
+                print('Exception in download of {}: {}'.format(item, e))
+                path = None
+            state.record('download', item, signature, bool(path))
+            status.count('download', bool(path))
+            if path and 'clean' in config['stages']:
+                cleans.put((relative(project_dir, path), file_signature(path, digest), os.path.dirname(path), os.path.basename(path)))
+    finally:
+        state.close()
+
+def stream_clean(project_dir, config, status, router, cleans, scores):
+    """Thread: clean the queued raw filings, organize them, and queue the cleaned files for scoring"""
+    state = PipelineState(project_dir)
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    try:
+        while True:
+            task = cleans.get()
+            if task is END:
+                return
+            item, signature, company_dir, file = task
+            try:
+                cleaned = cleaner.clean_company_filing(company_dir, file, router, catalog)
+            except Exception as e:
+                print('Exception in clean of {}: {}'.format(item, e))
+                cleaned = False
+            state.record('clean', item, signature, cleaned)
+            status.count('clean', cleaned)
+            if not cleaned:
+                continue
+
+            path = os.path.join(company_dir, 'cleaned_' + file)
+            if 'organize' in config['stages']:
+                organized_item = relative(project_dir, path)
+                organized_signature = file_signature(path, '')
+                try:
+                    path = organize_filing(company_dir, 'cleaned_' + file, catalog) or path
+                    organized = True
+                except Exception as e:
+                    print('Exception in organize of {}: {}'.format(organized_item, e))
+                    organized = False
+                state.record('organize', organized_item, organized_signature, organized)
+                status.count('organize', organized)
+            if 'similarity' in config['stages']:
+                scores.put(path)
+    finally:
+        catalog.close()
+        state.close()
+
+def new_filing_pairs(catalog, paths, done):
+    """
+    Catalogued pairs in which any of the cleaned files is the latest or the previous filing, so a filing is scored
+    against the year-earlier one and, if it arrived late, against the year-later one
+    done: set of pair keys already stored, which are left out
+    Output: list of (company, list of pair dicts with their form), as calc_doc_similarity.catalog_pair_tasks
+    """
+    new = {}
+    for path in paths:
+        header, _ = cleaned_filing.read_header(path)
+        filing = catalog.conn.execute('SELECT company, form FROM filings WHERE accession = ?', (header['edgar_accession'],)).fetchone()
+        if filing:
+            new.setdefault(filing, set()).add(header['edgar_accession'])
+    tasks = {}
+    for (company, form), accessions in new.items():
+        df_pairs = catalog.pairs(form, company)
+        df_pairs['form'] = form
+        for pair in df_pairs.to_dict('records'):
+            if (pair['latest_accession'] in accessions or pair['previous_accession'] in accessions) and similarity.pair_key(pair) not in done:
+                tasks.setdefault(company, []).append(pair)
+    return sorted(tasks.items())
+
+def stream_score(project_dir, config, status, scores):
+    """
+    Thread: score the pairs of the cleaned filings as they arrive, up to score_batch filings at a time, and commit
+    them to the results store with their checkpoints
+    """
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    store = results_store.ResultsStore(project_dir)
+    done = store.completed_pairs()
+    finished = False
+    try:
+        while not finished:
+            paths = [scores.get()]
+            while len(paths) < config['score_batch']:
+                try:
+                    paths.append(scores.get_nowait())
+                except queue.Empty:
+                    break
+            finished = END in paths
+            paths = [path for path in paths if path is not END]
+            if not paths:
+                continue
+            try:
+                tasks = new_filing_pairs(catalog, paths, done)
+                corpus = similarity_matrix.CorpusMatrix(None)
+                batch = []
+                for task in tasks:
+                    batch.extend(similarity_panel.add_company_panel(corpus, similarity_panel.process_company_panel(task, project_dir)))
+                stored = similarity.store_batch(store, corpus, batch)
+                done.update(similarity.result_key(result_dict) for _, result_dict, _ in batch)
+                # Pairs whose filings could not be read come back without a pending result
+                attempted = sum(len(pairs) for _, pairs in tasks)
+                status.count('score', True, stored)
+                status.count('score', False, attempted - stored)
+            except Exception as e:
+                print('Exception scoring {} cleaned filings: {}'.format(len(paths), e))
+                status.count('score', False, len(paths))
+    finally:
+        store.close()
+        catalog.close()
+
+def stream_pipeline(project_dir, config, force=(), retry_failed=False):
+    """
+    Run download, clean, organize and scoring concurrently, each filing moving on as soon as its stage is done,
+    instead of stage after stage. Stages are joined by bounded queues: a stage that falls behind fills its queue
+    and the stages feeding it wait, so memory stays bounded. A cleaned filing is scored as soon as the filing it is
+    compared with is catalogued. Items are recorded in the pipeline state as in a batch run, so either kind of run
+    resumes the other. The index stage runs first, and the similarity stage last to write the panels and CSVs from
+    the stored results.
+    Output: dict of stage -> (items processed, items failed)
+    """
+    state = PipelineState(project_dir)
+    counts = {}
+    if 'index' in config['stages']:
+        counts['index'] = run_index(project_dir, config, state, 'index' in force, retry_failed)
+
+    size = config['stream_queue_size']
+    downloads, cleans, scores = queue.Queue(size), queue.Queue(size), queue.Queue(size)
+    status = StreamStatus({'download': downloads, 'clean': cleans, 'score': scores}, os.path.join(project_dir, 'data', STREAM_STATUS_FILE))
+    router = make_router(project_dir, config)   # Shared by the cleaning threads, saved at the end
+
+    rows, download_list = download_items(project_dir, config) if 'download' in config['stages'] else ({}, [])
+    files, clean_list = clean_items(project_dir, config, state, 'clean' in force) if 'clean' in config['stages'] else ({}, [])
+    recorded_downloads, recorded_cleans = state.recorded('download'), state.recorded('clean')
+    state.close()
+
+    def feed():
+        # Filings already downloaded go first, so cleaning starts at once
+        for item, signature in clean_list:
+            if out_of_date(recorded_cleans, item, signature, 'clean' in force, retry_failed):
+                cleans.put((item, signature) + files[item])
+        for item, signature in download_list:
+            if out_of_date(recorded_downloads, item, signature, 'download' in force, retry_failed):
+                downloads.put((item, signature))
+
+    start_thread = lambda target, *args: threading.Thread(target=target, args=args, daemon=True)
+    feeder = start_thread(feed)
+    downloaders = [start_thread(stream_download, project_dir, config, status, rows, downloads, cleans, force, retry_failed)
+                   for _ in range(config['download_threads'])]
+    cleaners = [start_thread(stream_clean, project_dir, config, status, router, cleans, scores)
+                for _ in range(config['clean_threads'])]
+    scorer = start_thread(stream_score, project_dir, config, status, scores)
+    stop = threading.Event()
+    monitor = start_thread(status.monitor, stop, config['status_seconds'])
+    for thread in [feeder, monitor, scorer] + downloaders + cleaners:
+        thread.start()
+
+    # Each stage ends once the stages feeding it have, one END per consumer
+    feeder.join()
+    for _ in downloaders:
+        downloads.put(END)
+    for thread in downloaders:
+        thread.join()
+    for _ in cleaners:
+        cleans.put(END)
+    for thread in cleaners:
+        thread.join()
+    scores.put(END)
+    scorer.join()
+    stop.set()
+    monitor.join()
+    status.report()
+    if router is not None:
+        router.save()
+
+    counts.update({stage: tuple(status.counts[stage]) for stage in ['download', 'clean', 'organize', 'score']})
+    if 'similarity' in config['stages']:
+        state = PipelineState(project_dir)
+        try:
+            counts['similarity'] = run_similarity(project_dir, config, state, 'similarity' in force, retry_failed)
+        finally:
+            state.close()
+    return counts
+
+STAGE_RUNNERS = {
+    'index': run_index,
+    'download': run_download,
+    'clean': run_clean,
+    'organize': run_organize,
+    'similarity': run_similarity,
+}
+
+def run_pipeline(project_dir, config, force=(), retry_failed=False):
+    """
+    Run the configured stages in dependency order
+    force: stages whose items are processed again even if up to date
+    Output: dict of stage -> (items processed, items failed)
+    """
+    state = PipelineState(project_dir)
+    counts = {}
+    try:
+        for stage in stage_order(config['stages']):
+            print(f'*** {stage} ***')
+            started = time.time()
+            counts[stage] = STAGE_RUNNERS[stage](project_dir, config, state, stage in force, retry_failed)
+            print(f'{stage}: {counts[stage][0]} items processed, {counts[stage][1]} failed, {time.time() - started:.0f}s')
+    finally:
+        state.close()
+    return counts
+
+def load_config(path=None, overrides=None):
+    """DEFAULT_CONFIG, updated from a JSON file and then from the overrides that are not None"""
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path, 'r', encoding='utf-8') as file:
+            file_config = json.load(file)
+        unknown = set(file_config) - set(config)
+        if unknown:
+            raise ValueError(f'Unknown pipeline settings in {path}: {sorted(unknown)}')
+        config.update(file_config)
+    config.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    unknown = set(config['stages']) - set(STAGES)
+    if unknown:
+        raise ValueError(f'Unknown pipeline stages: {sorted(unknown)}')
+    return config
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the pipeline stages whose items are out of date')
+    parser.add_argument('--config', help='JSON file of settings, see DEFAULT_CONFIG')
+    parser.add_argument('--project-dir', help='Project directory, by default the first of ProjectDirectory.PROJECT_DIRS that exists')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='Stages to run')
+    parser.add_argument('--until', choices=list(STAGES), help='Run this stage and the stages it depends on')
+    parser.add_argument('--forms', nargs='+', choices=['10-K', '10-Q'])
+    parser.add_argument('--companies', nargs='+', help='Company name substrings to limit the run to')
+    parser.add_argument('--index-since-year', type=int)
+    parser.add_argument('--cik-file')
+    parser.add_argument('--from-date')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--force', nargs='+', choices=list(STAGES), default=[], help='Process every item of these stages again')
+    parser.add_argument('--retry-failed', action='store_true', help='Process failed items again even if their input has not changed')
+    parser.add_argument('--instrument', action='store_true', default=None, help='Log step timings and peak memory of every filing')
+    parser.add_argument('--stream', action='store_true', help='Stream filings through download, clean and scoring instead of stage after stage')
+    parser.add_argument('--status', action='store_true', help='Print what each stage has done and exit')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    project_dir = args.project_dir or directory.find_project_dir()
+
+    if args.status:
+        state = PipelineState(project_dir)
+        for stage, done, failed, finished in state.summary():
+            print(f'{stage}: {done} done, {failed} failed, last {finished}')
+        state.close()
+        status_path = os.path.join(project_dir, 'data', STREAM_STATUS_FILE)
+        if os.path.exists(status_path):
+            with open(status_path, 'r', encoding='utf-8') as file:
+                print(f'Last streaming run: {file.read()}')
+    else:
+        config = load_config(args.config, {'stages': sorted(upstream(args.until)) if args.until else args.stages,
+                                           'forms': args.forms, 'companies': args.companies,
+                                           'index_since_year': args.index_since_year, 'cik_file': args.cik_file,
+                                           'from_date': args.from_date, 'workers': args.workers,
+                                           'instrument': args.instrument})
+        if config['instrument']:
+            instrumentation.enable(os.path.join(project_dir, 'data', instrumentation.LOG_FILE))
+        if args.stream:
+            stream_pipeline(project_dir, config, args.force, args.retry_failed)
+        else:
+            run_pipeline(project_dir, config, args.force, args.retry_failed)
@@ -0,0 +1,115 @@
+#
+#   Long-format store of similarity results.
+#
+#       One SQLite row per filing pair, section and measure: (CIK, company, form, accession pair, period, section,
+#       measure, value). The whole document is the section 'document', and section word counts are the measures
+#       latest_words and previous_words, instead of the dynamic _lwc / _pwc columns of the wide results CSV. Rows are
+#       upserted on (CIK, latest accession, previous accession, section, measure), so each run adds new pairs and
+#       refreshes the ones it scores again rather than rewriting the file. Indexes on (section, measure, period) and
+#       (company, form, period) keep queries such as every Item 1A cosine for Q3_2019 to an index lookup.
+#
+#       The checkpoints table lists the pairs whose rows are stored, written in the same transaction as the rows, so a
+#       similarity run that stops part way can skip them when it is started again.
+
+import os
+import sqlite3
+import datetime
+import pandas as pd
+
+RESULTS_DB = 'similarity_results.sqlite'    # Under project_dir/data
+DOCUMENT = 'document'
+
+STORE_COLUMNS = ['cik', 'company', 'form', 'latest_accession', 'previous_accession', 'period', 'previous_period',
+                 'latest_filing_dt', 'previous_filing_dt', 'section', 'measure', 'value']
+
+class ResultsStore:
+    """
+    db_path: SQLite file, project_dir/data/similarity_results.sqlite by default, created if missing
+    """
+    def __init__(self, project_dir, db_path=None):
+        self.conn = sqlite3.connect(db_path or os.path.join(str(project_dir), 'data', RESULTS_DB), timeout=120)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS similarities (
+                cik TEXT, company TEXT, form TEXT,
+                latest_accession TEXT, previous_accession TEXT,
+                period TEXT, previous_period TEXT,     -- fiscal periods from the filing catalog: FY2020, Q3_2019
+                latest_filing_dt TEXT, previous_filing_dt TEXT,
+                section TEXT, measure TEXT, value REAL, updated TEXT,
+                PRIMARY KEY (cik, latest_accession, previous_accession, section, measure)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS similarities_by_section ON similarities (section, measure, period);
+            CREATE INDEX IF NOT EXISTS similarities_by_company ON similarities (company, form, period);
+            CREATE INDEX IF NOT EXISTS similarities_by_form ON similarities (form, period);
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                cik TEXT, latest_accession TEXT, previous_accession TEXT, finished TEXT,
+                PRIMARY KEY (cik, latest_accession, previous_accession)) WITHOUT ROWID;
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, rows, completed=()):
+        """
+        Store long rows, replacing earlier values of the same pair, section and measure
+        rows: tuples in STORE_COLUMNS order, e.g. from calc_doc_similarity.result_rows
+        completed: (CIK, latest accession, previous accession) of the pairs the rows finish, checkpointed in the same transaction
+        Output: number of rows written
+        """
+        updated = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO similarities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (cik, latest_accession, previous_accession, section, measure) DO UPDATE SET
+                    company = excluded.company, form = excluded.form, period = excluded.period,
+                    previous_period = excluded.previous_period, latest_filing_dt = excluded.latest_filing_dt,
+                    previous_filing_dt = excluded.previous_filing_dt, value = excluded.value, updated = excluded.updated''',
+                [tuple(row) + (updated,) for row in rows])
+            self.conn.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)', [tuple(key) + (updated,) for key in completed])
+        return len(rows)
+
+    def completed_pairs(self):
+        """Output: set of (CIK, latest accession, previous accession) checkpointed by earlier runs"""
+        return set(self.conn.execute('SELECT cik, latest_accession, previous_accession FROM checkpoints'))
+
+    def pairs_done(self, form=None):
+        """Output: set of (CIK, latest accession, previous accession) already stored"""
+        return set(self.conn.execute('SELECT DISTINCT cik, latest_accession, previous_accession FROM similarities WHERE (? IS NULL OR form = ?)',
+                                     (form, form)))
+
+    def query(self, form=None, section=None, measure=None, period=None, company=None, cik=None):
+        """
+        Stored results matching every filter given, e.g. query('10-Q', 'item 21a', 'cosine', 'Q3_2019')
+        Output: long dataframe, one row per pair, section and measure
+        """
+        filters = {'form': form, 'section': section, 'measure': measure, 'period': period, 'company': company, 'cik': cik}
+        where = ' AND '.join(f'{column} = ?' for column, value in filters.items() if value is not None) or '1'
+        return pd.read_sql_query(f'SELECT * FROM similarities WHERE {where} ORDER BY company, period, section, measure',
+                                 self.conn, params=[value for value in filters.values() if value is not None])
+
+    def pair_rows(self, form, pairs):
+        """Stored rows of the given (CIK, latest accession, previous accession) pairs. Output: long dataframe"""
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted_pairs (cik TEXT, latest_accession TEXT, previous_accession TEXT)')
+        with self.conn:
+            self.conn.execute('DELETE FROM wanted_pairs')
+            self.conn.executemany('INSERT INTO wanted_pairs VALUES (?, ?, ?)', pairs)
+        return pd.read_sql_query('''
+            SELECT s.* FROM wanted_pairs w JOIN similarities s USING (cik, latest_accession, previous_accession)
+            WHERE s.form = ?''', self.conn, params=(form,))
+
+    def wide(self, form, **filters):
+        """Stored results with one column per section and measure, one row per pair"""
+        df_long = self.query(form, **filters)
+        pair = ['company', 'cik', 'latest_accession', 'previous_accession', 'period', 'previous_period', 'latest_filing_dt', 'previous_filing_dt']
+        df_long['column'] = df_long['section'] + '_' + df_long['measure']
+        df_wide = df_long.set_index(pair + ['column'])['value'].unstack('column').reset_index()
+        df_wide.columns.name = None
+        return df_wide
+
+
+if __name__ == '__main__':
+    import ProjectDirectory as directory
+
+    store = ResultsStore(directory.find_project_dir())
+    for form, in store.conn.execute('SELECT DISTINCT form FROM similarities ORDER BY form'):
+        print(f'{form}: {len(store.pairs_done(form))} filing pairs stored')
+    store.close()
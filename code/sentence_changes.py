@@ -0,0 +1,214 @@
+#
+#   Sentences added and removed between consecutive filings.
+#
+#       Each section of a cleaned filing is split into sentences, and every sentence is normalized (lower case,
+#       punctuation dropped, numbers replaced by #) and hashed to 64 bits. The hashes of a filing are cached, keyed by
+#       the content hash of the cleaned file like the token cache, so a filing is split and hashed once, however many
+#       pairs it is part of. Comparing two filings is then set arithmetic on the hashes of each section: sentences
+#       whose hash is only in the latest filing were added, only in the previous one removed, in both retained.
+#
+#       A sentence that only changes a number or a date is retained, which is what Lazy Prices is after: boilerplate
+#       rolled forward a year is not a change. Set NORMALIZE_NUMBERS = False to count it as a change.
+
+import os
+import re
+import json
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import ProjectDirectory as directory
+import cleaned_filing
+import filing_catalog
+import calc_doc_similarity as similarity
+
+SENTENCE_CACHE_DIR = 'sentence-cache'   # Under the project directory
+SENTENCE_CACHE_VERSION = 'v1'   # Bump when the splitting or the normalization changes
+NORMALIZE_NUMBERS = True
+MIN_SENTENCE_WORDS = 4      # Shorter pieces (headings, page numbers, "None.") are not sentences
+SENTENCE_CHANGE_FILES = {'10-K': 'sentence_changes_10-K.csv', '10-Q': 'sentence_changes_10-Q.csv'}     # Under project_dir/data
+CHANGED_SENTENCE_FILES = {'10-K': 'changed_sentences_10-K.csv', '10-Q': 'changed_sentences_10-Q.csv'}
+
+# Whitespace after a sentence end (possibly closed by a quote or parenthesis) before anything but a lower case letter,
+# or a line break
+BOUNDARY = re.compile(r'(?:(?<=[.!?])|(?<=[.!?]["\')\]]))\s+(?=[^a-z])|\s*\n\s*')
+NUMBER = re.compile(r'\d[\d,.]*')
+NON_WORD = re.compile(r'[^\w#]+')
+
+def normalize_sentence(sentence, numbers=NORMALIZE_NUMBERS):
+    sentence = sentence.lower()
+    if numbers:
+        sentence = NUMBER.sub('#', sentence)
+    return NON_WORD.sub(' ', sentence).strip()
+
+def sentence_hash(normalized):
+    return int.from_bytes(hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+def split_sentences(text, min_words=MIN_SENTENCE_WORDS):
+    """Output: list of (start, end, word count, hash) of the sentences of a section's text"""
+    sentences = []
+    start = 0
+    for boundary in [m.span() for m in BOUNDARY.finditer(text)] + [(len(text), len(text))]:
+        normalized = normalize_sentence(text[start:boundary[0]])
+        words = normalized.count(' ') + 1 if normalized else 0
+        if words >= min_words:
+            sentences.append((start, boundary[0], words, sentence_hash(normalized)))
+        start = boundary[1]
+    return sentences
+
+class FilingSentences:
+    """
+    Sentence hashes of one cleaned filing
+    sections: list of section names
+    hashes, words: hash and word count of every sentence, section after section
+    spans: (start, end) of every sentence in its section's text
+    indptr: section i's sentences are [indptr[i], indptr[i+1])
+    """
+    def __init__(self, header, sections, hashes, words, spans, indptr):
+        self.header = header
+        self.sections = sections
+        self.hashes = hashes
+        self.words = words
+        self.spans = spans
+        self.indptr = indptr
+
+    def section_slice(self, section):
+        i = self.sections.index(section)
+        return slice(self.indptr[i], self.indptr[i + 1])
+
+class SentenceCache:
+    """cache_dir: directory holding one .npz of sentence hashes per filing content"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.config = f'{SENTENCE_CACHE_VERSION}|numbers={NORMALIZE_NUMBERS}|min_words={MIN_SENTENCE_WORDS}'
+
+    def entry_path(self, content):
+        key = hashlib.sha1(content + b'\0' + self.config.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def load(self, filename):
+        """Sentence hashes of a cleaned filing, from the cache if its content has been seen"""
+        with open(filename, 'rb') as file:
+            content = file.read()
+        path = self.entry_path(content)
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as entry:
+                return FilingSentences(json.loads(str(entry['header'])), entry['sections'].tolist(), entry['hashes'],
+                                       entry['words'], entry['spans'], entry['indptr'])
+
+        header_line, _, text = cleaned_filing.normalize_newlines(content.decode('utf-8')).partition('\n')
+        sections = cleaned_filing.split_sections(text)
+        found = [split_sentences(section_text) for section_text in sections.values()]
+        rows = [sentence for sentences in found for sentence in sentences]
+        filing = FilingSentences(json.loads(header_line), list(sections),
+                                 np.array([row[3] for row in rows], dtype=np.int64),
+                                 np.array([row[2] for row in rows], dtype=np.int32),
+                                 np.array([row[:2] for row in rows], dtype=np.int64).reshape(-1, 2),
+                                 np.cumsum([0] + [len(sentences) for sentences in found]).astype(np.int64))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            np.savez_compressed(file, header=np.array(json.dumps(filing.header)), sections=np.array(filing.sections, dtype=str),
+                                hashes=filing.hashes, words=filing.words, spans=filing.spans, indptr=filing.indptr)
+        os.replace(temp_path, path)
+        return filing
+
+def section_changes(latest, previous, section):
+    """
+    Added, removed and retained sentences of a section, by hash
+    Output: dict of counts and word shares, and the positions of the added sentences in latest and the removed ones in previous
+    """
+    latest_slice, previous_slice = latest.section_slice(section), previous.section_slice(section)
+    latest_hashes, previous_hashes = latest.hashes[latest_slice], previous.hashes[previous_slice]
+    latest_words, previous_words = latest.words[latest_slice], previous.words[previous_slice]
+    added = ~np.isin(latest_hashes, previous_hashes)
+    removed = ~np.isin(previous_hashes, latest_hashes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        changes = {
+            'latest_sentences': len(latest_hashes), 'previous_sentences': len(previous_hashes),
+            'added': int(added.sum()), 'removed': int(removed.sum()), 'retained': int((~added).sum()),
+            'added_share': latest_words[added].sum() / latest_words.sum() if latest_words.sum() else np.nan,
+            'removed_share': previous_words[removed].sum() / previous_words.sum() if previous_words.sum() else np.nan
+        }
+    return changes, latest_slice.start + np.flatnonzero(added), previous_slice.start + np.flatnonzero(removed)
+
+# Sentence cache of each worker process, created on first use
+sentence_caches = {}
+
+def get_sentence_cache(project_dir):
+    if project_dir not in sentence_caches:
+        sentence_caches[project_dir] = SentenceCache(os.path.join(project_dir, SENTENCE_CACHE_DIR))
+    return sentence_caches[project_dir]
+
+def changed_sentence_text(path, filing, positions):
+    """Text of the sentences at the given positions, reading only their sections"""
+    if not len(positions):
+        return []
+    rows = np.searchsorted(filing.indptr, positions, side='right') - 1
+    texts = cleaned_filing.read_sections(path, sorted(set(filing.sections[row] for row in rows)))
+    return [(filing.sections[row], texts[filing.sections[row]][start:end]) for row, (start, end) in zip(rows, filing.spans[positions])]
+
+def compare_company(task, project_dir, emit_sentences=True):
+    """
+    Worker: sentence changes of each of a company's same-period filing pairs
+    task: (company, list of pair dicts from the catalog, with their form)
+    Output: (list of count records, list of changed sentence records), each tagged with its form
+    """
+    company, pairs = task
+    cache = get_sentence_cache(project_dir)
+    change_records, sentence_records = [], []
+    for pair in pairs:
+        try:
+            latest_path = os.path.join(project_dir, pair['latest_path'])
+            previous_path = os.path.join(project_dir, pair['previous_path'])
+            latest, previous = cache.load(latest_path), cache.load(previous_path)
+            pair_fields = {'form': pair['form'], 'company': company, 'CIK': pair['latest_cik'],
+                           'latest_accession': pair['latest_accession'], 'previous_accession': pair['previous_accession'],
+                           'latest_filing_dt': pair['latest_filing_date'], 'previous_filing_dt': pair['previous_filing_date']}
+            added_positions, removed_positions = [], []
+            for section in latest.sections:
+                if section not in previous.sections:
+                    continue
+                changes, added, removed = section_changes(latest, previous, section)
+                change_records.append(dict(pair_fields, section=section, **changes))
+                added_positions.extend(added)
+                removed_positions.extend(removed)
+            if emit_sentences:
+                for change, path, filing, positions in [('added', latest_path, latest, added_positions),
+                                                        ('removed', previous_path, previous, removed_positions)]:
+                    for section, text in changed_sentence_text(path, filing, np.array(positions, dtype=np.int64)):
+                        sentence_records.append(dict(pair_fields, section=section, change=change, sentence=text))
+        except Exception as e:
+            print('Exception comparing sentences of {} {}: {}'.format(company, pair['latest_accession'], e))
+    return change_records, sentence_records
+
+def compare_all_companies(project_dir, forms=('10-K', '10-Q'), workers=similarity.SIMILARITY_WORKERS, emit_sentences=True):
+    """Output: (dict of form -> sentence change counts dataframe, dict of form -> changed sentences dataframe)"""
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    tasks = similarity.catalog_pair_tasks(catalog, forms, latest_only=False)
+    catalog.close()
+
+    compare = functools.partial(compare_company, project_dir=project_dir, emit_sentences=emit_sentences)
+    change_records, sentence_records = [], []
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for changes, sentences in pool.imap(compare, tasks, chunksize=4):
+                change_records.extend(changes)
+                sentence_records.extend(sentences)
+    else:
+        for changes, sentences in map(compare, tasks):
+            change_records.extend(changes)
+            sentence_records.extend(sentences)
+
+    df_changes, df_sentences = pd.DataFrame(change_records), pd.DataFrame(sentence_records)
+    by_form = lambda df, form: df[df['form'] == form].drop(columns='form').reset_index(drop=True) if len(df) else df
+    return {form: by_form(df_changes, form) for form in forms}, {form: by_form(df_sentences, form) for form in forms}
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    df_changes, df_sentences = compare_all_companies(project_dir)
+    for form in df_changes:
+        df_changes[form].to_csv(os.path.join(project_dir, 'data', SENTENCE_CHANGE_FILES[form]), encoding='utf-8', index=False)
+        df_sentences[form].to_csv(os.path.join(project_dir, 'data', CHANGED_SENTENCE_FILES[form]), encoding='utf-8', index=False)
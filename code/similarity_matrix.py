@@ -0,0 +1,107 @@
+#
+#   Corpus-level sparse term-document matrix.
+#
+#       Rather than fitting a new CountVectorizer for every filing pair and section pair and densifying the counts,
+#       every document and section is hashed into one shared feature space as it is read. The requested pairs are
+#       then scored with row-normalized sparse dot products in a single vectorized operation.
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+HASH_FEATURES = 2 ** 20     # Size of the hashed vocabulary shared by all filings
+
+def make_vectorizer(tokenizer, n_features=HASH_FEATURES):
+    """Stateless vectorizer: the same token always maps to the same column, for every filing and every run"""
+    return HashingVectorizer(tokenizer=tokenizer, token_pattern=None, n_features=n_features,
+                             alternate_sign=False, norm=None, dtype=np.float64)
+
+def pretokenized(tokens):
+    return tokens
+
+def make_token_vectorizer(n_features=HASH_FEATURES):
+    """Vectorizer for documents that are already lists of tokens. Hashes to the same columns as make_vectorizer"""
+    return HashingVectorizer(analyzer=pretokenized, n_features=n_features, alternate_sign=False, norm=None, dtype=np.float64)
+
+def pairwise_cosine(X, left, right):
+    """
+    Cosine similarity of rows left[i] and right[i] of X, for all i at once
+    Output: array of similarities. Pairs involving an empty row are NaN, as with the dense calculation
+    """
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    if len(left) == 0:
+        return np.zeros(0)
+    X = sp.csr_matrix(X)
+    Xn = normalize(X, norm='l2', axis=1)
+    similarity = np.asarray(Xn[left].multiply(Xn[right]).sum(axis=1)).ravel()
+    empty = np.diff(X.indptr) == 0
+    similarity[empty[left] | empty[right]] = np.nan
+    return similarity
+
+def pairwise_jaccard(X, left, right):
+    """
+    Jaccard similarity of the sets of tokens in rows left[i] and right[i] of X: shared tokens over tokens in either
+    Output: array of similarities, NaN if both rows are empty
+    """
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    if len(left) == 0:
+        return np.zeros(0)
+    X = sp.csr_matrix(X)
+    B = X.copy()
+    B.data = (B.data != 0).astype(np.float64)
+    intersection = np.asarray(B[left].multiply(B[right]).sum(axis=1)).ravel()
+    sizes = np.asarray(B.sum(axis=1)).ravel()
+    union = sizes[left] + sizes[right] - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, intersection / union, np.nan)
+
+class CorpusMatrix:
+    """
+    Accumulates count rows for the documents and sections of many filings, and the pairs of rows to compare
+    tokenizer: callable returning the tokens of a text, e.g. filing_tokenizer.FilingTokenizer. None if only
+               already vectorized rows are added
+    """
+    def __init__(self, tokenizer, n_features=HASH_FEATURES):
+        self.vectorizer = make_vectorizer(tokenizer, n_features) if tokenizer else None
+        self.n_features = n_features
+        self.blocks = []
+        self.n_rows = 0
+        self.left = []
+        self.right = []
+
+    def add_matrix(self, X):
+        """Append already vectorized rows. Output: list of their row numbers"""
+        self.blocks.append(sp.csr_matrix(X))
+        rows = list(range(self.n_rows, self.n_rows + X.shape[0]))
+        self.n_rows += X.shape[0]
+        return rows
+
+    def add_texts(self, texts):
+        """Vectorize texts and append them. Output: list of their row numbers"""
+        if len(texts) == 0:
+            return []
+        return self.add_matrix(self.vectorizer.transform(texts))
+
+    def add_pair(self, left_row, right_row):
+        """Queue a pair of rows to compare. Output: index of the pair in the similarity array"""
+        self.left.append(left_row)
+        self.right.append(right_row)
+        return len(self.left) - 1
+
+    def matrix(self):
+        if not self.blocks:
+            return sp.csr_matrix((0, self.n_features))
+        if len(self.blocks) > 1:
+            self.blocks = [sp.vstack(self.blocks, format='csr')]
+        return self.blocks[0]
+
+    def cosine(self):
+        """Cosine similarity of every queued pair, in the order they were added"""
+        return pairwise_cosine(self.matrix(), self.left, self.right)
+
+    def jaccard(self):
+        """Jaccard similarity of every queued pair, in the order they were added"""
+        return pairwise_jaccard(self.matrix(), self.left, self.right)
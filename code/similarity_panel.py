@@ -0,0 +1,126 @@
+#
+#   Full-history similarity panel.
+#
+#       calc_doc_similarity compares only the latest 10-K with the prior year and the latest 10-Q with the same
+#       quarter a year earlier. The panel compares every filing with the same period a year before, across each
+#       company's whole history, so the similarity series can be backtested. Pairs come from the filing catalog.
+#       Each filing's token counts are read once per company, through the token cache, even though it takes part in
+#       two pairs. Pairs already in the stored panel are skipped, so a run after new filings arrive only scores the
+#       new pairs. They are streamed to the long results store in checkpointed batches, then appended to the panel CSV.
+
+import os
+import functools
+import pandas as pd
+import scipy.sparse as sp
+import ProjectDirectory as directory
+import calc_doc_similarity as similarity
+import filing_catalog
+
+PANEL_10K = True
+PANEL_10Q = True
+PANEL_FILES = {'10-K': 'similarity_panel_10-K.csv', '10-Q': 'similarity_panel_10-Q.csv'}   # Under project_dir/data
+PANEL_KEY = ['CIK', 'latest_accession', 'previous_accession']     # Same key as the results store
+PANEL_ORDER = ['company', 'latest_filing_dt', 'previous_filing_dt']
+
+panel_columns = {'10-K': similarity.ten_k_columns, '10-Q': similarity.ten_q_columns}
+
+def process_company_panel(task, project_dir):
+    """
+    Worker: reads the token counts of every filing in the company's new pairs, once each.
+    task: (company, list of pair dicts from filing_catalog.FilingCatalog.pairs, with their form)
+    Output: (counts matrix of the company's filings, list of (form, result_dict, pending pairs))
+    """
+    company, pairs = task
+    cache = similarity.get_token_cache(project_dir)
+
+    loaded = {}     # path -> (CachedFiling, first row)
+    blocks = []
+    n_rows = 0
+    jobs = []
+    for pair in pairs:
+        form = pair['form']
+        try:
+            for path in [pair['latest_path'], pair['previous_path']]:
+                if path not in loaded:
+                    filing = cache.load(os.path.join(project_dir, path))
+                    loaded[path] = (filing, n_rows)
+                    blocks.append(filing.counts)
+                    n_rows += filing.counts.shape[0]
+        except Exception as e:
+            print('Exception during {} panel for {}: {}'.format(form, company, e))
+            continue
+
+        (latest, latest_offset), (previous, previous_offset) = loaded[pair['latest_path']], loaded[pair['previous_path']]
+        result_dict = similarity.pair_result_dict(pair)
+        pending = similarity.queue_filing_pair(result_dict, latest, previous, latest_offset, previous_offset)
+        jobs.append((form, result_dict, pending))
+
+    if not jobs:
+        return None, []
+    return sp.vstack(blocks, format='csr'), jobs
+
+def add_company_panel(corpus, result):
+    """Queue the pairs read by process_company_panel in a corpus, as calc_doc_similarity.add_company_pairs does"""
+    counts, jobs = result
+    if not jobs:
+        return []
+    rows = corpus.add_matrix(counts)
+    return [(form, result_dict, [(column, corpus.add_pair(rows[latest_row], rows[previous_row]))
+                                 for column, latest_row, previous_row in pending])
+            for form, result_dict, pending in jobs]
+
+def read_panel(path):
+    """Stored panel, or an empty frame if none has been written yet"""
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=PANEL_KEY)
+    return pd.read_csv(path, encoding='utf-8', dtype={'company': str, 'CIK': str, 'latest_filing_dt': str, 'previous_filing_dt': str,
+                                                      'latest_accession': str, 'previous_accession': str})
+
+def write_panel(df_panel, path):
+    temp_path = path + '.tmp'
+    df_panel.to_csv(temp_path, encoding='utf-8', index=False)
+    os.replace(temp_path, path)
+
+def update_panels(project_dir, panel_10k=PANEL_10K, panel_10q=PANEL_10Q, workers=similarity.SIMILARITY_WORKERS):
+    """
+    Scores the consecutive same-period pairs missing from the stored panels and appends them.
+    Output: dict of form -> number of pairs added
+    """
+    forms = [form for form, wanted in [('10-K', panel_10k), ('10-Q', panel_10q)] if wanted]
+    panel_paths = {form: os.path.join(project_dir, 'data', PANEL_FILES[form]) for form in forms}
+    panels = {form: read_panel(panel_paths[form]) for form in forms}
+
+    # Pairs already in the panel are dropped before any filing is read
+    done = set()
+    for form in forms:
+        done.update(panels[form][PANEL_KEY].itertuples(index=False, name=None))
+    catalog = filing_catalog.FilingCatalog(project_dir)
+    tasks = [(company, [pair for pair in pairs if similarity.pair_key(pair) not in done])
+             for company, pairs in similarity.catalog_pair_tasks(catalog, forms, latest_only=False)]
+    tasks = [task for task in tasks if task[1]]
+    catalog.close()
+
+    # Scored pairs are committed to the results store batch by batch, then appended to the panels from there, so
+    # pairs stored by a run that stopped before writing the panels are not scored again
+    read_company = functools.partial(process_company_panel, project_dir=project_dir)
+    similarity.run_similarity_batches(project_dir, tasks, read_company, add_company_panel, 'Panel', workers)
+
+    added = {}
+    for form in forms:
+        df_new = similarity.stored_results(project_dir, form, [pair for _, pairs in tasks for pair in pairs if pair['form'] == form],
+                                           panel_columns[form])
+        added[form] = len(df_new)
+        if not len(df_new):
+            continue
+        df_panel = pd.concat([panels[form], df_new], ignore_index=True) if len(panels[form]) else df_new
+        extra_columns = [column for column in df_panel.columns if column not in panel_columns[form]]
+        df_panel = df_panel.reindex(columns=panel_columns[form] + extra_columns)
+        write_panel(df_panel.sort_values(PANEL_ORDER, kind='stable'), panel_paths[form])
+    return added
+
+
+if __name__ == '__main__':
+    project_dir = directory.find_project_dir()
+    added = update_panels(project_dir)
+    for form, n in added.items():
+        print(f'{n} new {form} pairs added to {PANEL_FILES[form]}')
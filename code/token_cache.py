@@ -0,0 +1,124 @@
+#
+#   Persistent per-filing token-count cache.
+#
+#       Every filing is tokenized at least twice: as the latest filing, and a year later as the previous one, plus
+#       once more per section for the word counts. Cache the hashed token counts of the whole document and of each
+#       section, with the section word counts, keyed by the content hash of the cleaned file and the preprocessing
+#       configuration. Each entry is one compressed .npz file, so a filing that has been seen is never tokenized again.
+#       Entries also keep the token ID sequence of every row, for the diff-based similarity measures. Sequences are
+#       stored as indices into the filing's own vocabulary, which keeps them small.
+
+import os
+import json
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+import filing_tokenizer
+import similarity_matrix
+
+TOKEN_CACHE_DIR = 'token-cache'     # Under the project directory
+CACHE_VERSION = 'v3'    # Bump when the cached layout or the preprocessing changes
+
+def tokenizer_config(tokenizer, n_features):
+    """String that identifies everything that changes the token counts"""
+    stopwords_digest = hashlib.sha1('\n'.join(sorted(tokenizer.stopwords)).encode('utf-8')).hexdigest()[:12]
+    return f'{CACHE_VERSION}|mode={tokenizer.mode}|stemming={tokenizer.stemming}|stopwords={stopwords_digest}|features={n_features}'
+
+class CachedFiling:
+    """
+    Token counts of one cleaned filing
+    header: header dict written by the cleaner
+    sections: list of section names, in the order split_sections returns them
+    counts: sparse matrix, row 0 is the whole document and row i+1 is sections[i]
+    word_counts: array of raw word counts, aligned with the rows of counts
+    token_ids: token ID sequences of all rows, concatenated
+    token_indptr: row i's sequence is token_ids[token_indptr[i]:token_indptr[i+1]]
+    """
+    def __init__(self, header, sections, counts, word_counts, token_ids, token_indptr):
+        self.header = header
+        self.sections = sections
+        self.counts = counts
+        self.word_counts = word_counts
+        self.token_ids = token_ids
+        self.token_indptr = token_indptr
+
+    def section_row(self, section):
+        return self.sections.index(section) + 1
+
+    def row_tokens(self, row):
+        """Token ID sequence of a row, as a list for the diff"""
+        return self.token_ids[self.token_indptr[row]:self.token_indptr[row + 1]].tolist()
+
+class TokenCache:
+    """
+    cache_dir: directory holding the .npz entries
+    tokenizer: filing_tokenizer.FilingTokenizer used on a cache miss
+    split_sections: function splitting a cleaned filing into a dict of section name -> text
+    on_miss: optional callable(filename, CachedFiling), called once a filing has been tokenized for the first time
+    """
+    def __init__(self, cache_dir, tokenizer, split_sections, n_features=similarity_matrix.HASH_FEATURES, on_miss=None):
+        self.cache_dir = cache_dir
+        self.on_miss = on_miss
+        self.tokenizer = tokenizer
+        self.split_sections = split_sections
+        self.vectorizer = similarity_matrix.make_token_vectorizer(n_features)
+        self.config = tokenizer_config(tokenizer, n_features)
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, content):
+        key = hashlib.sha1(content + b'\0' + self.config.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def load(self, filename):
+        """Token counts of a cleaned filing, from the cache if its content has been seen with this configuration"""
+        with open(filename, 'rb') as file:
+            content = file.read()
+        path = self.entry_path(content)
+        if os.path.exists(path):
+            self.hits += 1
+            return read_entry(path)
+
+        self.misses += 1
+        # Same newline handling as reading the file in text mode
+        header_line, _, text = content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').partition('\n')
+        header = json.loads(header_line)
+        sections = self.split_sections(text)
+        texts = [text] + list(sections.values())
+        tokens = [self.tokenizer(t) for t in texts]
+        counts = self.vectorizer.transform(tokens)
+        word_counts = np.array([filing_tokenizer.count_words(t) for t in texts], dtype=np.int64)
+        token_ids = [self.tokenizer.token_ids(t) for t in tokens]
+        token_indptr = np.cumsum([0] + [len(t) for t in token_ids]).astype(np.int64)
+        filing = CachedFiling(header, list(sections), counts, word_counts, np.concatenate(token_ids), token_indptr)
+        write_entry(path, filing)
+        if self.on_miss:
+            self.on_miss(filename, filing)
+        return filing
+
+def write_entry(path, filing):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    counts = sp.csr_matrix(filing.counts)
+    vocabulary, token_index = np.unique(filing.token_ids, return_inverse=True)
+    token_index = token_index.astype(np.uint16 if len(vocabulary) <= 2 ** 16 else np.uint32)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        np.savez_compressed(file,
+            header=np.array(json.dumps(filing.header)),
+            sections=np.array(filing.sections, dtype=str),
+            data=counts.data.astype(np.int32),
+            indices=counts.indices.astype(np.int32),
+            indptr=counts.indptr.astype(np.int64),
+            shape=np.array(counts.shape, dtype=np.int64),
+            word_counts=filing.word_counts,
+            vocabulary=vocabulary,
+            token_index=token_index,
+            token_indptr=filing.token_indptr)
+    os.replace(temp_path, path)
+
+def read_entry(path):
+    with np.load(path, allow_pickle=False) as entry:
+        counts = sp.csr_matrix((entry['data'].astype(np.float64), entry['indices'], entry['indptr']), shape=tuple(entry['shape']))
+        token_ids = entry['vocabulary'][entry['token_index']]
+        return CachedFiling(json.loads(str(entry['header'])), entry['sections'].tolist(), counts, entry['word_counts'],
+                            token_ids, entry['token_indptr'])
@@ -0,0 +1,218 @@
+#
+#   Token-level diff of two filings.
+#
+#       Sequences are lists of interned integer token IDs (FilingTokenizer.token_ids), so comparing two tokens is an
+#       integer comparison. Common prefixes and suffixes are trimmed first, tokens that occur exactly once on both
+#       sides anchor the sequences (patience diff), and the gaps left between anchors are solved with Myers' O(ND)
+#       algorithm in linear space (middle snake). Unchanged boilerplate therefore costs almost nothing, and the
+#       quadratic work is confined to the regions that were actually rewritten.
+#
+#       The measures follow Cohen, Malloy and Nguyen, "Lazy Prices":
+#           edit similarity   = 1 - edit distance / max(n, m), a replaced run counts max(deleted, inserted) edits
+#           simple similarity = 1 - (deleted + inserted) / (n + m)
+
+from collections import Counter
+from bisect import bisect_left
+
+MAX_DIFF_COST = 256     # Search depth of one middle snake before settling for a near-minimal split
+
+def common_prefix(a, alo, ahi, b, blo, bhi):
+    i = 0
+    n = min(ahi - alo, bhi - blo)
+    while i < n and a[alo + i] == b[blo + i]:
+        i += 1
+    return i
+
+def common_suffix(a, alo, ahi, b, blo, bhi):
+    i = 0
+    n = min(ahi - alo, bhi - blo)
+    while i < n and a[ahi - 1 - i] == b[bhi - 1 - i]:
+        i += 1
+    return i
+
+def patience_anchors(a, alo, ahi, b, blo, bhi):
+    """
+    Positions (i, j) of tokens unique in both ranges, longest run that is increasing in both. A unique token only
+    anchors if a neighbouring token matches too, so one word that happens to occur once on each side of a rewritten
+    region cannot pull the alignment out of place
+    """
+    a_counts = Counter(a[alo:ahi])
+    b_positions = {}
+    for j in range(blo, bhi):
+        token = b[j]
+        if a_counts.get(token) == 1:
+            b_positions[token] = -1 if token in b_positions else j
+    candidates = []
+    for i in range(alo, ahi):
+        j = b_positions.get(a[i], -1)
+        if j >= 0 and ((i > alo and j > blo and a[i - 1] == b[j - 1]) or (i + 1 < ahi and j + 1 < bhi and a[i + 1] == b[j + 1])):
+            candidates.append((i, j))
+    if not candidates:
+        return []
+
+    # Longest increasing subsequence of the b positions, in a order
+    tails = []
+    tail_index = []
+    previous = [-1] * len(candidates)
+    for index, (i, j) in enumerate(candidates):
+        k = bisect_left(tails, j)
+        if k:
+            previous[index] = tail_index[k - 1]
+        if k == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[k] = j
+            tail_index[k] = index
+    anchors = []
+    index = tail_index[-1]
+    while index >= 0:
+        anchors.append(candidates[index])
+        index = previous[index]
+    return anchors[::-1]
+
+def middle_snake(a, alo, ahi, b, blo, bhi, max_cost):
+    """
+    Myers' middle snake of a[alo:ahi] and b[blo:bhi], which share no first or last token
+    Output: (x, y, u, v) relative to alo and blo, with a[x:u] == b[y:v] on an optimal path. Once the search passes
+            max_cost, the furthest reaching point found so far is returned as an empty snake instead, as GNU diff does,
+            so the result is no longer minimal but the cost stays bounded
+    """
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    limit = (n + m + 1) // 2
+    offset = limit + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(limit + 1):
+        if d > max_cost:
+            return furthest_point(forward, backward, offset, d - 1, n, m)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and delta - (d - 1) <= k <= delta + (d - 1) and x + backward[offset + delta - k] >= n:
+                return start, start - k, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return n - x, m - y, n - start, m - (start - k)
+    return None
+
+def furthest_point(forward, backward, offset, d, n, m):
+    """Point on the diagonal that got furthest, forward or backward, after d steps. None if it is a corner"""
+    best, point = -1, None
+    for k in range(-d, d + 1, 2):
+        x = forward[offset + k]
+        if 0 <= x <= n and 0 <= x - k <= m and 2 * x - k > best:
+            best, point = 2 * x - k, (x, x - k)
+        x = backward[offset + k]
+        if 0 <= x <= n and 0 <= x - k <= m and 2 * x - k > best:
+            best, point = 2 * x - k, (n - x, m - (x - k))
+    if point is None or point in ((0, 0), (n, m)):
+        return None
+    return point + point
+
+def matching_blocks(a, b, max_cost=MAX_DIFF_COST):
+    """
+    Output: list of (i, j, size) with a[i:i+size] == b[j:j+size], increasing in i and j, adjacent blocks merged and
+            ending with the sentinel (len(a), len(b), 0), as difflib.SequenceMatcher.get_matching_blocks returns them
+    """
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        size = common_prefix(a, alo, ahi, b, blo, bhi)
+        if size:
+            blocks.append((alo, blo, size))
+            alo += size
+            blo += size
+        size = common_suffix(a, alo, ahi, b, blo, bhi)
+        if size:
+            blocks.append((ahi - size, bhi - size, size))
+            ahi -= size
+            bhi -= size
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = patience_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            i0, j0 = alo, blo
+            for i, j in anchors:
+                blocks.append((i, j, 1))
+                stack.append((i0, i, j0, j))
+                i0, j0 = i + 1, j + 1
+            stack.append((i0, ahi, j0, bhi))
+            continue
+
+        snake = middle_snake(a, alo, ahi, b, blo, bhi, max_cost)
+        if snake is None:
+            continue    # Nothing in common: the whole gap is replaced
+        x, y, u, v = snake
+        if u > x:
+            blocks.append((alo + x, blo + y, u - x))
+        stack.append((alo, alo + x, blo, blo + y))
+        stack.append((alo + u, ahi, blo + v, bhi))
+
+    blocks.sort()
+    merged = []
+    for i, j, size in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((i, j, size))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+def get_opcodes(a, b, max_cost=MAX_DIFF_COST):
+    """Edit script in the format of difflib.SequenceMatcher.get_opcodes: (tag, i1, i2, j1, j2)"""
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in matching_blocks(a, b, max_cost):
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+def diff_similarities(a, b, max_cost=MAX_DIFF_COST):
+    """
+    Edit and simple similarity of two token ID sequences
+    Output: dict with 'edit' and 'simple', NaN if both sequences are empty
+    """
+    n, m = len(a), len(b)
+    if n + m == 0:
+        return {'edit': float('nan'), 'simple': float('nan')}
+    edits = 0
+    changed = 0
+    for tag, i1, i2, j1, j2 in get_opcodes(a, b, max_cost):
+        if tag != 'equal':
+            edits += max(i2 - i1, j2 - j1)
+            changed += (i2 - i1) + (j2 - j1)
+    return {'edit': max(0.0, 1 - edits / max(n, m)), 'simple': 1 - changed / (n + m)}